@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 import pathlib
@@ -7,6 +8,7 @@ import subprocess
 import sys
 import tarfile
 import tempfile
+from tracker.pipeline import prefetched
 
 
 parser = argparse.ArgumentParser(description="Import multiple csv files from an archive directory and running the compare_csv_files.py script",
@@ -25,7 +27,78 @@ parser.add_argument("--start_date", type=lambda s: datetime.strptime(s, '%Y-%m-%
 parser.add_argument("--end_date", type=lambda s: datetime.strptime(s, '%Y-%m-%d'), action='store', required=False,
                     help="The date to stop on. If not specified, the script will run until the end of the directory. "
                          "Format: YYYY-MM-DD")
+parser.add_argument("-j", "--jobs", type=int, required=False, default=1,
+                    help="The number of PD type comparisons to run at the same time for each day. Keep this low enough to "
+                         "protect the PostgreSQL server. Not used with --stream. Default: 1")
+parser.add_argument("-p", "--prefetch", type=int, required=False, default=0,
+                    help="The number of archive files to extract in the background while the current day is being compared. "
+                         "Each prefetched archive uses its own temporary directory. Default: 0")
+parser.add_argument("--stream", action='store_true', required=False, default=False,
+                    help="Read the CSV files directly from the archive files without extracting them to disk. The comparisons "
+                         "are run in a single process by the compare_pd_archive command.")
+parser.add_argument("--profile_dir", type=pathlib.Path, required=False,
+                    help="Profile every comparison with cProfile and write one profile per PD type and day to this directory.")
+parser.add_argument("--profile_memory", action='store_true', required=False, default=False,
+                    help="Also write a tracemalloc allocation snapshot with each profile. Requires --profile_dir.")
 args = parser.parse_args()
+if args.jobs < 1:
+    print("The number of jobs must be at least 1.")
+    sys.exit(1)
+if args.prefetch < 0:
+    print("The number of prefetched archives cannot be negative.")
+    sys.exit(1)
+if args.profile_memory and not args.profile_dir:
+    print("--profile_memory requires --profile_dir.")
+    sys.exit(1)
+
+# Options passed to every comparison to profile it
+profile_options = ['--profile', '--profile_dir', str(args.profile_dir)] if args.profile_dir else []
+if args.profile_memory:
+    profile_options.append('--profile_memory')
+
+
+def run_compare(cmd, capture):
+    '''
+    Run a single compare_csv_files command
+    :param cmd: The command line to run
+    :param capture: Capture the output of the command so it can be printed in order once the command is done
+    :return: The completed process
+    '''
+    return subprocess.run(cmd, stdout=subprocess.PIPE if capture else None, stderr=subprocess.STDOUT if capture else None,
+                          text=True)
+
+
+def extract_archive(tar_file):
+    '''
+    Extract a daily archive file to a new temporary directory
+    :param tar_file: The archive file name
+    :return: tuple of the archive file name and the temporary directory
+    '''
+    temp_dir = tempfile.mkdtemp(prefix="import_od_", dir=args.temp_dir) if args.temp_dir else tempfile.mkdtemp()
+    print('Extracting {0} to {1}'.format(tar_file, temp_dir))
+    tar = tarfile.open(os.path.join(args.data_dir, tar_file))
+    tar.extractall(temp_dir)
+    tar.close()
+    return tar_file, temp_dir
+
+
+# When streaming, hand the whole date range to the in-process archive command
+
+if args.stream:
+    if args.jobs > 1:
+        print("--jobs is ignored with --stream: compare_pd_archive compares one PD type at a time in a single process.")
+    cmd = [sys.executable, 'manage.py', 'compare_pd_archive', '-d', str(args.data_dir), '--stream', '--prefetch', str(args.prefetch)]
+    if args.temp_dir:
+        cmd.extend(['--temp_dir', str(args.temp_dir)])
+    if args.latest_only:
+        cmd.append('--latest_only')
+    if args.start_date:
+        cmd.extend(['--start_date', args.start_date.strftime("%Y-%m-%d")])
+    if args.end_date:
+        cmd.extend(['--end_date', args.end_date.strftime("%Y-%m-%d")])
+    cmd.extend(profile_options)
+    print(f' Running {" ".join(cmd)}')
+    sys.exit(subprocess.run(cmd).returncode)
 
 # Get the list of archive files based on the user provided parameters
 
@@ -46,37 +119,27 @@ else:
     if args.end_date:
         sorted_file_list = [x for x in sorted_file_list if args.end_date >= datetime.strptime(x[3:11], '%Y%m%d')]
 
+# Verify the temporary working directory, if provided
+if args.temp_dir and not os.path.isdir(args.temp_dir):
+    print(f"Cannot find temporary working directory '{args.temp_dir}'")
+    exit(-1)
+
 from_file = ""
 to_file = ""
 to_date = None
 from_date = None
 temp_from_dir = None
 temp_to_dir = None
+results = []
 
-# For each archive file, extract the contents to a temporary directory and call the compare_csv_files.py script
+# For each archive file, extract the contents to a temporary directory and call the compare_csv_files.py script.
+# Up to --prefetch archives are extracted in the background while the current day is being compared.
 
+archives = prefetched([x for x in sorted_file_list if x.endswith('.tar.gz')], extract_archive, depth=args.prefetch,
+                      discard=lambda extracted: shutil.rmtree(extracted[1], ignore_errors=True))
 try:
-    for tar_file in sorted_file_list:
-        # Redundant check, but just in case.
-        if not tar_file.endswith('.tar.gz'):
-            continue
+    for tar_file, temp_to_dir in archives:
         to_file = tar_file
-
-        # Verify the temporary working directory, if provided
-        if args.temp_dir:
-            if os.path.isdir(args.temp_dir):
-                temp_to_dir = tempfile.mkdtemp(prefix="import_od_", dir=args.temp_dir)
-            else:
-                print(f"Cannot find temporary working directory '{args.temp_dir}'")
-                exit(-1)
-        else:
-            temp_to_dir = tempfile.mkdtemp()
-
-        print('Extracting {0} to {1}'.format(tar_file, temp_to_dir))
-        tar = tarfile.open(os.path.join(args.data_dir, tar_file))
-        tar.extractall(temp_to_dir)
-        tar.close()
-
         to_date = datetime.strptime(tar_file[3:11], "%Y%m%d")
 
         if not from_file:
@@ -90,19 +153,28 @@ try:
         sorted_csv_list = os.listdir(temp_to_dir)
         sorted_csv_list.sort()
 
-        # Run the compare script for each file
+        # Run the compare script for each file. Commands run in a bounded pool and their output is printed in file order.
 
+        commands = []
         for csv_file in sorted_csv_list:
             csv_from = os.path.join(temp_from_dir, csv_file)
             csv_to = os.path.join(temp_to_dir, csv_file)
 
             if os.path.exists(csv_from) and os.path.exists(csv_to):
                 print(f' Running {sys.executable} manage.py compare_csv_files -t {pathlib.Path(csv_file).stem} -fi {csv_from} -f2 {csv_to} -s {from_date.strftime("%Y-%m-%d")} -l {to_date.strftime("%Y-%m-%d")}')
-                proc = subprocess.run([sys.executable, 'manage.py', 'compare_csv_files', '-t',
-                                       pathlib.Path(csv_file).stem.replace('-', '_'), '-f1', csv_from, '-f2', csv_to,
-                                       '-s', from_date.strftime("%Y-%m-%d"), '-l', to_date.strftime("%Y-%m-%d"), '-x'])
+                commands.append((csv_file, [sys.executable, 'manage.py', 'compare_csv_files', '-t',
+                                            pathlib.Path(csv_file).stem.replace('-', '_'), '-f1', csv_from, '-f2', csv_to,
+                                            '-s', from_date.strftime("%Y-%m-%d"), '-l', to_date.strftime("%Y-%m-%d"), '-x'] + profile_options))
+
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [(csv_file, cmd, pool.submit(run_compare, cmd, args.jobs > 1)) for csv_file, cmd in commands]
+            for csv_file, cmd, future in futures:
+                proc = future.result()
+                if proc.stdout:
+                    print(proc.stdout, end='')
                 if proc.returncode != 0:
-                    print(f'Error running {sys.executable} manage.py compare_csv_files -t {pathlib.Path(csv_file).stem} -fi {csv_from} -f2 {csv_to} -s {from_date.strftime("%Y-%m-%d")} -l {to_date.strftime("%Y-%m-%d")}', file=sys.stderr)
+                    print(f'Error running {" ".join(cmd)}', file=sys.stderr)
+                results.append((to_date, pathlib.Path(csv_file).stem, proc.returncode == 0))
         from_date = to_date
 
         # Clean up the previous temp dir
@@ -111,5 +183,19 @@ try:
         temp_from_dir = temp_to_dir
 
 finally:
+    archives.close()
+    if temp_to_dir and os.path.exists(temp_to_dir):
+        shutil.rmtree(temp_to_dir)
     if temp_from_dir and os.path.exists(temp_from_dir):
-        shutil.rmtree(temp_from_dir)
\ No newline at end of file
+        shutil.rmtree(temp_from_dir)
+
+# Summarize the comparisons by PD type
+
+if results:
+    print('Summary:')
+    for pd_type in sorted(set(r[1] for r in results)):
+        type_results = [r for r in results if r[1] == pd_type]
+        failed = [r[0].strftime("%Y-%m-%d") for r in type_results if not r[2]]
+        print(f' {pd_type}: {len(type_results) - len(failed)} succeeded, {len(failed)} failed{" (" + ", ".join(failed) + ")" if failed else ""}')
+    if any(not r[2] for r in results):
+        sys.exit(1)
@@ -1,18 +1,11 @@
 #
 # Re-read the recombinant schemas from the Open Canada portal and import them into the PD Tracker database.
-# No arguments are required.
+# No arguments are required. The PD types are the default list of import_ckan_schema, or the PD_TYPES setting if it is set.
 #
 
 # activate the PD Tracker Python virtual environment before running.
 .\venv\Scripts\activate
 
-$pdtypes = @("adminaircraft","ati","briefingt","consultations","contracts","contractsa",`
- "dac","experiment","grants","hospitalityq","inventory","nap","qpnotes",`
- "reclassification", "service","travela","travelq","wrongdoing")
-
-# Call the Django custom command to re-read the schemas from the Open Canada portal.
-foreach ($pdtype in $pdtypes)
-{
-  python .\manage.py import_ckan_schema  -t $pdtype
-}
+# Call the Django custom command to re-read all the schemas from the Open Canada portal at once.
+python .\manage.py import_ckan_schema --all
 date
\ No newline at end of file
@@ -161,3 +161,41 @@ SILENCED_SYSTEM_CHECKS = ["security.W019"]
 CKAN_RECOMBINANT_API_URL = 'https://open.canada.ca/data/en/recombinant-schema/{0}.json'
 DEFAULT_CSV_EXPORT_DIR = os.path.join(BASE_DIR, 'data')
 EXPORT_TO_CSV_BY_DEFAULT = False
+# Primary key / row digest snapshots used by compare_csv_files --engine local. Leave blank to disable.
+PD_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'data', 'snapshots')
+# Partitioned Parquet dataset of the activity rows written by compare_csv_files and export_pd_csv. Leave blank to disable.
+PD_PARQUET_DIR = ''
+# Number of bytes of each archive's members that compare_pd_archive --stream keeps in memory. The other members are read
+# from the archive again each time they are needed.
+PD_ARCHIVE_MEMORY_SIZE = 512 * 1024 * 1024
+
+# Cache used to keep PD file hashes between runs. A file based cache lets separate compare_csv_files processes share it.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'data', 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+PD_HASH_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+# Size of the SQLAlchemy connection pool shared by the threads of export_pd_csv --jobs
+PD_DB_POOL_SIZE = 5
+
+# Also log the per-phase timings of every comparison, export and schema import as JSON lines on the tracker.metrics logger
+PD_METRICS_JSON_LOG = False
+
+# How long, in seconds, the PD type schemas built from the PD Types Fields are kept in the cache. They are also
+# invalidated whenever import_ckan_schema or the admin changes the fields.
+PD_SCHEMA_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Directory where import_ckan_schema caches the recombinant schemas it fetches. Leave blank to disable. A cached schema
+# is used without checking the portal for PD_SCHEMA_CACHE_TTL seconds, and whenever the portal cannot be reached.
+PD_SCHEMA_CACHE_DIR = os.path.join(BASE_DIR, 'data', 'schemas')
+PD_SCHEMA_CACHE_TTL = 60 * 60
+
+# The Recombinant Types loaded by import_ckan_schema --all. Only set this to load a different list than the default
+# one in import_ckan_schema.
+# PD_TYPES = ["contracts", "grants"]
@@ -1,18 +1,23 @@
 from django.contrib import admin
-from .models import PDTableField, PDRunLog
+from .models import PDTableField, PDRunLog, PDExportLog, PDRunPhase
+from .schema import invalidate_schemas
 
 
 def set_pdexport_field(modeladmn, request, queryset):
     queryset.update(pd_export=True)
+    invalidate_schemas()
 
 def unset_pdexport_field(modeladmn, request, queryset):
     queryset.update(pd_export=False)
+    invalidate_schemas()
 
 def set_primary_key_field(modeladmn, request, queryset):
     queryset.update(primary_key=True)
+    invalidate_schemas()
 
 def unset_primary_key_field(modeladmn, request, queryset):
     queryset.update(primary_key=False)
+    invalidate_schemas()
 
 # Register your models here.
 @admin.register(PDTableField)
@@ -22,9 +27,45 @@ class PDTableFieldAdmin(admin.ModelAdmin):
     ordering = ['table_id', 'field_order']
     actions = [set_primary_key_field, unset_primary_key_field, set_pdexport_field, unset_pdexport_field]
 
+    # Fields edited or deleted one at a time also change the cached PD schemas
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_schemas()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_schemas()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        invalidate_schemas()
+
+class PDRunPhaseInline(admin.TabularInline):
+    model = PDRunPhase
+    fields = ['phase', 'started', 'seconds', 'rows', 'bytes_read', 'peak_rss_mb']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
 @admin.register(PDRunLog)
 class PDRunLogAdmin(admin.ModelAdmin):
 
     list_display = ['table_id', 'log_date', 'rows_added', 'rows_updated', 'rows_deleted']
     list_filter =['table_id', 'log_date']
-    ordering = ['log_date', 'table_id']
\ No newline at end of file
+    ordering = ['log_date', 'table_id']
+    inlines = [PDRunPhaseInline]
+
+@admin.register(PDRunPhase)
+class PDRunPhaseAdmin(admin.ModelAdmin):
+
+    list_display = ['command', 'table_id', 'phase', 'started', 'seconds', 'rows', 'bytes_read', 'peak_rss_mb']
+    list_filter = ['command', 'table_id', 'phase']
+    ordering = ['-started', 'table_id']
+
+@admin.register(PDExportLog)
+class PDExportLogAdmin(admin.ModelAdmin):
+
+    list_display = ['table_id', 'report_file', 'high_water_mark', 'export_date', 'rows_exported', 'full_export']
+    list_filter = ['table_id']
+    ordering = ['table_id', 'report_file']
@@ -0,0 +1,64 @@
+from django.conf import settings
+import io
+import os
+from sqlalchemy import create_engine
+
+_engine = None
+
+
+def get_engine():
+    '''
+    Return the SQLAlchemy engine for the PD Tracker PostgreSQL database. The engine and its connection pool are created
+    once per process and shared by every command that runs in it. Commands that run several jobs in threads need at
+    least one pooled connection per job; the pool size can be set with PD_DB_POOL_SIZE.
+    :return: SQLAlchemy engine
+    '''
+    global _engine
+    if _engine is None:
+        conn_string = f"postgresql+psycopg2://{str(settings.DATABASES['default']['USER'])}:{str(settings.DATABASES['default']['PASSWORD'])}@{str(settings.DATABASES['default']['HOST'])}/{str(settings.DATABASES['default']['NAME'])}"
+        _engine = create_engine(conn_string, pool_size=getattr(settings, 'PD_DB_POOL_SIZE', 5))
+    return _engine
+
+
+class LineSeparatorWriter(io.TextIOBase):
+    '''
+    Text file wrapper that ends CSV records with the given line separator instead of \n. Line breaks inside quoted
+    values are written as they are, as the csv module and pandas do.
+    '''
+
+    def __init__(self, handle, linesep):
+        '''
+        :param handle: Text file opened with newline=''
+        :param linesep: Line separator to end the records with
+        '''
+        super().__init__()
+        self.handle = handle
+        self.linesep = linesep
+        self.quoted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        # Every double quote opens or closes a quoted value; an escaped quote closes and reopens it
+        parts = data.split('"')
+        for i, part in enumerate(parts):
+            if i > 0:
+                self.quoted = not self.quoted
+            if not self.quoted:
+                parts[i] = part.replace('\n', self.linesep)
+        self.handle.write('"'.join(parts))
+        return len(data)
+
+
+def copy_to_csv(cursor, statement, handle):
+    '''
+    Run a COPY ... TO STDOUT WITH (FORMAT CSV) statement into a text file. PostgreSQL always ends the records with \n,
+    so they are ended with os.linesep instead, as pandas to_csv does, so both write the same files on every platform.
+    :param cursor: psycopg2 cursor
+    :param statement: COPY statement
+    :param handle: Text file opened with newline=''
+    :return: number of rows copied
+    '''
+    cursor.copy_expert(statement, handle if os.linesep == '\n' else LineSeparatorWriter(handle, os.linesep))
+    return cursor.rowcount
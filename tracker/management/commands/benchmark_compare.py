@@ -0,0 +1,287 @@
+import csv
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from sqlalchemy import text
+import pandas as pd
+import pyarrow as pa
+import tracker
+from tracker.db import get_engine
+from tracker.management.commands.compare_csv_files import compare_files
+from tracker.models import PDTableField, PDRunLog, PDRunPhase
+from tracker.schema import invalidate_schemas
+
+BENCHMARK_SOURCE_DATE = datetime(2000, 1, 1)
+BENCHMARK_LOG_DATE = datetime(2000, 1, 2)
+
+
+def synthetic_value(rng, field_type, row):
+    '''
+    Generate a random value for a PD field of the given CKAN datastore type
+    :param rng: random.Random instance
+    :param field_type: CKAN datastore type of the field
+    :param row: Row number, used to keep some values unique
+    :return: value as a string
+    '''
+    if field_type in ('int', 'year', 'month'):
+        return str(rng.randint(1, 12) if field_type == 'month' else rng.randint(1990, 2030) if field_type == 'year' else rng.randint(0, 10 ** 6))
+    if field_type in ('numeric', 'money'):
+        return f'{rng.uniform(0, 10 ** 6):.2f}'
+    if field_type == 'date':
+        return (BENCHMARK_SOURCE_DATE + timedelta(days=rng.randint(0, 9000))).strftime('%Y-%m-%d')
+    if field_type == 'timestamp':
+        return (BENCHMARK_SOURCE_DATE + timedelta(seconds=rng.randint(0, 9000 * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+    if field_type == 'boolean':
+        return rng.choice(['true', 'false'])
+    if rng.random() < 0.05:
+        return ''
+    words = ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(rng.randint(1, 6)))
+    return f'{words}\n{row}' if rng.random() < 0.01 else words
+
+
+def generate_pd_csv_pair(file_1, file_2, pd_fields, rows, key_width, add_ratio, delete_ratio, change_ratio, seed):
+    '''
+    Write a pair of synthetic PD CSV files for a PD type. The second file is the first one with a share of the rows
+    deleted, changed and added.
+    :param pd_fields: list of PDTableField objects of the PD type, in field order
+    :param rows: Number of rows in the first file
+    :param key_width: Number of characters of the first primary key field, which holds the unique row number
+    :param add_ratio: Share of rows added to the second file
+    :param delete_ratio: Share of rows deleted from the second file
+    :param change_ratio: Share of rows with a changed non-key field in the second file
+    :param seed: Random seed, so the same files can be generated again
+    :return: dictionary of the expected number of added, deleted and changed rows
+    '''
+    rng = random.Random(seed)
+    primary_key = [f.field_name for f in pd_fields if f.primary_key]
+    non_key_fields = [f for f in pd_fields if not f.primary_key]
+    if not primary_key:
+        raise CommandError('The PD type has no primary key fields')
+    columns = [f.field_name for f in pd_fields] + ['owner_org_title']
+    orgs = [f'org-{i}' for i in range(20)]
+
+    def make_row(n):
+        row = {}
+        for f in pd_fields:
+            if f.field_name == primary_key[0]:
+                row[f.field_name] = str(n).zfill(key_width)
+            elif f.primary_key:
+                row[f.field_name] = orgs[n % len(orgs)] if f.field_name == 'owner_org' else f'k{n % 7}'
+            else:
+                row[f.field_name] = synthetic_value(rng, f.field_type, n)
+        row['owner_org_title'] = f'Organization {row.get("owner_org", "")}'
+        return row
+
+    expected = {'A': 0, 'D': 0, 'C': 0}
+    with open(file_1, 'w', encoding='utf-8', newline='') as handle_1, open(file_2, 'w', encoding='utf-8', newline='') as handle_2:
+        writer_1 = csv.DictWriter(handle_1, fieldnames=columns)
+        writer_2 = csv.DictWriter(handle_2, fieldnames=columns)
+        writer_1.writeheader()
+        writer_2.writeheader()
+        for n in range(rows):
+            row = make_row(n)
+            writer_1.writerow(row)
+            draw = rng.random()
+            if draw < delete_ratio:
+                expected['D'] += 1
+                continue
+            if draw < delete_ratio + change_ratio and non_key_fields:
+                field = rng.choice(non_key_fields)
+                row = dict(row, **{field.field_name: row[field.field_name] + '*'})
+                expected['C'] += 1
+            writer_2.writerow(row)
+        for n in range(rows, rows + int(rows * add_ratio)):
+            writer_2.writerow(make_row(n))
+            expected['A'] += 1
+    return expected
+
+
+def run_measured(cmd, log_file, cwd):
+    '''
+    Run a command in a child process and measure its wall time and peak resident memory
+    :param cmd: list of the command arguments
+    :param log_file: File that receives the output of the command
+    :param cwd: Working directory of the command
+    :return: tuple of the exit code, the elapsed seconds and the peak RSS in MB (None where the platform cannot report it)
+    '''
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            proc.wait()
+            peak_rss_mb = None
+    return proc.returncode, time.perf_counter() - start, peak_rss_mb
+
+
+class Command(BaseCommand):
+    help = "Benchmark compare_csv_files on synthetic PD CSV files generated from the field schema of a PD type, and save " \
+           "the timings, throughput and peak memory as JSON. The comparisons are written to a separate pd_benchmark_ " \
+           "activity table which is removed afterwards."
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('-t', '--table', type=str, required=True,
+                            help='The Recombinant Type whose field schema is used to generate the CSV files')
+        parser.add_argument('-o', '--output', type=str, required=True, help='JSON file to write the results to')
+        parser.add_argument('-n', '--rows', type=int, nargs='+', default=[100000],
+                            help='Number of rows in the first file. Several sizes can be given.')
+        parser.add_argument('--key_width', type=int, default=10, help='Number of characters of the first primary key field')
+        parser.add_argument('--add_ratio', type=float, default=0.01, help='Share of rows added to the second file')
+        parser.add_argument('--delete_ratio', type=float, default=0.01, help='Share of rows deleted from the second file')
+        parser.add_argument('--change_ratio', type=float, default=0.05, help='Share of rows changed in the second file')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed for the generated files')
+        parser.add_argument('-e', '--engines', type=str, nargs='+', choices=['postgres', 'local'], default=['postgres', 'local'],
+                            help='The comparison engines to benchmark')
+        parser.add_argument('--loader', type=str, choices=['copy', 'to_sql'], default='copy',
+                            help='The staging table loader used by the postgres engine')
+        parser.add_argument('--csv_reader', type=str, choices=['pandas', 'arrow'], default='pandas',
+                            help='The CSV reader used by the comparisons')
+        parser.add_argument('--repeat', type=int, default=1, help='Number of times each comparison is run')
+        parser.add_argument('--temp_dir', type=str, default=None,
+                            help='Directory for the generated files, otherwise uses the system default')
+        parser.add_argument('--baseline', type=str, default=None,
+                            help='JSON results of an earlier benchmark to compare the timings against')
+
+    def setup_benchmark_type(self, table_name, bench_table):
+        '''
+        Copy the field schema of a PD type to the benchmark type, so the comparisons do not touch the real activity table
+        :return: list of the PDTableField objects of the benchmark type, in field order
+        '''
+        pd_fields = list(PDTableField.objects.filter(table_id=table_name).order_by('field_order'))
+        if not pd_fields:
+            raise CommandError(f'No fields found for table {table_name}')
+        PDTableField.objects.filter(table_id=bench_table).delete()
+        for f in pd_fields:
+            f.pk = None
+            f.table_id = bench_table
+        PDTableField.objects.bulk_create(pd_fields)
+        invalidate_schemas()
+        return pd_fields
+
+    def cleanup_benchmark_type(self, bench_table):
+        PDTableField.objects.filter(table_id=bench_table).delete()
+        invalidate_schemas()
+        PDRunLog.objects.filter(table_id=bench_table).delete()
+        PDRunPhase.objects.filter(table_id=bench_table).delete()
+        with get_engine().begin() as pgconn:
+            pgconn.execute(text(f'DROP TABLE IF EXISTS {bench_table} CASCADE'))
+
+    def run_compare(self, bench_table, file_1, file_2, engine, work_dir, options):
+        '''
+        Run one comparison of the generated files in a child process. The results are taken from the run log written by
+        that run, so a failed run never reports the counts and phases of an earlier one.
+        :return: dictionary of the measurements of the run, including the phases recorded by compare_csv_files
+        '''
+        project_dir = os.path.dirname(os.path.dirname(os.path.abspath(tracker.__file__)))
+        snapshot_dir = os.path.join(work_dir, f'snapshots_{engine}')
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        cmd = [sys.executable, os.path.join(project_dir, 'manage.py'), 'compare_csv_files', '-t', bench_table,
+               '-f1', file_1, '-f2', file_2,
+               '-s', BENCHMARK_SOURCE_DATE.strftime('%Y-%m-%d'), '-l', BENCHMARK_LOG_DATE.strftime('%Y-%m-%d'),
+               '--engine', engine, '--loader', options['loader'], '--csv_reader', options['csv_reader'],
+               '--snapshot_dir', snapshot_dir]
+        log_file = os.path.join(work_dir, f'compare_{engine}.log')
+        last_run_id = PDRunLog.objects.aggregate(last_run_id=Max('activity_id'))['last_run_id'] or 0
+        returncode, seconds, peak_rss_mb = run_measured(cmd, log_file, project_dir)
+        if returncode != 0:
+            raise CommandError(f'compare_csv_files failed with exit code {returncode}, see {log_file}')
+        run_log = PDRunLog.objects.filter(table_id=bench_table, activity_id__gt=last_run_id).order_by('-activity_id').first()
+        if run_log is None:
+            raise CommandError(f'compare_csv_files did not complete, see {log_file}')
+        return {
+            'seconds': round(seconds, 3),
+            'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+            'counts': {'A': run_log.rows_added, 'D': run_log.rows_deleted, 'C': run_log.rows_updated},
+            'compare_phases': {p.phase: {'seconds': round(p.seconds, 3), 'rows': p.rows, 'bytes_read': p.bytes_read,
+                                         'peak_rss_mb': round(p.peak_rss_mb, 1) if p.peak_rss_mb is not None else None}
+                               for p in run_log.phases.order_by('phase_id')},
+        }
+
+    def handle(self, *args, **options):
+        table_name = options['table'].replace('-', '_')
+        bench_table = f'pd_benchmark_{table_name}'
+        if options['repeat'] < 1 or min(options['rows']) < 1:
+            raise CommandError('The number of rows and repeats must be at least 1.')
+        if options['temp_dir'] and not os.path.isdir(options['temp_dir']):
+            raise CommandError(f"Cannot find temporary working directory '{options['temp_dir']}'")
+
+        results = {
+            'table': table_name,
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'platform': {'python': platform.python_version(), 'system': platform.platform(),
+                         'pandas': pd.__version__, 'pyarrow': pa.__version__},
+            'settings': {k: options[k] for k in ('key_width', 'add_ratio', 'delete_ratio', 'change_ratio', 'seed',
+                                                 'loader', 'csv_reader', 'repeat')},
+            'runs': [],
+        }
+        work_dir = tempfile.mkdtemp(prefix='pd_benchmark_', dir=options['temp_dir'])
+        try:
+            pd_fields = self.setup_benchmark_type(table_name, bench_table)
+            for rows in options['rows']:
+                file_1 = os.path.join(work_dir, f'{bench_table}_1.csv')
+                file_2 = os.path.join(work_dir, f'{bench_table}_2.csv')
+                start = time.perf_counter()
+                expected = generate_pd_csv_pair(file_1, file_2, pd_fields, rows, options['key_width'], options['add_ratio'],
+                                                options['delete_ratio'], options['change_ratio'], options['seed'])
+                generate_seconds = time.perf_counter() - start
+                size_mb = (os.path.getsize(file_1) + os.path.getsize(file_2)) / (1024 * 1024)
+                self.logger.info(f'Generated {rows} rows ({size_mb:.1f} MB) in {generate_seconds:.2f}s')
+
+                start = time.perf_counter()
+                compare_files(file_1, file_2)
+                hash_seconds = time.perf_counter() - start
+
+                for engine in options['engines']:
+                    for repeat in range(options['repeat']):
+                        run = self.run_compare(bench_table, file_1, file_2, engine, work_dir, options)
+                        run.update({
+                            'rows': rows,
+                            'engine': engine,
+                            'repeat': repeat,
+                            'size_mb': round(size_mb, 2),
+                            'expected': expected,
+                            'rows_per_second': round(rows / max(run['seconds'], 1e-6)),
+                            'phases': {'generate': round(generate_seconds, 3), 'hash': round(hash_seconds, 3),
+                                       'compare': run['seconds']},
+                        })
+                        if run['counts'] != expected:
+                            self.logger.warning(f'{engine} found {run["counts"]} but {expected} were generated')
+                        self.logger.info(f'{engine} on {rows} rows: {run["seconds"]:.2f}s, {run["rows_per_second"]} rows/s, '
+                                         f'peak RSS {run["peak_rss_mb"]} MB')
+                        results['runs'].append(run)
+        finally:
+            self.cleanup_benchmark_type(bench_table)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        with open(options['output'], 'w', encoding='utf-8') as handle:
+            json.dump(results, handle, indent=2)
+        self.logger.info(f'Wrote benchmark results to {options["output"]}')
+
+        # Compare the mean time of every configuration with the baseline results
+
+        if options['baseline']:
+            with open(options['baseline'], 'r', encoding='utf-8') as handle:
+                baseline = json.load(handle)
+            for rows in options['rows']:
+                for engine in options['engines']:
+                    current = [r['seconds'] for r in results['runs'] if r['rows'] == rows and r['engine'] == engine]
+                    previous = [r['seconds'] for r in baseline.get('runs', []) if r['rows'] == rows and r['engine'] == engine]
+                    if current and previous:
+                        change = (sum(current) / len(current)) / (sum(previous) / len(previous)) - 1
+                        self.logger.info(f'{engine} on {rows} rows: {change:+.1%} compared to {options["baseline"]}')
@@ -1,27 +1,78 @@
 from datetime import datetime, timezone
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.core.cache import cache
+import csv
 import hashlib
+import io
+import json
 import logging
-import os.path
+import os
+import shutil
+import time
 from pd_tracker.ColourFormatter import ColourFormatter
 import pytz
-from sqlalchemy import create_engine, text, TEXT
+from sqlalchemy import text, TEXT
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import IntegrityError
+import numpy as np
 import pandas as pd
-from tracker.models import PDTableField, PDRunLog
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from tracker.db import copy_to_csv, get_engine
+from tracker.metrics import PhaseRecorder
+from tracker.models import PDRunLog
+from tracker.parquet import ActivityDatasetWriter, load_field_types
+from tracker.profiling import add_profile_arguments, profile_base, profiled
+from tracker.schema import get_schema
 
 # Inspired by an article by Costas Andreau from https://towardsdatascience.com/how-to-compare-large-files-f58982eccd3a
 
 
+def open_pd_file(source):
+    '''
+    Open a PD CSV file for reading in binary mode
+    :param source: File name, or an archive member object with an open() method that is read without extracting it to disk
+    :return: Binary file object
+    '''
+    if isinstance(source, str):
+        return open(source, 'rb')
+    return source.open()
+
+
+def pd_file_size(source):
+    '''
+    Return the size in bytes of a PD CSV file
+    :param source: File name or archive member object
+    :return: File size in bytes
+    '''
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return source.size
+
+
+def pd_file_signature(source):
+    '''
+    Return the values that identify a particular version of a PD CSV file without reading it
+    :param source: File name or archive member object
+    :return: tuple of the file path, size in bytes and modification time
+    '''
+    if isinstance(source, str):
+        stat = os.stat(source)
+        return os.path.abspath(source), stat.st_size, stat.st_mtime_ns
+    return str(source), source.size, source.mtime
+
+
 def md5_hash(file_name):
     '''
     Return a simple file hash
-    :param file_name: File name to hash
+    :param file_name: File name or archive member to hash
     :return: MD5 hash of the file
     '''
     block_size = 65536
     md5_hasher = hashlib.md5()
-    with open(file_name, 'rb') as handle:
+    with open_pd_file(file_name) as handle:
         buf = handle.read(block_size)
         while len(buf) > 0:
             md5_hasher.update(buf)
@@ -31,15 +82,37 @@ def md5_hash(file_name):
     return hash_value
 
 
+def cached_md5_hash(file_name):
+    '''
+    Return the MD5 hash of a file, reusing the hash calculated by an earlier run if the file has not changed since.
+    Hashes are kept in the Django cache keyed by the file path, size and modification time, so the file that was the
+    second file of one comparison is not hashed again when it becomes the first file of the next.
+    :param file_name: File name or archive member to hash
+    :return: MD5 hash of the file
+    '''
+    signature = "|".join(str(v) for v in pd_file_signature(file_name))
+    cache_key = f'pd_tracker:md5:{hashlib.md5(signature.encode("utf-8")).hexdigest()}'
+    hash_value = cache.get(cache_key)
+    if hash_value is None:
+        hash_value = md5_hash(file_name)
+        cache.set(cache_key, hash_value, timeout=getattr(settings, 'PD_HASH_CACHE_TIMEOUT', 60 * 60 * 24 * 7))
+    else:
+        logging.info(f'MD5 hash of {file_name} is {hash_value} (cached)')
+    return hash_value
+
+
 def compare_files(file_1, file_2):
     '''
-    Compare two text files by their MD5 hash
+    Compare two text files by their size and MD5 hash
     :param file_1: First file
     :param file_2: Second File
     :return: True if the files are identical, otherwise return false
     '''
 
-    if md5_hash(file_1) == md5_hash(file_2):
+    if pd_file_size(file_1) != pd_file_size(file_2):
+        logging.info(f'{file_1} and {file_2} are different sizes. Proceeding to detailed checks.')
+        return False
+    if cached_md5_hash(file_1) == cached_md5_hash(file_2):
         logging.info(f'Files {file_1} and {file_2} are identical and will not be compared.')
         return True
     else:
@@ -47,20 +120,408 @@ def compare_files(file_1, file_2):
         return False
 
 
-def make_field_list(l1, alias='x'):
+def load_table_fields(table_name):
     '''
-    Simple sql statement helper to add a table alias to a list of field names
-    :param l1: list of field names
-    :param alias: a table alias Ex tablex.field_name
-    :return: list of field names with table alias
+    Look up the primary key and non-key fields of a PD type from its cached schema
+    :param table_name: PD type
+    :return: tuple of the primary key field names, the non-key field names and all the field names, in field order
     '''
-    csv_list = ""
-    for i, item in enumerate(l1):
-        if i == 0:
-            csv_list = f'{alias}.{item}'
-        else:
-            csv_list += f', {alias}.{item}'
-    return csv_list
+    schema = get_schema(table_name)
+    if schema is None or not schema.primary_key:
+        raise CommandError(f'No primary key found for table {table_name}')
+    return list(schema.primary_key), list(schema.non_key_fields), list(schema.field_names)
+
+
+def copy_csv_to_table(pgconn, file_name, table, chunk_size=50000, csv_reader='pandas'):
+    '''
+    Bulk load a PD CSV file into a staging table using PostgreSQL COPY FROM STDIN. The file is still parsed by pandas
+    or Arrow so that column names are normalized and bad lines are skipped exactly as with the to_sql loader.
+    :param pgconn: SQLAlchemy connection to the PostgreSQL database
+    :param file_name: CSV file name or archive member to load
+    :param table: Name of the staging table, already created with create_staging_table()
+    :param chunk_size: Number of rows sent per COPY statement
+    :param csv_reader: 'pandas' or 'arrow'
+    :return: Number of rows loaded
+    '''
+    rows = 0
+    cursor = pgconn.connection.cursor()
+    try:
+        if csv_reader == 'arrow':
+            columns = read_pd_csv_header(file_name)
+            quoted_columns = [f'"{c}"' for c in columns]
+            for batch in read_pd_csv_batches(file_name, columns):
+                buffer = io.BytesIO()
+                pv.write_csv(batch, buffer, write_options=pv.WriteOptions(include_header=False))
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY "{table}" ({", ".join(quoted_columns)}) FROM STDIN WITH (FORMAT CSV)', buffer)
+                rows += batch.num_rows
+            return rows
+        with open_pd_file(file_name) as handle:
+            for chunk in pd.read_csv(handle, chunksize=chunk_size, delimiter=",", dtype=str, header=0, on_bad_lines="skip"):
+                chunk.columns = chunk.columns.str.replace(' ', '_')
+                quoted_columns = [f'"{c}"' for c in chunk.columns]
+                buffer = io.StringIO()
+                chunk.to_csv(buffer, index=False, header=False)
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY "{table}" ({", ".join(quoted_columns)}) FROM STDIN WITH (FORMAT CSV)', buffer)
+                rows += len(chunk.index)
+    finally:
+        cursor.close()
+    return rows
+
+
+def read_pd_csv_header(file_name):
+    '''
+    Read the column names of a PD CSV file, normalized the same way as when the file is loaded
+    :param file_name: CSV file name or archive member to read
+    :return: list of column names
+    '''
+    with open_pd_file(file_name) as handle:
+        df = pd.read_csv(handle, delimiter=",", dtype=str, header=0, nrows=0)
+    return list(df.columns.str.replace(' ', '_'))
+
+
+def skip_long_rows(row):
+    '''
+    Arrow CSV invalid row handler that skips rows with too many fields and fails on rows with missing fields
+    :param row: pyarrow.csv.InvalidRow
+    :return: 'skip' or 'error'
+    '''
+    return 'skip' if row.actual_columns > row.expected_columns else 'error'
+
+
+def read_pd_csv_batches(file_name, columns=None, block_size=16 * 1024 * 1024):
+    '''
+    Read a PD CSV file as Arrow record batches with the multithreaded Arrow CSV reader. Column names are normalized,
+    every column is read as a string, empty values are null and rows with too many fields are skipped, as with the
+    pandas reader. pandas pads rows with missing fields with empty values, which Arrow cannot do, so such a row raises
+    pyarrow.ArrowInvalid and the file has to be read with the pandas reader instead.
+    :param file_name: CSV file name or archive member to read
+    :param columns: list of the normalized column names, if already known
+    :param block_size: Number of bytes of CSV parsed per batch
+    :return: generator of Arrow record batches
+    '''
+    if columns is None:
+        columns = read_pd_csv_header(file_name)
+    with open_pd_file(file_name) as handle:
+        reader = pv.open_csv(handle,
+                             read_options=pv.ReadOptions(block_size=block_size, column_names=columns, skip_rows=1),
+                             parse_options=pv.ParseOptions(newlines_in_values=True, invalid_row_handler=skip_long_rows),
+                             convert_options=pv.ConvertOptions(column_types={c: pa.string() for c in columns}, strings_can_be_null=True))
+        for batch in reader:
+            yield batch
+
+
+def staging_columns(csv_columns, field_names):
+    '''
+    Order the columns of a staging table: the PD type's fields that are in the CSV file come first in field order,
+    followed by any other CSV columns such as owner_org_title
+    :param csv_columns: list of the columns in the CSV file
+    :param field_names: list of the PD type's field names in field order
+    :return: list of column names
+    '''
+    return [f for f in field_names if f in csv_columns] + [c for c in csv_columns if c not in field_names]
+
+
+def read_pd_csv(file_name, csv_reader='pandas'):
+    '''
+    Read a complete PD CSV file into a DataFrame, using the same parsing rules as the staging table loaders
+    :param file_name: CSV file name or archive member to read
+    :param csv_reader: 'pandas' or 'arrow'
+    :return: DataFrame with every column read as a string
+    '''
+    if csv_reader == 'arrow':
+        columns = read_pd_csv_header(file_name)
+        schema = pa.schema([pa.field(c, pa.string()) for c in columns])
+        return pa.Table.from_batches(read_pd_csv_batches(file_name, columns), schema=schema).to_pandas()
+    with open_pd_file(file_name) as handle:
+        df = pd.read_csv(handle, delimiter=",", dtype=str, header=0, on_bad_lines="skip")
+    df.columns = df.columns.str.replace(' ', '_')
+    return df
+
+
+def row_digests(df, fields):
+    '''
+    Calculate a 64-bit digest for each row of a DataFrame based on a subset of its columns
+    :param df: DataFrame to hash
+    :param fields: list of the field names to include in the digest
+    :return: Series of uint64 row digests aligned with the DataFrame index
+    '''
+    if len(fields) == 0:
+        return pd.Series(0, index=df.index, dtype='uint64')
+    return pd.util.hash_pandas_object(df[fields], index=False)
+
+
+def key_digests(df, primary_key, fields):
+    '''
+    Build the primary key, row digest and per-field digests of every row of a PD file, as kept in its snapshot. Each
+    non-key field is hashed separately, into a _f_<field> column, so the fields of a changed row that differ can be
+    found without the old row values. The row digest is built from the field digests.
+    :param df: DataFrame of the PD file
+    :param primary_key: list of the primary key field names
+    :param fields: list of the non-key fields to hash
+    :return: DataFrame with the primary key columns, a _digest column and a _f_<field> column for each field
+    '''
+    digests = pd.DataFrame({f'_f_{f}': pd.util.hash_pandas_object(df[f], index=False) for f in fields}, index=df.index)
+    return df[primary_key].assign(_digest=row_digests(digests, list(digests.columns)), **{c: digests[c] for c in digests.columns})
+
+
+def digest_changed_fields(matched, std_fields):
+    '''
+    Work out which non-key fields changed for each matched pair of rows from their per-field digests
+    :param matched: DataFrame of matched rows with the _f_<field>_x and _f_<field>_y digests of both files
+    :param std_fields: list of the non-key fields, in field order
+    :return: list of the lists of changed field names
+    '''
+    differs = pd.DataFrame({f: matched[f'_f_{f}_x'].to_numpy() != matched[f'_f_{f}_y'].to_numpy() for f in std_fields})
+    return [[f for f, d in zip(std_fields, row_differs) if d] or None for row_differs in differs.itertuples(index=False)]
+
+
+def sql_changed_fields(std_fields):
+    '''
+    Build the SQL expression listing the non-key fields that differ between the x and y rows, in field order. An
+    ARRAY[] constructor is not limited to 100 arguments like a function call, so no chunking is needed.
+    :param std_fields: list of the non-key fields
+    :return: SQL expression for a TEXT[] array of field names, or NULL if no field changed
+    '''
+    if not std_fields:
+        return 'CAST(NULL AS TEXT[])'
+    parts = [f"CASE WHEN x.{f} IS DISTINCT FROM y.{f} THEN '{f}' END" for f in std_fields]
+    return f"NULLIF(array_remove(CAST(ARRAY[{', '.join(parts)}] AS TEXT[]), NULL), '{{}}')"
+
+
+def sql_changed_values(std_fields, chunk_size=45):
+    '''
+    Build the SQL expression holding the old and new values of the non-key fields that differ between the x and y rows
+    :param std_fields: list of the non-key fields
+    :param chunk_size: Maximum number of fields per jsonb_build_object() call
+    :return: SQL expression for a JSON object of field name to [old value, new value]
+    '''
+    if not std_fields:
+        return 'CAST(NULL AS TEXT)'
+    objects = []
+    for i in range(0, len(std_fields), chunk_size):
+        pairs = ", ".join(f"'{f}', CASE WHEN x.{f} IS DISTINCT FROM y.{f} THEN jsonb_build_array(x.{f}, y.{f}) END" for f in std_fields[i:i + chunk_size])
+        objects.append(f'jsonb_build_object({pairs})')
+    return f"CAST(jsonb_strip_nulls({' || '.join(objects)}) AS TEXT)"
+
+
+def changed_field_columns(old_values, new_values, std_fields, with_values):
+    '''
+    Work out which non-key fields changed for each pair of old and new rows. As in the SQL comparison, which uses
+    IS DISTINCT FROM, a change to or from an empty value is counted as a change.
+    :param old_values: DataFrame of the old non-key values
+    :param new_values: DataFrame of the new non-key values, aligned with old_values
+    :param std_fields: list of the non-key fields, in field order
+    :param with_values: Also return the old and new values of the changed fields
+    :return: tuple of a list of the lists of changed field names and, if requested, a list of JSON objects of field
+    name to [old value, new value]
+    '''
+    differs = ~((old_values[std_fields] == new_values[std_fields]) | (old_values[std_fields].isna() & new_values[std_fields].isna()))
+    changed_fields = [[f for f, d in zip(std_fields, row_differs) if d] or None for row_differs in differs.itertuples(index=False)]
+    if not with_values:
+        return changed_fields, None
+    changed_values = []
+    for old_row, new_row, row_differs in zip(old_values[std_fields].itertuples(index=False), new_values[std_fields].itertuples(index=False),
+                                             differs.itertuples(index=False)):
+        changed_values.append(json.dumps({f: [None if pd.isna(o) else o, None if pd.isna(n) else n]
+                                          for f, o, n, d in zip(std_fields, old_row, new_row, row_differs) if d}))
+    return changed_fields, changed_values
+
+
+def snapshot_path(snapshot_dir, table_name, snapshot_date):
+    '''
+    Build the file name of the digest snapshot for a PD type on a given date
+    :param snapshot_dir: Directory where snapshots are kept
+    :param table_name: PD type
+    :param snapshot_date: Date of the CSV file the snapshot was built from
+    :return: Path of the Parquet snapshot file
+    '''
+    return os.path.join(snapshot_dir, f'{table_name}_{snapshot_date.strftime("%Y_%m_%d")}.parquet')
+
+
+def write_digest_snapshot(file_name, key_digests, columns, std_fields):
+    '''
+    Save the primary key, row digest and per-field digests of every row in a PD CSV file as a Parquet snapshot. The
+    CSV columns and the fields used to build the digest are kept in the file metadata so that incompatible snapshots
+    are not reused.
+    :param file_name: Parquet file to write
+    :param key_digests: DataFrame with the primary key columns, a _digest column and the _f_<field> digests
+    :param columns: list of the columns in the CSV file
+    :param std_fields: list of the non-key fields included in the digest
+    '''
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+    # The snapshot may be a hard link to the snapshot of an earlier day, which must not be overwritten with it
+
+    if os.path.exists(file_name):
+        os.remove(file_name)
+    table = pa.Table.from_pandas(key_digests, preserve_index=False)
+    metadata = {b'pd_tracker': json.dumps({'columns': columns, 'std_fields': std_fields}).encode('utf-8')}
+    pq.write_table(table.replace_schema_metadata(metadata), file_name)
+
+
+def carry_forward_snapshot(snapshot_dir, table_name, source_date, log_date):
+    '''
+    Reuse the digest snapshot of the first file for the second file when the two files are identical, so the next
+    day's comparison can still skip parsing its first file. The snapshot is hard-linked, or copied if the file system
+    does not support hard links.
+    :param snapshot_dir: Directory where snapshots are kept
+    :param table_name: PD type
+    :param source_date: Date of the first file
+    :param log_date: Date of the second file
+    :return: True if a snapshot was carried forward, False if the first file has no snapshot
+    '''
+    source = snapshot_path(snapshot_dir, table_name, source_date)
+    target = snapshot_path(snapshot_dir, table_name, log_date)
+    if not os.path.exists(source) or source == target:
+        return False
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+    return True
+
+
+def read_digest_snapshot(file_name, columns, std_fields):
+    '''
+    Read a Parquet digest snapshot if it exists and was built from the same columns and digest fields. Snapshots
+    written before per-field digests were kept are not used.
+    :param file_name: Parquet file to read
+    :param columns: list of the columns expected in the CSV file
+    :param std_fields: list of the non-key fields expected in the digest
+    :return: DataFrame with the primary key columns, a _digest column and the _f_<field> digests, or None if no
+    usable snapshot exists
+    '''
+    if not os.path.exists(file_name):
+        return None
+    table = pq.read_table(file_name)
+    metadata = json.loads((table.schema.metadata or {}).get(b'pd_tracker', b'{}'))
+    if set(metadata.get('columns', [])) != set(columns) or metadata.get('std_fields') != std_fields:
+        logging.info(f'Snapshot {file_name} does not match the current columns and will not be used.')
+        return None
+    if any(f'_f_{f}' not in table.column_names for f in std_fields):
+        logging.info(f'Snapshot {file_name} has no field digests and will not be used.')
+        return None
+    return table.to_pandas()
+
+
+def start_report_file(report_file, columns):
+    '''
+    Check whether activity rows with the given columns can be appended to a report file. A report written with other
+    columns, such as one started before changed_fields was added, is renamed with a timestamp suffix so a new report is
+    started instead of mixing rows of different widths under one header.
+    :param report_file: CSV report file
+    :param columns: list of the columns of the rows to be written
+    :return: True if the header needs to be written, False if the rows are appended to an existing report
+    '''
+    if not os.path.exists(report_file):
+        return True
+    with open(report_file, 'r', encoding='utf-8', newline='') as handle:
+        header = next(csv.reader(handle), None)
+    if header is None:
+        return True
+    if header == columns:
+        return False
+    base, ext = os.path.splitext(report_file)
+    old_report = f'{base}_{datetime.now().strftime("%Y%m%d%H%M%S")}{ext}'
+    os.replace(report_file, old_report)
+    logging.warning(f'The columns of {report_file} do not match the activity columns. It was renamed to {old_report} and a new report was started.')
+    return True
+
+
+def flatten_changed_fields(df):
+    '''
+    Format the changed_fields arrays of a batch of activity rows as comma separated lists for the report file and the
+    Parquet dataset
+    :param df: DataFrame of activity rows
+    :return: DataFrame with a text changed_fields column
+    '''
+    if 'changed_fields' not in df.columns:
+        return df
+    return df.assign(changed_fields=df['changed_fields'].map(
+        lambda v: ','.join(v) if isinstance(v, (list, tuple, np.ndarray)) else v))
+
+
+# Activity table columns that are not stored as TEXT. changed_fields is an array so that the rows where a given
+# field changed can be found through its GIN index, e.g. WHERE changed_fields @> ARRAY['amount'].
+
+ACTIVITY_COLUMN_TYPES = {'log_date': 'DATE', 'log_activity': 'CHAR(1)', 'changed_fields': 'TEXT[]'}
+
+
+def activity_table_kind(pgconn, table_name):
+    '''
+    Check whether an activity table exists and whether it is partitioned
+    :param table_name: PD type
+    :return: 'p' for a partitioned table, 'r' for a plain table created before partitioning, or None if it does not exist
+    '''
+    statement = f'''SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE n.nspname = 'public' AND c.relname = '{table_name}' AND c.relkind IN ('r', 'p')'''
+    r = pgconn.execute(text(statement)).fetchone()
+    return r[0] if r else None
+
+
+def create_activity_table(pgconn, table_name, columns, primary_key):
+    '''
+    Create an activity table range-partitioned by month on log_date, with an index on the primary key fields so the
+    history of a record can be looked up without a full scan, and a GIN index on changed_fields. Partitions are added
+    with create_activity_partition() and inherit both indexes.
+    :param table_name: PD type
+    :param columns: list of the columns of the activity table, including log_date and log_activity
+    :param primary_key: list of the primary key field names
+    '''
+    column_defs = ", ".join(f'{c} {ACTIVITY_COLUMN_TYPES.get(c, "TEXT")}' for c in columns)
+    pgconn.execute(text(f'CREATE TABLE {table_name} ({column_defs}) PARTITION BY RANGE (log_date)'))
+    index_columns = [k for k in primary_key if k in columns] + ['log_date']
+    pgconn.execute(text(f'CREATE INDEX {table_name}_key_idx ON {table_name} ({", ".join(index_columns)})'))
+    if 'changed_fields' in columns:
+        create_changed_fields_index(pgconn, table_name)
+
+
+def create_changed_fields_index(pgconn, table_name):
+    '''
+    Create the GIN index on the changed_fields array of an activity table, if it does not exist yet
+    :param table_name: PD type
+    '''
+    pgconn.execute(text(f'CREATE INDEX IF NOT EXISTS {table_name}_changed_fields_idx ON {table_name} USING GIN (changed_fields)'))
+
+
+def create_activity_partition(pgconn, table_name, log_date):
+    '''
+    Create the monthly partition of an activity table that holds the given log date, if it does not exist yet
+    :param table_name: PD type
+    :param log_date: Date of the activity rows to be stored
+    '''
+    start = log_date.replace(day=1)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    pgconn.execute(text(f'''CREATE TABLE IF NOT EXISTS {table_name}_p{start.strftime("%Y_%m")} PARTITION OF {table_name}
+                            FOR VALUES FROM ('{start.strftime("%Y-%m-%d")}') TO ('{end.strftime("%Y-%m-%d")}')'''))
+
+
+def to_sql_csv_to_table(pgconn, file_name, table, chunk_size=1000, csv_reader='pandas'):
+    '''
+    Load a PD CSV file into a staging table using pandas to_sql, one INSERT batch per chunk
+    :param pgconn: SQLAlchemy connection to the PostgreSQL database
+    :param file_name: CSV file name or archive member to load
+    :param table: Name of the staging table already created with create_staging_table()
+    :param chunk_size: Number of rows per chunk
+    :param csv_reader: 'pandas' or 'arrow'
+    :return: Number of rows loaded
+    '''
+    rows = 0
+    if csv_reader == 'arrow':
+        for batch in read_pd_csv_batches(file_name):
+            batch.to_pandas().to_sql(name=table, con=pgconn, if_exists='append', index=False, chunksize=chunk_size)
+            rows += batch.num_rows
+        return rows
+    with open_pd_file(file_name) as handle:
+        for chunk in pd.read_csv(handle, chunksize=chunk_size, delimiter=",", dtype=str, header=0, on_bad_lines="skip"):
+            chunk.columns = chunk.columns.str.replace(' ', '_')  # replacing spaces with underscores for column names
+            chunk.to_sql(name=table, con=pgconn, if_exists='append', index=False)
+            rows += len(chunk.index)
+    return rows
 
 
 class Command(BaseCommand):
@@ -92,221 +553,558 @@ class Command(BaseCommand):
                             required=False, default=False)
         parser.add_argument('-u', '--vacuum', action='store_true', help='Vacuum the SQLite database after the comparison is complete. Don\'t vacuum if you are running this command from a batch job.',
                             required=False, default=False)
+        parser.add_argument('-e', '--engine', type=str, choices=['postgres', 'local'], default='postgres',
+                            help='Where the comparison is run: in PostgreSQL staging tables (default) or locally in a single '
+                                 'in-process pass. The local engine only sends the final delta rows to PostgreSQL.',
+                            required=False)
+        parser.add_argument('--snapshot_dir', type=str, default=getattr(settings, 'PD_SNAPSHOT_DIR', ''),
+                            help='Directory for the primary key and row digest snapshots used by the local engine. When a '
+                                 'snapshot of the first file exists, only the second file is parsed.', required=False)
+        parser.add_argument('--csv_reader', type=str, choices=['pandas', 'arrow'], default='pandas',
+                            help='How the CSV files are parsed: with pandas (default) or with the multithreaded Arrow CSV reader, '
+                                 'which hands Arrow record batches to the loader.', required=False)
+        parser.add_argument('--parquet_dir', type=str, default=getattr(settings, 'PD_PARQUET_DIR', ''),
+                            help='Also write the activity rows to a Parquet dataset in this directory, partitioned as '
+                                 'table=<type>/log_date=<YYYY-MM-DD> and typed from the PD field types.', required=False)
+        parser.add_argument('--change_values', action='store_true', default=False,
+                            help='Also record the old and new values of the changed fields of every changed row, as JSON in '
+                                 'the changed_values column of the activity table.', required=False)
+        parser.add_argument('--insert_select', action='store_true', default=False,
+                            help='Write the delta rows into the activity table on the server with INSERT ... SELECT instead of '
+                                 'fetching them first. Only used by the postgres engine.', required=False)
+        parser.add_argument('--batch_size', type=int, default=10000,
+                            help='The number of delta rows fetched from the server-side cursor and written at a time.', required=False)
+        parser.add_argument('--loader', type=str, choices=['copy', 'to_sql'], default='copy',
+                            help='How the CSV files are loaded into the staging tables: PostgreSQL COPY (default) or pandas to_sql.',
+                            required=False)
+        add_profile_arguments(parser)
 
-    def handle(self, *args, **options):
+    def report_path(self, table_name, options):
+        '''
+        Get the report file of a comparison. If none is given, one is generated from the table name in the default
+        export directory when EXPORT_TO_CSV_BY_DEFAULT is set.
+        :return: report file name, or an empty string if no report file is written
+        '''
+        report_file = options['report_file'] if options['report_file'] else ""
+        if not report_file and settings.EXPORT_TO_CSV_BY_DEFAULT:
+            report_file = os.path.join(settings.DEFAULT_CSV_EXPORT_DIR, f'{table_name}_activity.csv')
+        return report_file
 
-        table_name = options['table'].replace('-', '_')
+    def profile_path(self, table_name, options):
+        '''
+        Get the path, without extension, of the profile files of a comparison, next to its report file
+        :return: path of the profile files, or None if profiling is not enabled
+        '''
+        return profile_base(options, os.path.dirname(self.report_path(table_name, options)),
+                            f'{table_name}_{options["log_date"].strftime("%Y-%m-%d")}_compare')
+
+    def load_csv(self, pgconn, file_name, table, loader, csv_reader='pandas'):
+        '''
+        Load a CSV file into a staging table and report the load throughput
+        :param pgconn: SQLAlchemy connection to the PostgreSQL database
+        :param file_name: CSV file name or archive member to load
+        :param table: Name of the staging table
+        :param loader: 'copy' or 'to_sql'
+        :param csv_reader: 'pandas' or 'arrow'
+        :return: Number of rows loaded
+        '''
+        self.logger.info(f'Reading {file_name} into {table} using {loader} and the {csv_reader} CSV reader')
+        start = time.perf_counter()
+        load = copy_csv_to_table if loader == 'copy' else to_sql_csv_to_table
+        try:
+            rows = load(pgconn, file_name, table, csv_reader=csv_reader)
+        except pa.ArrowInvalid as e:
+            self.logger.warning(f'Reloading {file_name} with the pandas CSV reader: {e}')
+            pgconn.execute(text(f'TRUNCATE "{table}"'))
+            rows = load(pgconn, file_name, table, csv_reader='pandas')
+        elapsed = max(time.perf_counter() - start, 1e-6)
+        size_mb = pd_file_size(file_name) / (1024 * 1024)
+        self.logger.info(f'Loaded {rows} rows ({size_mb:.1f} MB) into {table} in {elapsed:.2f}s: '
+                         f'{rows / elapsed:.0f} rows/s, {size_mb / elapsed:.1f} MB/s')
+        return rows
+
+    def read_csv(self, file_name, csv_reader='pandas'):
+        '''
+        Read a complete PD CSV file into a DataFrame, falling back to the pandas reader for files with rows that the
+        Arrow reader cannot parse
+        :param file_name: CSV file name or archive member to read
+        :param csv_reader: 'pandas' or 'arrow'
+        :return: DataFrame with every column read as a string
+        '''
+        try:
+            return read_pd_csv(file_name, csv_reader)
+        except pa.ArrowInvalid as e:
+            self.logger.warning(f'Reading {file_name} with the pandas CSV reader: {e}')
+            return read_pd_csv(file_name, 'pandas')
+
+    def load_staging(self, pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, options):
+        '''
+        Load both CSV files into PostgreSQL staging tables and build a single FULL OUTER JOIN query that finds the
+        deleted, added and changed rows
+        :return: tuple of the list of data columns and the comparison query, which takes a :log_date parameter
+        '''
         csv_files = [options['first_file'], options['second_file']]
 
-        # Use file hashing to determine if the files are the same before comparing them.
-        if compare_files(options['first_file'], options['second_file']):
-            exit(0)
-
-        # Look up the primary key for the table from the PD database
-        pkeys = PDTableField.objects.filter(table_id=table_name, primary_key=True).order_by('field_order')
-        if pkeys.count() == 0:
-            raise CommandError(f'No primary key found for table {table_name}')
-        primary_key = []
-        for pkey in pkeys:
-            primary_key.append(pkey.field_name)
-
-        # Look up the key and non-key fields for the table
-        pd_fields = PDTableField.objects.filter(table_id=table_name).order_by('field_order')
-        field_names = []
-        non_key_fields = []
-        for pd_field in pd_fields:
-            field_names.append(pd_field.field_name)
-            if not pd_field.primary_key:
-                non_key_fields.append(pd_field.field_name)
-
-        # Connect to the Postgresql database and generate the temporary table names
+        # Clear out the temp files if they exist
 
-        temp_tables = ["{0}_{1}".format(table_name, options["source_date"].strftime('%Y_%m_%d')).replace('-', '_'),
-                       "{0}_{1}".format(table_name, options["log_date"].strftime('%Y_%m_%d')).replace('-', '_')]
-        conn_string = f"postgresql+psycopg2://{str(settings.DATABASES['default']['USER'])}:{str(settings.DATABASES['default']['PASSWORD'])}@{str(settings.DATABASES['default']['HOST'])}/{str(settings.DATABASES['default']['NAME'])}"
-        eng = create_engine(conn_string)
-        with eng.begin() as pgconn:
+        for table in temp_tables:
+            pgconn.execute(text(f'DROP TABLE IF EXISTS {table}'))
+
+        # Create the temporary tables as UNLOGGED tables, since they are dropped as soon as the comparison is done, and
+        # read the CSV files into them. Indexes are only built once the tables are loaded.
+
+        for i, file in enumerate(csv_files):
+            with self.recorder.phase(['load_first_file', 'load_second_file'][i], bytes_read=pd_file_size(file)) as phase:
+                self.create_staging_table(pgconn, temp_tables[i], staging_columns(read_pd_csv_header(file), field_names))
+                phase['rows'] += self.load_csv(pgconn, file, temp_tables[i], options['loader'], options['csv_reader'])
+
+        # Verify that the columns in both tables match
+
+        temp_columns = []
+        column_names = []
+        for i, t in enumerate(temp_tables):
+            results = pgconn.execute(text(f"select column_name from information_schema.columns where table_name = '{t}' order by ordinal_position"))
+            column_names = []
+            for row in results:
+                column_names.append(row[0])
+            temp_columns.append(column_names)
+
+        # Bail if the columns don't match - this condition voids the comparison
+
+        if set(temp_columns[0]) != set(temp_columns[1]):
+            raise Exception(f"The columns in the {t} table do not match the columns in the {table_name} definition.")
+
+        # create a list of non-primary key fields that actually in the file. This is based on the fields that were read
+        # in from the file. The PD database should hold the latest definition, but older CSV files may not have fewer columns
+
+        std_fields = []
+        for f in non_key_fields:
+            if f in column_names:
+                std_fields.append(f)
+
+        # create indexes to accelerate queries
+
+        self.logger.info(f'Creating indexes for {temp_tables[0]} and {temp_tables[1]}')
+        with self.recorder.phase('index'):
+            for table in temp_tables:
+                self.index_staging_table(pgconn, table, primary_key)
+
+        # Normally you would not build queries using strings, but the key values are coming from the config database
+
+        joinstatement = " AND ".join(f'x.{key} = y.{key}' for key in primary_key)
+
+        # Log some information about the two CSV files
+
+        self.logger.info('Total CSV Row Counts')
+        statement_counts = f"SELECT 'one', COUNT(*) FROM {temp_tables[0]} UNION SELECT 'two', COUNT(*) FROM {temp_tables[1]}"
+        results = pgconn.execute(text(statement_counts))
+        i = 0
+
+        # Note: loop indexing will not compatible with older versions of Python 3
+        for row in results:
+            self.logger.info(f'{temp_tables[i]}: {row[1]}')
+            i += 1
+
+        # Build a single comparison query that tags every deleted, added and changed row. Deleted rows come from
+        # the first table and added or changed rows from the second one.
+
+        if "owner_org_title" in column_names:
+            column_names.remove("owner_org_title")
+        deleted_condition = " AND ".join(f'y.{key} IS NULL' for key in primary_key)
+        added_condition = " AND ".join(f'x.{key} IS NULL' for key in primary_key)
+        change_query = " OR ".join(f'(x.{field} IS DISTINCT FROM y.{field})' for field in std_fields) if std_fields else 'FALSE'
+        select_fields = ", ".join(f'CASE WHEN {deleted_condition} THEN x.{c} ELSE y.{c} END AS {c}' for c in column_names)
+        change_columns = f'CASE WHEN ({deleted_condition}) OR ({added_condition}) THEN NULL ELSE {sql_changed_fields(std_fields)} END AS changed_fields'
+        if options['change_values']:
+            change_columns += f', CASE WHEN ({deleted_condition}) OR ({added_condition}) THEN NULL ELSE {sql_changed_values(std_fields)} END AS changed_values'
+        else:
+            change_columns += ', CAST(NULL AS TEXT) AS changed_values'
+        statement = f'''SELECT {select_fields}, CAST(:log_date AS DATE) AS log_date,
+                              CASE WHEN {deleted_condition} THEN 'D' WHEN {added_condition} THEN 'A' ELSE 'C' END AS log_activity,
+                              {change_columns}
+                       FROM "{temp_tables[0]}" x FULL OUTER JOIN "{temp_tables[1]}" y ON {joinstatement}
+                       WHERE ({deleted_condition}) OR ({added_condition}) OR ({change_query})'''
+        return column_names, statement
+
+    def create_staging_table(self, pgconn, table, columns):
+        '''
+        Create an empty UNLOGGED staging table. Staging tables are dropped minutes after they are loaded, so there is
+        no need to write them to the WAL.
+        :param table: Name of the staging table
+        :param columns: list of the column names, in order
+        '''
+        column_defs = ", ".join(f'"{c}" TEXT' for c in columns)
+        pgconn.execute(text(f'CREATE UNLOGGED TABLE "{table}" ({column_defs})'))
+
+    def index_staging_table(self, pgconn, table, primary_key):
+        '''
+        Build the primary key index of a loaded staging table and update its planner statistics. The index is unique
+        unless the CSV file has duplicate keys, in which case a regular index is used so the comparison can still run.
+        '''
+        pgconn.execute(text(f'DROP INDEX IF EXISTS pk_index_{table}'))
+        try:
+            with pgconn.begin_nested():
+                pgconn.execute(text(f'CREATE UNIQUE INDEX pk_index_{table} on {table} USING btree ({", ".join(primary_key)})'))
+        except IntegrityError:
+            self.logger.warning(f'Duplicate primary keys found in {table}. Creating a non-unique index.')
+            pgconn.execute(text(f'CREATE INDEX pk_index_{table} on {table} USING btree ({", ".join(primary_key)})'))
+        pgconn.execute(text(f'ANALYZE {table}'))
+
+    def drop_staging(self, pgconn, temp_tables):
+        '''
+        Drop the staging tables used by the PostgreSQL comparison
+        '''
+        for table in temp_tables:
+            pgconn.execute(text(f'DROP TABLE IF EXISTS {table} CASCADE'))
+
+    def diff_postgres(self, pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, options):
+        '''
+        Load both CSV files into PostgreSQL staging tables and use a single FULL OUTER JOIN to find the deleted, added
+        and changed rows
+        :return: generator of DataFrames with the delta rows, tagged with their log date and activity code
+        '''
+        try:
+            column_names, statement = self.load_staging(pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, options)
+
+            # Stream the results through a server-side cursor so only one batch is held in memory at a time. Only the
+            # time spent running the query and fetching the batches counts towards the diff phase.
+
+            self.logger.info('Checking for new, deleted and changed rows based on data key.')
+            with self.recorder.phase('diff'):
+                result = pgconn.execute(text(statement), {'log_date': options['log_date'].strftime('%Y-%m-%d')},
+                                        execution_options={'stream_results': True})
+                columns = list(result.keys())
+                partitions = result.partitions(options['batch_size'])
+            while True:
+                with self.recorder.phase('diff') as phase:
+                    rows = next(partitions, None)
+                    if rows is not None:
+                        phase['rows'] += len(rows)
+                if rows is None:
+                    break
+                yield pd.DataFrame(rows, columns=columns)
+
+        finally:
+            self.drop_staging(pgconn, temp_tables)
+
+    def insert_activity(self, pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, report_file, options):
+        '''
+        Compare the CSV files in PostgreSQL staging tables and write the deleted, added and changed rows straight into
+        the activity table with INSERT ... SELECT, so the delta rows never leave the server. The report file, if one is
+        being written, is then produced with a single COPY ... TO STDOUT.
+        :return: dictionary of the number of rows written for each activity code
+        '''
+        log_date_str = options['log_date'].strftime('%Y-%m-%d')
+        try:
+            column_names, statement = self.load_staging(pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, options)
+            self.delete_activity(pgconn, table_name, options['log_date'])
+            activity_columns = column_names + ['log_date', 'log_activity', 'changed_fields', 'changed_values']
+            self.prepare_activity_table(pgconn, table_name, activity_columns, primary_key, options['log_date'])
+
+            self.logger.info('Inserting new, deleted and changed rows based on data key.')
+            statement_insert = f'''WITH inserted AS (INSERT INTO {table_name} ({", ".join(activity_columns)}) {statement}
+                                                     RETURNING log_activity)
+                                   SELECT log_activity, COUNT(*) FROM inserted GROUP BY log_activity'''
+            counts = {'A': 0, 'D': 0, 'C': 0}
+            with self.recorder.phase('insert_select') as phase:
+                for row in pgconn.execute(text(statement_insert), {'log_date': log_date_str}):
+                    counts[row[0]] = row[1]
+                phase['rows'] += sum(counts.values())
+        finally:
+            self.drop_staging(pgconn, temp_tables)
+
+        if report_file and sum(counts.values()) > 0:
+            first_time = start_report_file(report_file, activity_columns)
+            select_fields = ", ".join("array_to_string(changed_fields, ',') AS changed_fields" if c == 'changed_fields' else c
+                                      for c in activity_columns)
+            statement_copy = f'''COPY (SELECT {select_fields} FROM {table_name} WHERE log_date = '{log_date_str}')
+                                 TO STDOUT WITH (FORMAT CSV{", HEADER" if first_time else ""})'''
+            cursor = pgconn.connection.cursor()
             try:
-                # Clear out the temp files if they exist
+                with self.recorder.phase('report') as phase, open(report_file, 'a', encoding='utf-8', newline='') as handle:
+                    phase['rows'] += copy_to_csv(cursor, statement_copy, handle)
+            finally:
+                cursor.close()
+        return counts
 
-                for table in temp_tables:
-                    pgconn.execute(text(f'DROP TABLE IF EXISTS {table}'))
+    def diff_local(self, table_name, primary_key, non_key_fields, options):
+        '''
+        Find the deleted, added and changed rows in a single in-process pass. Rows are matched on the primary key and
+        compared using a 64-bit digest of their non-key fields, so no staging tables are needed in PostgreSQL. The
+        changed fields are found from a digest of each field.
+        If a digest snapshot of the first file exists, only the second file is read. The first file is then only read
+        when there are deleted rows to report, or when the old values of changed rows are recorded.
+        :return: list of DataFrames with the deleted, added and changed rows, tagged with their log date and activity code
+        '''
+        self.logger.info(f'Reading {options["second_file"]}')
+        with self.recorder.phase('read_second_file', bytes_read=pd_file_size(options['second_file'])) as phase:
+            new_df = self.read_csv(options['second_file'], options['csv_reader'])
+            phase['rows'] += len(new_df.index)
+        missing_keys = [k for k in primary_key if k not in new_df.columns]
+        if missing_keys:
+            raise Exception(f"The primary key fields {missing_keys} for {table_name} are missing from the CSV files.")
 
-                # Read the CSV files into the temporary tables
+        column_names = [c for c in new_df.columns if c != "owner_org_title"]
+        std_fields = [f for f in non_key_fields if f in column_names]
 
-                chunk_size = 1000
-                i = 0
-                for file in csv_files:
-                    self.logger.info(f'Reading {csv_files[i]} into {temp_tables[i]}')
-                    i = i + 1
-                    for chunk in pd.read_csv(file, chunksize=chunk_size, delimiter=",", dtype=str, header=0, on_bad_lines="skip"):
-                        chunk.columns = chunk.columns.str.replace(' ', '_')  # replacing spaces with underscores for column names
-                        chunk.to_sql(name=temp_tables[i - 1], con=pgconn, if_exists='append', index=False)
+        # Use the snapshot of the first file when it was built from the same columns, otherwise read the first file
 
-                # Verify that the columns in both tables match
+        old_df = None
+        old_keys = None
+        snapshot_dir = options['snapshot_dir']
+        if snapshot_dir:
+            with self.recorder.phase('read_snapshot'):
+                old_keys = read_digest_snapshot(snapshot_path(snapshot_dir, table_name, options['source_date']),
+                                                list(new_df.columns), std_fields)
+        if old_keys is None:
+            self.logger.info(f'Reading {options["first_file"]}')
+            with self.recorder.phase('read_first_file', bytes_read=pd_file_size(options['first_file'])) as phase:
+                old_df = self.read_csv(options['first_file'], options['csv_reader'])
+                phase['rows'] += len(old_df.index)
 
-                temp_columns = []
-                column_names = []
-                for i, t in enumerate(temp_tables):
-                    results = pgconn.execute(text(f"select column_name from information_schema.columns where table_name = '{t}'"))
-                    column_names = []
-                    for row in results:
-                        column_names.append(row[0])
-                    temp_columns.append(column_names)
+            # Bail if the columns don't match - this condition voids the comparison
 
-                # Bail if the columns don't match - this condition voids the comparison
+            if set(old_df.columns) != set(new_df.columns):
+                raise Exception(f"The columns in {options['first_file']} do not match the columns in {options['second_file']}.")
+            old_keys = key_digests(old_df, primary_key, std_fields)
+        else:
+            self.logger.info(f'Using the digest snapshot for {table_name} on {options["source_date"].strftime("%Y-%m-%d")}')
 
-                if set(temp_columns[0]) != set(temp_columns[1]):
-                    raise Exception(f"The columns in the {t} table do not match the columns in the {table_name} definition.")
+        self.logger.info(f'Total CSV Row Counts: {options["first_file"]}: {len(old_keys.index)}, {options["second_file"]}: {len(new_df.index)}')
 
-                # create a list of non-primary key fields that actually in the file. This is based on the fields that were read
-                # in from the file. The PD database should hold the latest definition, but older CSV files may not have fewer columns
+        with self.recorder.phase('diff') as phase:
+            # Match the rows on their key and classify them in one pass using the row digests
 
-                std_fields = []
-                for f in non_key_fields:
-                    if f in column_names:
-                        std_fields.append(f)
+            new_keys = key_digests(new_df, primary_key, std_fields).assign(_row=range(len(new_df.index)))
+            matched = old_keys.merge(new_keys, on=primary_key, how='outer', suffixes=('_x', '_y'), indicator=True)
 
-                # create indexes to accelerate queries
+            deleted = matched['_merge'] == 'left_only'
+            added = matched['_merge'] == 'right_only'
+            changed = (matched['_merge'] == 'both') & (matched['_digest_x'] != matched['_digest_y'])
+            phase['rows'] += len(matched.index)
 
-                self.logger.info(f'Creating indexes for {temp_tables[0]} and {temp_tables[1]}')
-                pgconn.execute(text(f'DROP INDEX IF EXISTS pk_index_{temp_tables[0]}'))
-                pgconn.execute(text(f'DROP INDEX IF EXISTS pk_index_{temp_tables[1]}'))
-                pgconn.execute(text(f'CREATE INDEX pk_index_{temp_tables[0]} on {temp_tables[0]} ({", ".join(primary_key)})'))
-                pgconn.execute(text(f'CREATE INDEX pk_index_{temp_tables[1]} on {temp_tables[1]} ({", ".join(primary_key)})'))
+        # Deleted rows and the old values of changed rows only exist in the first file, so fetch them from it
 
-                # Normally you would not build queries using strings, but the key values are coming from the config database
+        if old_df is None and (deleted.any() or (changed.any() and options['change_values'])):
+            self.logger.info(f'Reading {options["first_file"]} for deleted and changed rows')
+            with self.recorder.phase('read_first_file', bytes_read=pd_file_size(options['first_file'])) as phase:
+                old_df = self.read_csv(options['first_file'], options['csv_reader'])
+                phase['rows'] += len(old_df.index)
+        with self.recorder.phase('diff'):
+            if deleted.any():
+                df1 = old_df.merge(matched.loc[deleted, primary_key], on=primary_key, how='inner')[column_names]
+            else:
+                df1 = pd.DataFrame(columns=column_names)
+            df2 = new_df.iloc[matched.loc[added, '_row'].astype('int64')][column_names].reset_index(drop=True)
+            if changed.any():
+                changed_rows = matched.loc[changed].drop_duplicates(subset='_row').reset_index(drop=True)
+                df3 = new_df.iloc[changed_rows['_row'].astype('int64')][column_names].reset_index(drop=True)
+                changed_fields, changed_values = digest_changed_fields(changed_rows, std_fields), None
+                if options['change_values']:
+                    pairs = changed_rows[primary_key].merge(old_df[primary_key + std_fields].drop_duplicates(subset=primary_key),
+                                                            on=primary_key, how='left')
+                    changed_fields, changed_values = changed_field_columns(pairs, df3, std_fields, True)
+            else:
+                df3 = pd.DataFrame(columns=column_names)
+                changed_fields, changed_values = [], []
 
-                for key in primary_key:
-                    if key == primary_key[0]:
-                        joinstatement = f'x.{key} = y.{key}'
-                        wherestatement = f' WHERE y.{key} IS NULL'
-                        wherenotstatement = f' WHERE y.{key} IS NOT NULL'
-                    else:
-                        joinstatement += f' AND x.{key} = y.{key}'
-                        wherestatement += f' AND y.{key} IS NULL'
-                        wherenotstatement += f' AND y.{key} IS NOT NULL'
-
-                # Log some information about the two CSV files
-
-                self.logger.info('Total CSV Row Counts')
-                statement_counts = f"SELECT 'one', COUNT(*) FROM {temp_tables[0]} UNION SELECT 'two', COUNT(*) FROM {temp_tables[1]}"
-                results = pgconn.execute(text(statement_counts))
-                i = 0
-
-                # Note: loop indexing will not compatible with older versions of Python 3
-                for row in results:
-                    self.logger.info(f'{temp_tables[i]}: {row[1]}')
-                    i += 1
-                self.logger.info('Checking got new and deleted rows based on data Key.')
-
-                # Build the comparison query
-
-                if "owner_org_title" in column_names:
-                    column_names.remove("owner_org_title")
-                t1 = ",".join(list(map(lambda s: 'x.' + s, column_names)))
-                t2 = ",".join(list(map(lambda s: 'x.' + s, column_names)))
-                statement1 = f'SELECT {t1} FROM "{temp_tables[0]}" x LEFT JOIN "{temp_tables[1]}" y ON {joinstatement} {wherestatement}'
-                statement2 = f'SELECT {t2} FROM "{temp_tables[1]}" x LEFT JOIN "{temp_tables[0]}" y ON  {joinstatement} {wherestatement}'
-
-                # Delete any rows associated with the log date being processed - these will be replaced. First check to see if the table exists
-
-                statement_ruthere = f"SELECT EXISTS(SELECT FROM pg_tables WHERE schemaname = 'public' and tablename = '{table_name}')"
-                results = pgconn.execute(text(statement_ruthere))
-                r = results.fetchone()
-                if r[0]:
-                    self.logger.info(f'Deleting rows from {table_name} based on {options["log_date"]}')
-                    log_date_str = options["log_date"].strftime("%Y-%m-%d")
-                    statement_delete = f"DELETE FROM {table_name} WHERE log_date = '{log_date_str}'"
-                    pgconn.execute(text(statement_delete))
-
-                # Running row matching queries to determine additions and deletions
-
-                primary_key.append('log_date')
-                df1 = pd.read_sql(statement1, pgconn)
-                df2 = pd.read_sql(statement2, pgconn)
-                df1['log_date'] = options['log_date'].strftime('%Y-%m-%d')
-                df1['log_activity'] = 'D'
-                df1.set_index(primary_key)
-
-                df2['log_date'] = options['log_date'].strftime('%Y-%m-%d')
-                df2['log_activity'] = 'A'
-                df2.set_index(primary_key)
-
-                # if the export file name is not provided, then generate one using the table name abd the default export directory
-
-                report_file = options['report_file'] if options['report_file'] else ""
-                if not report_file and settings.EXPORT_TO_CSV_BY_DEFAULT:
-                    report_file = os.path.join(settings.DEFAULT_CSV_EXPORT_DIR, f'{table_name}_activity.csv')
-
-                # Report on additions and deletions
-
-                first_time = False if os.path.exists(report_file) else True
-                if len(df1.index) > 0:
-                    if report_file:
-                        df1.to_csv(report_file, mode='a', index=False, header=first_time)
-                    df1.to_sql(table_name, con=pgconn, if_exists='append', dtype=TEXT, index=False)
+        if snapshot_dir:
+            with self.recorder.phase('write_snapshot'):
+                write_digest_snapshot(snapshot_path(snapshot_dir, table_name, options['log_date']),
+                                      new_keys.drop(columns='_row'), list(new_df.columns), std_fields)
+        log_date_str = options['log_date'].strftime('%Y-%m-%d')
+        deltas = []
+        for df, activity in [(df1, 'D'), (df2, 'A'), (df3, 'C')]:
+            deltas.append(df.assign(log_date=log_date_str, log_activity=activity,
+                                    changed_fields=changed_fields if activity == 'C' else None,
+                                    changed_values=changed_values if activity == 'C' else None))
+        return deltas
+
+    def delete_activity(self, pgconn, table_name, log_date):
+        '''
+        Delete any rows associated with the log date being processed from the activity table - these will be replaced
+        '''
+
+        # First check to see if the table exists
+
+        statement_ruthere = f"SELECT EXISTS(SELECT FROM pg_tables WHERE schemaname = 'public' and tablename = '{table_name}')"
+        results = pgconn.execute(text(statement_ruthere))
+        r = results.fetchone()
+        log_date_str = log_date.strftime("%Y-%m-%d")
+        if r[0]:
+            self.logger.info(f'Deleting rows from {table_name} based on {log_date}')
+            statement_delete = f"DELETE FROM {table_name} WHERE log_date = '{log_date_str}'"
+            pgconn.execute(text(statement_delete))
+
+    def prepare_activity_table(self, pgconn, table_name, columns, primary_key, log_date):
+        '''
+        Create the activity table if it does not exist yet, add any columns it is missing, such as changed_fields
+        on a table created before changes were tracked per field, convert a comma separated changed_fields column to
+        an indexed array, and make sure the partition for the log date exists
+        :param columns: list of the columns that will be written to the table
+        :param primary_key: list of the primary key field names
+        :param log_date: Date of the activity rows that will be written
+        '''
+        table_kind = activity_table_kind(pgconn, table_name)
+        if table_kind is None:
+            self.logger.info(f'Creating activity table {table_name}')
+            create_activity_table(pgconn, table_name, columns, primary_key)
+            table_kind = 'p'
+        else:
+            results = pgconn.execute(text(f"select column_name, data_type from information_schema.columns where table_schema = 'public' and table_name = '{table_name}'"))
+            existing_columns = {row[0]: row[1] for row in results}
+            for c in columns:
+                if c not in existing_columns:
+                    pgconn.execute(text(f'ALTER TABLE {table_name} ADD COLUMN {c} {ACTIVITY_COLUMN_TYPES.get(c, "TEXT")}'))
+            if existing_columns.get('changed_fields') == 'text':
+                self.logger.info(f'Converting the changed_fields column of {table_name} to an array')
+                pgconn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN changed_fields TYPE TEXT[] USING string_to_array(changed_fields, ',')"))
+            if 'changed_fields' in columns:
+                create_changed_fields_index(pgconn, table_name)
+        if table_kind == 'p':
+            create_activity_partition(pgconn, table_name, log_date)
+        else:
+            self.logger.warning(f'Activity table {table_name} is not partitioned. Run partition_activity_tables to convert it.')
 
-                first_time = False if os.path.exists(report_file) else True
-                if len(df2.index) > 0:
+    def write_activity(self, pgconn, table_name, primary_key, report_file, log_date, batches, parquet_writer=None):
+        '''
+        Replace the activity rows for the log date with the deleted, added and changed rows, and append them to the
+        report file and the Parquet dataset if they are being written. Each batch is written as soon as it is received.
+        Every batch has the same columns, with changed_values left empty unless it was requested, so the report keeps
+        a fixed set of columns.
+        :param batches: iterable of DataFrames tagged with their log date and activity code
+        :param parquet_writer: ActivityDatasetWriter for the PD type, or None
+        :return: dictionary of the number of rows written for each activity code
+        '''
+        with self.recorder.phase('write'):
+            self.delete_activity(pgconn, table_name, log_date)
+        counts = {'A': 0, 'D': 0, 'C': 0}
+        prepared = False
+        first_time = None
+        for df in batches:
+            if len(df.index) > 0:
+                with self.recorder.phase('write') as phase:
+                    if not prepared:
+                        self.prepare_activity_table(pgconn, table_name, list(df.columns), primary_key, log_date)
+                        prepared = True
+                    report_df = flatten_changed_fields(df)
                     if report_file:
-                        df2.to_csv(report_file, mode='a', index=False, header=first_time)
-                    df2.to_sql(table_name, con=pgconn, if_exists='append', dtype=TEXT, index=False)
+                        first_time = start_report_file(report_file, list(df.columns)) if first_time is None else False
+                        report_df.to_csv(report_file, mode='a', index=False, header=first_time)
+                    df.to_sql(table_name, con=pgconn, if_exists='append', index=False,
+                              dtype={c: ARRAY(TEXT) if c == 'changed_fields' else TEXT for c in df.columns})
+                    if parquet_writer:
+                        parquet_writer.write(report_df)
+                    phase['rows'] += len(df.index)
+                for activity, count in df['log_activity'].value_counts().items():
+                    counts[activity] += int(count)
+        return counts
 
-                # Running row matching query to determine what rows have changed
+    def compare(self, eng, table_name, primary_key, non_key_fields, field_names, options, recorder=None):
+        '''
+        Compare the two PD CSV files in the options and record the deleted, added and changed rows, and the time and
+        resources used by each phase of the comparison
+        :param eng: SQLAlchemy engine for the PD database
+        :param table_name: PD type
+        :param primary_key: list of the primary key field names
+        :param non_key_fields: list of the non-key field names
+        :param field_names: list of all the field names in field order
+        :param options: command options
+        :param recorder: PhaseRecorder that already holds the earlier phases of the run, such as hashing, or None
+        :return: True if the comparison completed or the files are identical, otherwise False
+        '''
+        self.recorder = recorder if recorder else PhaseRecorder('compare_csv_files', table_name)
 
-                change_query = ""
-                for field in std_fields:
-                    change_query += f"(x.{field} <> y.{field}) OR "
-                change_fields = make_field_list(column_names, 'y')
-                statement3 = f'''SELECT {change_fields} FROM {temp_tables[0]} x
-                                        JOIN {temp_tables[1]} y ON {joinstatement} {wherenotstatement}
-                                        AND ({change_query[:-4]})'''
+        # if the export file name is not provided, then generate one using the table name abd the default export directory
 
-                self.logger.info('Checking for changed rows based on data key.')
+        report_file = self.report_path(table_name, options)
 
-                df3 = pd.read_sql(statement3, pgconn,)
+        # Generate the temporary table names
 
-                df3['log_date'] = options['log_date'].strftime('%Y-%m-%d')
-                df3['log_activity'] = 'C'
-                df3.set_index(primary_key)
+        temp_tables = ["{0}_{1}".format(table_name, options["source_date"].strftime('%Y_%m_%d')).replace('-', '_'),
+                       "{0}_{1}".format(table_name, options["log_date"].strftime('%Y_%m_%d')).replace('-', '_')]
+        completed = False
+        run_log = None
+        parquet_writer = None
+        if options['parquet_dir']:
+            parquet_writer = ActivityDatasetWriter(options['parquet_dir'], table_name, load_field_types(table_name))
+            parquet_writer.clear_partition(options['log_date'].strftime('%Y-%m-%d'))
+        with eng.begin() as pgconn:
+            try:
+                if options['engine'] == 'postgres' and options['insert_select']:
+                    counts = self.insert_activity(pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, report_file, options)
+                    if parquet_writer and sum(counts.values()) > 0:
+                        statement_select = f'SELECT * FROM {table_name} WHERE log_date = :log_date'
+                        with self.recorder.phase('parquet') as phase:
+                            for df in pd.read_sql(text(statement_select), pgconn, params={'log_date': options['log_date'].strftime('%Y-%m-%d')},
+                                                  chunksize=options['batch_size']):
+                                parquet_writer.write(flatten_changed_fields(df))
+                                phase['rows'] += len(df.index)
+                else:
+                    if options['engine'] == 'local':
+                        batches = self.diff_local(table_name, primary_key, non_key_fields, options)
+                    else:
+                        batches = self.diff_postgres(pgconn, table_name, temp_tables, primary_key, non_key_fields, field_names, options)
 
-                # Report on changes
+                    # Report on additions, deletions and changes
 
-                first_time = False if os.path.exists(report_file) else True
-                if len(df3.index) > 0:
-                    if report_file:
-                        df3.to_csv(report_file, mode='a', index=False, header=first_time)
-                    df3.to_sql(table_name, con=pgconn, if_exists='append', dtype=TEXT, index=False)
+                    try:
+                        counts = self.write_activity(pgconn, table_name, primary_key, report_file, options['log_date'], batches, parquet_writer)
+                    finally:
+                        if hasattr(batches, 'close'):
+                            batches.close()
 
                 # Log the PD tracker run to the intenal database
 
                 local_tz = pytz.timezone(settings.TIME_ZONE)
                 local_now = local_tz.localize(datetime.now())
-                PDRunLog.objects.create(
+                run_log = PDRunLog.objects.create(
                     table_id=table_name,
-                    file_from=options['first_file'],
-                    file_to=options['second_file'],
+                    file_from=str(options['first_file']),
+                    file_to=str(options['second_file']),
                     activity_date=local_now,
                     log_date=local_tz.localize(options['log_date']),
                     report_file=report_file,
-                    rows_added=len(df2.index),
-                    rows_deleted=len(df1.index),
-                    rows_updated=len(df3.index),
+                    rows_added=counts['A'],
+                    rows_deleted=counts['D'],
+                    rows_updated=counts['C'],
                 )
-                self.logger.info(f'{table_name} completed: {len(df2.index)} rows added, {len(df1.index)} rows deleted, {len(df3.index)} rows updated')
+                self.logger.info(f'{table_name} completed: {counts["A"]} rows added, {counts["D"]} rows deleted, {counts["C"]} rows updated')
+                completed = True
 
             except Exception as e:
                 self.logger.critical(f'Error processing table {table_name}')
                 self.logger.error(e)
+                if parquet_writer:
+                    parquet_writer.clear_partition(options['log_date'].strftime('%Y-%m-%d'))
 
             finally:
-                for table in temp_tables:
-                    pgconn.execute(text(f'DROP TABLE IF EXISTS {table} CASCADE'))
+                if parquet_writer:
+                    parquet_writer.close()
                 pgconn.commit()
                 if options['vacuum']:
                     pgconn.executetext(('VACUUM'))
-                pgconn.close()
+        self.recorder.save(run_log)
+        return completed
+
+    def handle(self, *args, **options):
+
+        table_name = options['table'].replace('-', '_')
+        with profiled(self.profile_path(table_name, options), options['profile_top'], options['profile_memory']):
 
+            # Use file hashing to determine if the files are the same before comparing them.
+            recorder = PhaseRecorder('compare_csv_files', table_name)
+            with recorder.phase('hash'):
+                identical = compare_files(options['first_file'], options['second_file'])
+            if identical:
+                if options['snapshot_dir']:
+                    with recorder.phase('write_snapshot'):
+                        carry_forward_snapshot(options['snapshot_dir'], table_name, options['source_date'], options['log_date'])
+                recorder.save()
+                return
 
+            # Look up the primary key and the non-key fields for the table from the PD database
+            primary_key, non_key_fields, field_names = load_table_fields(table_name)
 
+            if not self.compare(get_engine(), table_name, primary_key, non_key_fields, field_names, options, recorder):
+                raise CommandError(f'The comparison of {table_name} failed')
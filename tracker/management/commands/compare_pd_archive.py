@@ -0,0 +1,289 @@
+from datetime import datetime
+import io
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import gzip
+import logging
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+from tracker.db import get_engine
+from tracker.metrics import PhaseRecorder
+from tracker.management.commands.compare_csv_files import Command as CompareCommand, carry_forward_snapshot, compare_files
+from tracker.pipeline import prefetched
+from tracker.profiling import add_profile_arguments, profile_base, profiled
+from tracker.schema import get_all_schemas
+
+
+def load_all_table_fields():
+    '''
+    Get the primary key and non-key fields of every PD type from the cached schemas
+    :return: dictionary of PD type to a tuple of the primary key field names, the non-key field names and all the
+    field names, in field order
+    '''
+    return {t: (schema.primary_key, schema.non_key_fields, schema.field_names) for t, schema in get_all_schemas().items()}
+
+
+class ArchiveMemberReader(io.RawIOBase):
+    '''
+    Read the data of a single member from a gzip compressed archive, seeking to its offset instead of extracting it
+    '''
+
+    def __init__(self, archive_path, offset, size):
+        '''
+        :param archive_path: Path of the .tar.gz archive
+        :param offset: Offset of the member data in the uncompressed tar stream
+        :param size: Size of the member data in bytes
+        '''
+        super().__init__()
+        self._file = gzip.open(archive_path, 'rb')
+        self._file.seek(offset)
+        self._remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)[:self._remaining]
+        count = self._file.readinto(view) if len(view) else 0
+        self._remaining -= count
+        return count
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class ArchiveMember:
+    '''
+    A PD CSV file that is read from a daily archive instead of being extracted with the rest of the archive. Members
+    that fit in the archive's memory budget are decompressed once, when the archive is opened, which is done ahead of
+    time by the prefetch thread, and are kept in memory until release() is called, so hashing and parsing the file, and
+    comparing it again as the first file of the next day, never decompress it twice. The other members are read
+    straight from the archive each time they are opened, so nothing is written to disk.
+    '''
+
+    def __init__(self, archive_path, member, data=None):
+        '''
+        :param archive_path: Path of the archive
+        :param member: TarInfo of the member
+        :param data: Decompressed contents of the member, if it is kept in memory
+        '''
+        self.archive_path = archive_path
+        self.archive_name = os.path.basename(archive_path)
+        self.name = member.name
+        self.size = member.size
+        self.mtime = member.mtime
+        self.offset = member.offset_data
+        self.in_memory = data is not None
+        self._data = data
+
+    def open(self):
+        if not self.in_memory:
+            return io.BufferedReader(ArchiveMemberReader(self.archive_path, self.offset, self.size), 1024 * 1024)
+        if self._data is None:
+            raise ValueError(f'{self} has already been released')
+        return io.BytesIO(self._data)
+
+    def release(self):
+        self._data = None
+
+    def __str__(self):
+        return f'{self.archive_name}/{self.name}'
+
+
+class Command(BaseCommand):
+    help = "Compare every PD CSV file in a series of daily pd-YYYYMMDD.tar.gz archives inside a single process. The " \
+           "database engine and the PD field metadata are set up once for the whole batch instead of once per file."
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--data_dir', type=str, required=True,
+                            help='The directory where to find the daily archive files. There must be at least 2 archive files to run the analysis.')
+        parser.add_argument('-t', '--temp_dir', type=str, required=False, default=None,
+                            help='Specify a temporary working directory, otherwise uses the system default')
+        parser.add_argument('-1', '--latest_only', action='store_true', required=False, default=False,
+                            help='Only compare the last two archive files. This option cannot be selected when either a start or end data is specified.')
+        parser.add_argument('--start_date', type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=False,
+                            help='The date to start the warehouse processing from. Format: YYYY-MM-DD')
+        parser.add_argument('--end_date', type=lambda s: datetime.strptime(s, '%Y-%m-%d'), required=False,
+                            help='The date to stop on. Format: YYYY-MM-DD')
+        parser.add_argument('--stream', action='store_true', required=False, default=False,
+                            help='Read the CSV files directly from the archives instead of extracting them to a temporary directory.')
+        parser.add_argument('-p', '--prefetch', type=int, required=False, default=0,
+                            help='The number of archive files to extract, or decompress when streaming, in the background while the current day is being compared.')
+        parser.add_argument('-e', '--engine', type=str, choices=['postgres', 'local'], default='postgres',
+                            help='Where the comparisons are run: in PostgreSQL staging tables (default) or locally in a single in-process pass.')
+        parser.add_argument('--snapshot_dir', type=str, default=getattr(settings, 'PD_SNAPSHOT_DIR', ''),
+                            help='Directory for the primary key and row digest snapshots used by the local engine.')
+        parser.add_argument('--parquet_dir', type=str, default=getattr(settings, 'PD_PARQUET_DIR', ''),
+                            help='Also write the activity rows to a partitioned Parquet dataset in this directory.')
+        parser.add_argument('--change_values', action='store_true', default=False,
+                            help='Also record the old and new values of the changed fields of every changed row.')
+        parser.add_argument('--insert_select', action='store_true', default=False,
+                            help='Write the delta rows into the activity tables on the server with INSERT ... SELECT. Only used by the postgres engine.')
+        parser.add_argument('--batch_size', type=int, default=10000,
+                            help='The number of delta rows fetched from the server-side cursor and written at a time.')
+        parser.add_argument('--csv_reader', type=str, choices=['pandas', 'arrow'], default='pandas',
+                            help='How the CSV files are parsed: with pandas (default) or with the multithreaded Arrow CSV reader.')
+        parser.add_argument('--loader', type=str, choices=['copy', 'to_sql'], default='copy',
+                            help='How the CSV files are loaded into the staging tables: PostgreSQL COPY (default) or pandas to_sql.')
+        add_profile_arguments(parser)
+
+    def archive_list(self, options):
+        '''
+        Get the sorted list of archive files to process based on the user provided parameters
+        :return: list of archive file names
+        '''
+        sorted_file_list = sorted(x for x in os.listdir(options['data_dir']) if x.endswith('.tar.gz'))
+        if len(sorted_file_list) < 2:
+            raise CommandError('Not enough files in data directory.')
+        if options['latest_only'] and (options['start_date'] or options['end_date']):
+            raise CommandError('Cannot use both --latest_only and --start_date or --end_date.')
+        if options['latest_only']:
+            return sorted_file_list[-2:]
+        if options['start_date']:
+            sorted_file_list = [x for x in sorted_file_list if options['start_date'] <= datetime.strptime(x[3:11], '%Y%m%d')]
+        if options['end_date']:
+            sorted_file_list = [x for x in sorted_file_list if options['end_date'] >= datetime.strptime(x[3:11], '%Y%m%d')]
+        return sorted_file_list
+
+    def open_archive(self, tar_file, options):
+        '''
+        Make the CSV files of a daily archive available for comparison, either by extracting them to a new temporary
+        directory or, when streaming, as ArchiveMember objects. Members are kept in memory in archive order for as long
+        as they fit in PD_ARCHIVE_MEMORY_SIZE bytes, and the others are read from the archive when they are opened.
+        :return: tuple of a dictionary of CSV file name to file name or archive member, and a clean up function
+        '''
+        if options['temp_dir'] and not os.path.isdir(options['temp_dir']):
+            raise CommandError(f"Cannot find temporary working directory '{options['temp_dir']}'")
+        if options['stream']:
+            self.logger.info(f'Decompressing {tar_file}')
+            archive_path = os.path.join(options['data_dir'], tar_file)
+            memory_left = getattr(settings, 'PD_ARCHIVE_MEMORY_SIZE', 512 * 1024 * 1024)
+            members = {}
+
+            # Read the members in archive order so the compressed stream is only read once
+
+            with tarfile.open(archive_path) as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    name = os.path.basename(member.name)
+                    if member.size > memory_left:
+                        members[name] = ArchiveMember(archive_path, member)
+                        continue
+                    with tar.extractfile(member) as handle:
+                        members[name] = ArchiveMember(archive_path, member, data=handle.read())
+                    memory_left -= member.size
+
+            def close():
+                for member in members.values():
+                    member.release()
+            return members, close
+
+        temp_dir = tempfile.mkdtemp(prefix="import_od_", dir=options['temp_dir'])
+        self.logger.info(f'Extracting {tar_file} to {temp_dir}')
+        with tarfile.open(os.path.join(options['data_dir'], tar_file)) as tar:
+            tar.extractall(temp_dir)
+        return {f: os.path.join(temp_dir, f) for f in os.listdir(temp_dir)}, lambda: shutil.rmtree(temp_dir)
+
+    def compare_type(self, compare_cmd, eng, table_name, table_fields, csv_from, csv_to, from_date, to_date, options):
+        '''
+        Compare one PD type between two days
+        :return: True if the comparison completed or the files are identical, otherwise False
+        '''
+        if table_name not in table_fields or not table_fields[table_name][0]:
+            self.logger.error(f'No primary key found for table {table_name}')
+            return False
+        recorder = PhaseRecorder('compare_pd_archive', table_name)
+        with recorder.phase('hash'):
+            identical = compare_files(csv_from, csv_to)
+        if identical:
+            if options['snapshot_dir']:
+                with recorder.phase('write_snapshot'):
+                    carry_forward_snapshot(options['snapshot_dir'], table_name, from_date, to_date)
+            recorder.save()
+            return True
+        primary_key, non_key_fields, field_names = table_fields[table_name]
+        compare_options = {
+            'first_file': csv_from,
+            'second_file': csv_to,
+            'source_date': from_date,
+            'log_date': to_date,
+            'report_file': '',
+            'engine': options['engine'],
+            'snapshot_dir': options['snapshot_dir'],
+            'loader': options['loader'],
+            'csv_reader': options['csv_reader'],
+            'batch_size': options['batch_size'],
+            'insert_select': options['insert_select'],
+            'change_values': options['change_values'],
+            'parquet_dir': options['parquet_dir'],
+            'vacuum': False,
+        }
+        return compare_cmd.compare(eng, table_name, list(primary_key), list(non_key_fields), list(field_names), compare_options, recorder)
+
+    def handle(self, *args, **options):
+        sorted_file_list = self.archive_list(options)
+        if options['prefetch'] < 0:
+            raise CommandError('The number of prefetched archives cannot be negative.')
+
+        # Set up the database engine, the PD field metadata and the comparison command once for the whole batch
+
+        eng = get_engine()
+        table_fields = load_all_table_fields()
+        compare_cmd = CompareCommand()
+
+        results = []
+        from_date = None
+        from_files = None
+        close_from = None
+        close_to = None
+        archives = prefetched(sorted_file_list, lambda tar_file: (tar_file, *self.open_archive(tar_file, options)),
+                              depth=options['prefetch'], discard=lambda opened: opened[2]())
+        try:
+            for tar_file, to_files, close_to in archives:
+                to_date = datetime.strptime(tar_file[3:11], "%Y%m%d")
+
+                if from_files is not None:
+                    self.logger.info(f'Processing changes to {tar_file}')
+                    for csv_file in sorted(to_files):
+                        if csv_file not in from_files:
+                            continue
+                        table_name = pathlib.Path(csv_file).stem.replace('-', '_')
+                        with profiled(profile_base(options, '', f'{table_name}_{to_date.strftime("%Y-%m-%d")}_compare'),
+                                      options['profile_top'], options['profile_memory']):
+                            results.append((to_date, table_name, self.compare_type(
+                                compare_cmd, eng, table_name, table_fields, from_files[csv_file], to_files[csv_file],
+                                from_date, to_date, options)))
+
+                        # The first file is no longer needed, but the second one is the first file of the next day
+                        if isinstance(from_files[csv_file], ArchiveMember):
+                            from_files[csv_file].release()
+
+                    # Clean up the previous day
+                    close_from()
+                from_files, close_from = to_files, close_to
+                from_date = to_date
+        finally:
+            archives.close()
+            if close_to and close_to is not close_from:
+                close_to()
+            if close_from:
+                close_from()
+
+        # Summarize the comparisons by PD type
+
+        failures = 0
+        for table_name in sorted(set(r[1] for r in results)):
+            type_results = [r for r in results if r[1] == table_name]
+            failed = [r[0].strftime("%Y-%m-%d") for r in type_results if not r[2]]
+            failures += len(failed)
+            self.logger.info(f'{table_name}: {len(type_results) - len(failed)} succeeded, {len(failed)} failed'
+                             f'{" (" + ", ".join(failed) + ")" if failed else ""}')
+        if failures:
+            raise CommandError(f'{failures} PD type comparisons failed.')
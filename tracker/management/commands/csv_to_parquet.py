@@ -1,19 +1,167 @@
-from django.core.management.base import BaseCommand
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from django.core.management.base import BaseCommand, CommandError
+import glob
 import logging
+import os
+import pathlib
+import pyarrow as pa
 import pyarrow.csv as pv
 import pyarrow.parquet as pq
+from tracker.parquet import arrow_schema, cast_record_batch, load_field_types
+from tracker.profiling import add_profile_arguments, profile_base, profiled
+from tracker.schema import pd_table_ids
+
+
+def pd_type_for_file(csv_file, pd_types):
+    '''
+    Work out the PD type of a CSV file from its name, e.g. contracts.csv, contracts_activity.csv or
+    contracts_pd_activity.csv
+    :param csv_file: CSV file name
+    :param pd_types: set of the known PD types
+    :return: PD type, or None if the file name does not match one
+    '''
+    stem = pathlib.Path(csv_file).stem.replace('-', '_')
+    for suffix in ('_pd_activity', '_activity', ''):
+        if stem.endswith(suffix) and stem[:len(stem) - len(suffix)] in pd_types:
+            return stem[:len(stem) - len(suffix)]
+    return None
+
+
+def convert_csv(csv_file, parquet_file, field_types, block_size, row_group_size, compression, use_dictionary):
+    '''
+    Convert a CSV file to Parquet one block at a time, so memory use is bounded by the row group size rather than the
+    file size. Every column is read as a string and the PD fields are then typed from their datastore types, so the
+    column types do not depend on the values in the first block. Without field types, Arrow infers the column types
+    from the first block instead, and a later block that does not fit them raises pyarrow.ArrowInvalid.
+    :param field_types: dictionary of field name to datastore type, or None to infer the column types
+    :param block_size: Number of bytes of CSV parsed at a time
+    :param row_group_size: Number of rows per Parquet row group
+    :param compression: Parquet compression codec
+    :param use_dictionary: Dictionary encode the columns
+    :return: number of rows written
+    '''
+    with open(csv_file, 'r', encoding='utf-8-sig', newline='') as handle:
+        columns = next(csv.reader(handle), [])
+    if field_types is None:
+        convert_options = pv.ConvertOptions(strings_can_be_null=True)
+    else:
+        convert_options = pv.ConvertOptions(column_types={c: pa.string() for c in columns}, strings_can_be_null=True)
+    reader = pv.open_csv(csv_file,
+                         read_options=pv.ReadOptions(block_size=block_size),
+                         parse_options=pv.ParseOptions(newlines_in_values=True),
+                         convert_options=convert_options)
+    schema = reader.schema if field_types is None else arrow_schema(columns, field_types)
+    rows = 0
+    pending = schema.empty_table()
+    with pq.ParquetWriter(parquet_file, schema, compression=compression, use_dictionary=use_dictionary) as writer:
+        for batch in reader:
+            if field_types is not None:
+                batch = cast_record_batch(batch, schema)
+            pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+            while pending.num_rows >= row_group_size:
+                writer.write_table(pending.slice(0, row_group_size))
+                pending = pending.slice(row_group_size)
+                rows += row_group_size
+        if pending.num_rows > 0:
+            writer.write_table(pending)
+            rows += pending.num_rows
+    return rows
+
 
 class Command(BaseCommand):
-    help = "Convert a CSV activity file to Parquet."
+    help = "Convert a CSV activity file to Parquet. A directory or a glob pattern converts many files in parallel."
     logger = logging.getLogger(__name__)
 
     def add_arguments(self, parser):
-        parser.add_argument('--csv', type=str, required=True, help='CSV input file name')
-        parser.add_argument('--parquet', type=str, required=True, help='Parquet output file name')
+        parser.add_argument('--csv', type=str, required=True,
+                            help='CSV input file name, or a directory or glob pattern of CSV files')
+        parser.add_argument('--parquet', type=str, required=True,
+                            help='Parquet output file name, or the output directory when converting many files')
+        parser.add_argument('-t', '--table', type=str, required=False, default=None,
+                            help='The Recombinant Type whose field types are used for the Parquet schema. When converting '
+                                 'many files without a type, the type is taken from each file name.')
+        parser.add_argument('--block_size', type=int, default=8 * 1024 * 1024,
+                            help='The number of bytes of CSV parsed at a time.')
+        parser.add_argument('--row_group_size', type=int, default=250000,
+                            help='The number of rows per Parquet row group.')
+        parser.add_argument('--compression', type=str, choices=['snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none'], default='snappy',
+                            help='The Parquet compression codec.')
+        parser.add_argument('--no_dictionary', action='store_true', default=False,
+                            help='Do not dictionary encode the Parquet columns.')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='The number of files to convert at the same time when converting many files.')
+        add_profile_arguments(parser)
+
+    def convert(self, csv_file, parquet_file, field_types, options):
+        self.logger.info(f'Converting {csv_file} to {parquet_file}')
+        with profiled(profile_base(options, os.path.dirname(os.path.abspath(parquet_file)), f'{pathlib.Path(parquet_file).stem}_convert'),
+                      options['profile_top'], options['profile_memory']):
+            try:
+                rows = convert_csv(csv_file, parquet_file, field_types, options['block_size'], options['row_group_size'],
+                                   options['compression'], not options['no_dictionary'])
+            except pa.ArrowInvalid as e:
+                if field_types is not None:
+                    raise
+                self.logger.warning(f'Cannot infer the column types of {csv_file}, all columns will be strings: {e}')
+                rows = convert_csv(csv_file, parquet_file, {}, options['block_size'], options['row_group_size'],
+                                   options['compression'], not options['no_dictionary'])
+        self.logger.info(f'Wrote {rows} rows to {parquet_file}')
 
     def handle(self, *args, **options):
+        if options['block_size'] < 1 or options['row_group_size'] < 1 or options['jobs'] < 1:
+            raise CommandError('The block size, row group size and number of jobs must be at least 1.')
+        if options['compression'] == 'none':
+            options['compression'] = None
+        if options['profile'] and options['jobs'] > 1:
+            self.logger.warning('Profiling converts one file at a time, ignoring --jobs')
+            options['jobs'] = 1
+
+        if os.path.isfile(options['csv']):
+            table_name = options['table'].replace('-', '_') if options['table'] else pd_type_for_file(options['csv'], set(pd_table_ids()))
+            if table_name is None:
+                self.logger.warning(f"No PD type found for {options['csv']}, the column types will be inferred")
+            self.convert(options['csv'], options['parquet'], load_field_types(table_name) if table_name else None, options)
+            return
+
+        # Convert every CSV file in a directory or matching a glob pattern into the output directory
+
+        if os.path.isdir(options['csv']):
+            csv_files = sorted(glob.glob(os.path.join(options['csv'], '*.csv')))
+        else:
+            csv_files = sorted(glob.glob(options['csv']))
+        if not csv_files:
+            raise CommandError(f"No CSV files found for {options['csv']}")
+
+        pd_types = set(pd_table_ids())
+        conversions = []
+        for csv_file in csv_files:
+            table_name = options['table'].replace('-', '_') if options['table'] else pd_type_for_file(csv_file, pd_types)
+            if table_name is None:
+                self.logger.warning(f'No PD type found for {csv_file}, the column types will be inferred')
+            parquet_file = os.path.join(options['parquet'], f'{pathlib.Path(csv_file).stem}.parquet')
+            conversions.append((csv_file, parquet_file, load_field_types(table_name) if table_name else None))
+
+        # Files with the same name in different directories would overwrite each other's Parquet file
 
-        parse_opts = pv.ParseOptions(newlines_in_values=True)
-        table = pv.read_csv(options['csv'], parse_options=parse_opts)
-        pq.write_table(table, options['parquet'])
+        targets = {}
+        for csv_file, parquet_file, _ in conversions:
+            targets.setdefault(parquet_file, []).append(csv_file)
+        duplicates = {parquet_file: files for parquet_file, files in targets.items() if len(files) > 1}
+        if duplicates:
+            raise CommandError('Several CSV files would be written to the same Parquet file: ' +
+                               '; '.join(f'{", ".join(files)} -> {parquet_file}' for parquet_file, files in duplicates.items()))
+        os.makedirs(options['parquet'], exist_ok=True)
 
+        failures = []
+        with ThreadPoolExecutor(max_workers=options['jobs']) as pool:
+            futures = [(csv_file, pool.submit(self.convert, csv_file, parquet_file, field_types, options))
+                       for csv_file, parquet_file, field_types in conversions]
+            for csv_file, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f'Error converting {csv_file}: {e}')
+                    failures.append(csv_file)
+        if failures:
+            raise CommandError(f'{len(failures)} files failed to convert: {", ".join(failures)}')
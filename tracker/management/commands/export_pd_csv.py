@@ -1,92 +1,343 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
+from datetime import datetime
 import os.path
 import pandas as pd
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import connections
 import logging
-from sqlalchemy import create_engine
-from tracker.models import PDTableField, PDRunLog
+import pytz
+from sqlalchemy import text
+from tracker.db import copy_to_csv, get_engine
+from tracker.metrics import PhaseRecorder
+from tracker.models import PDRunLog, PDExportLog
+from tracker.parquet import ActivityDatasetWriter, load_field_types
+from tracker.profiling import add_profile_arguments, profile_base, profiled
+from tracker.schema import get_all_schemas, get_schema
+
+
+def select_column(column, array_columns):
+    '''
+    Build the SQL expression exporting an activity table column as text. Array columns, such as changed_fields, are
+    exported as comma separated lists.
+    :param column: column name
+    :param array_columns: list of the array columns of the table
+    :return: SQL expression
+    '''
+    if column in array_columns:
+        return f"array_to_string({column}, ',')"
+    return f'CAST({column} AS TEXT)'
 
 
 class Command(BaseCommand):
     help = "Export PD data to CSV. Can export all types or a single type."
     logger = logging.getLogger(__name__)
 
+    def incremental_start(self, table_name, report_file, header):
+        '''
+        Work out whether new rows can be appended to an existing export file instead of rebuilding it. The file has to
+        exist with the same header, and no day up to its high-water mark can have been compared again since it was
+        exported.
+        :param header: list of the column names the export file would be written with
+        :return: the log date of the last exported rows, or None if the file has to be rebuilt
+        '''
+        if not os.path.exists(report_file):
+            return None
+        export_log = PDExportLog.objects.filter(report_file=report_file).first()
+        if export_log is None:
+            self.logger.info(f'No previous export recorded for {report_file}, rebuilding it')
+            return None
+        if os.path.isfile(report_file):
+            with open(report_file, 'r', encoding='utf-8-sig', newline='') as handle:
+                existing_header = next(csv.reader(handle), [])
+            if existing_header != header:
+                self.logger.info(f'The columns of {report_file} have changed, rebuilding it')
+                return None
+        reprocessed = PDRunLog.objects.filter(table_id=table_name, log_date__date__lte=export_log.high_water_mark,
+                                              activity_date__gt=export_log.export_date)
+        if reprocessed.exists():
+            self.logger.info(f'{table_name} has been reprocessed on or before {export_log.high_water_mark}, rebuilding {report_file}')
+            return None
+        return export_log.high_water_mark
 
-    def export_type(self, table_name, report_dir, cols:list):
+    def copy_output(self, conn, table_name, primary_key, output, high_water_mark):
+        '''
+        Write one export file with COPY ... TO STDOUT, so that PostgreSQL formats the CSV rows itself. The file has the
+        same BOM, header, column order, quoting and line endings as the pandas export; NULL values are written as quoted
+        empty strings.
+        :param conn: SQLAlchemy connection
+        :param primary_key: list of the primary key field names
+        :param output: dictionary with the report file, the path it is written to, data columns and incremental start
+        date of the file
+        :param high_water_mark: Latest log date to export
+        :return: number of rows written
+        '''
+        header = primary_key + output['data_columns']
+        select_fields = ", ".join(f"COALESCE({select_column(c, output['array_columns'])}, '')" for c in header)
+        conditions = f"log_date <= '{high_water_mark}'"
+        if output['since']:
+            conditions += f" AND log_date > '{output['since']}'"
+        statement = f'''COPY (SELECT {select_fields} FROM "{table_name}" WHERE {conditions})
+                        TO STDOUT WITH (FORMAT CSV, FORCE_QUOTE *)'''
+        cursor = conn.connection.cursor()
         try:
-            # Look up the primary key for the table from the database
-            pkeys = PDTableField.objects.filter(table_id=table_name, primary_key=True).order_by('field_order')
-            if pkeys.count() == 0:
-                raise CommandError(f'No primary key found for table {table_name}')
-            primary_key = []
-            for pkey in pkeys:
-                primary_key.append(pkey.field_name)
+            with open(output['path'], 'a' if output['since'] else 'w', encoding='utf-8-sig', newline='') as handle:
+                if not output['since']:
+                    csv.writer(handle, quoting=csv.QUOTE_ALL, lineterminator=os.linesep).writerow(header)
+                return copy_to_csv(cursor, statement, handle)
+        finally:
+            cursor.close()
 
-            # Get the fields to export
-            conn_string = f"postgresql+psycopg2://{str(settings.DATABASES['default']['USER'])}:{str(settings.DATABASES['default']['PASSWORD'])}@{str(settings.DATABASES['default']['HOST'])}/{str(settings.DATABASES['default']['NAME'])}"
-            eng = create_engine(conn_string)
-            conn = eng.connect()
+    def finish_output(self, table_name, output, export_date, high_water_mark):
+        '''
+        Move a completed export file into place and record it in the PD Export Log, so that a later failure in the
+        same export does not affect it
+        :param output: dictionary with the report file, the path it was written to and the number of rows written
+        :param export_date: Date and time of the export
+        :param high_water_mark: Latest log date exported
+        '''
+        if output['path'] != output['report_file']:
+            os.replace(output['path'], output['report_file'])
+        self.logger.info(f'Exported {output["rows"]} rows to {output["report_file"]}')
+        PDExportLog.objects.update_or_create(report_file=output['report_file'], defaults={
+            'table_id': table_name,
+            'export_date': export_date,
+            'high_water_mark': high_water_mark,
+            'rows_exported': output['rows'],
+            'full_export': output['since'] is None,
+        })
+        output['finished'] = True
+
+    def discard_output(self, output):
+        '''
+        Undo the partial write of an export file that could not be completed. Appended rows are truncated, so the next
+        incremental export appends them again without duplicates, and a rebuilt CSV file is left unchanged. A Parquet
+        dataset that was being rebuilt has already been cleared, so it is removed from the PD Export Log to be rebuilt
+        in full next time.
+        :param output: dictionary with the report file, the path it was written to and its size before the export
+        '''
+        if output['parquet']:
+            if not output['since']:
+                PDExportLog.objects.filter(report_file=output['report_file']).delete()
+        elif output['since']:
+            with open(output['report_file'], 'r+b') as handle:
+                handle.truncate(output['size'])
+        elif os.path.exists(output['path']):
+            os.remove(output['path'])
+
+    def export_type(self, eng, table_name, report_dir, cols: list, incremental=False, engine='pandas', parquet_dir=''):
+        '''
+        Export the activity table of a PD type to <type>_activity.csv and, if export columns are given, to the filtered
+        <type>_pd_activity.csv. With the pandas engine both files are written from a single scan of the table; with
+        the copy engine each file is written by its own COPY statement. If a Parquet directory is given, the rows are
+        also written to the table=<type> partition of the Parquet dataset in it. Rebuilt CSV files are written to a
+        temporary file first, and each file is recorded in the PD Export Log as soon as it is complete. If the export
+        fails, the files that are not complete are put back as they were. The time and resources used by each phase of
+        the export are recorded as PDRunPhase entries.
+        :param eng: SQLAlchemy engine for the PD database
+        :param cols: list of the pd_export columns for the filtered file, or an empty list for the full file only
+        :param incremental: Append only the rows logged since the last export to existing files
+        :param engine: 'pandas' to format the rows with pandas, or 'copy' to stream them from PostgreSQL COPY
+        :param parquet_dir: Directory of the Parquet dataset, or an empty string
+        '''
+        recorder = PhaseRecorder('export_pd_csv', table_name)
+
+        # Look up the primary key for the table from its schema
+        schema = get_schema(table_name)
+        if schema is None or not schema.primary_key:
+            raise CommandError(f'No primary key found for table {table_name}')
+        primary_key = list(schema.primary_key)
 
-            i = 0
-            csv_filename = f'{table_name}_activity.csv'
+        with eng.connect() as conn:
+
+            # Get the fields to export
+            results = conn.execute(text(f'''select column_name, data_type from information_schema.columns
+                                            where table_schema = 'public' and table_name = '{table_name}' order by ordinal_position'''))
+            column_types = {row[0]: row[1] for row in results}
+            columns = list(column_types)
+            array_columns = [c for c, t in column_types.items() if t == 'ARRAY']
+            missing_cols = [c for c in cols if c not in columns]
+            if missing_cols:
+                raise CommandError(f'The export fields {missing_cols} are missing from table {table_name}')
+            outputs = [{'report_file': os.path.join(report_dir, f'{table_name}_activity.csv'), 'columns': columns, 'parquet': False}]
             if len(cols) > 0:
-                csv_filename = f'{table_name}_pd_activity.csv'
-            report_file = os.path.join(report_dir, csv_filename)
-            sql_query = f'SELECT * FROM "{table_name}"'          
-            if len(cols):
-                sql_query = f'SELECt {",".join(cols)} FROM {table_name}'
-
-            for chunk in pd.read_sql(sql_query, conn.connection, index_col=primary_key, chunksize=1000):
-                if i == 0:
-                    chunk.to_csv(report_file, index=True, header=True, mode='w', encoding='utf-8-sig', quoting=csv.QUOTE_ALL)
-                    i = chunk.index.size
-                else:
-                    chunk.to_csv(report_file, mode='a', header=False, index=True, encoding='utf-8-sig', quoting=csv.QUOTE_ALL)
-                    i += chunk.index.size
-            self.logger.info(f'Exported {i} rows to {report_file}')
-        finally:
-            conn.close()
+                outputs.append({'report_file': os.path.join(report_dir, f'{table_name}_pd_activity.csv'), 'columns': cols, 'parquet': False})
+            if parquet_dir:
+                outputs.append({'report_file': os.path.join(parquet_dir, f'table={table_name}'), 'columns': columns, 'parquet': True})
+
+            # Only export up to the latest log date present now, so that it can be recorded as the high-water mark
+
+            local_tz = pytz.timezone(settings.TIME_ZONE)
+            export_date = local_tz.localize(datetime.now())
+            with recorder.phase('prepare'):
+                high_water_mark = conn.execute(text(f'SELECT MAX(log_date) FROM "{table_name}"')).scalar()
+            if high_water_mark is None:
+                self.logger.info(f'No rows to export from {table_name}')
+                recorder.save()
+                return
+            if isinstance(high_water_mark, str):
+                high_water_mark = datetime.strptime(high_water_mark, '%Y-%m-%d').date()
+            with recorder.phase('prepare'):
+                for output in outputs:
+                    output['data_columns'] = [c for c in output['columns'] if c not in primary_key]
+                    output['array_columns'] = array_columns
+                    output['since'] = self.incremental_start(table_name, output['report_file'], primary_key + output['data_columns']) if incremental else None
+                    output['rows'] = 0
+                    output['finished'] = False
+                    output['path'] = output['report_file'] if output['since'] or output['parquet'] else f"{output['report_file']}.tmp"
+                    output['size'] = os.path.getsize(output['report_file']) if output['since'] and not output['parquet'] else None
+                    if output['since']:
+                        self.logger.info(f'Appending rows logged after {output["since"]} to {output["report_file"]}')
+
+            try:
+                # With the copy engine, the CSV files are written by PostgreSQL and only the Parquet dataset is scanned
+
+                scan_outputs = outputs
+                if engine == 'copy':
+                    for output in outputs:
+                        if not output['parquet']:
+                            with recorder.phase('copy') as phase:
+                                output['rows'] = self.copy_output(conn, table_name, primary_key, output, high_water_mark)
+                                phase['rows'] += output['rows']
+                            self.finish_output(table_name, output, export_date, high_water_mark)
+                    scan_outputs = [output for output in outputs if output['parquet']]
+                if scan_outputs:
+                    # Scan from the oldest log date that any of the files needs. The Parquet dataset is written one log date
+                    # at a time, so it needs the rows in log date order.
+
+                    select_fields = ", ".join(f'{select_column(c, array_columns)} AS {c}' if c in array_columns else c for c in columns)
+                    sql_query = f'SELECT {select_fields} FROM "{table_name}" WHERE log_date <= :high_water_mark'
+                    params = {'high_water_mark': str(high_water_mark)}
+                    if all(output['since'] for output in scan_outputs):
+                        sql_query += ' AND log_date > :since'
+                        params['since'] = str(min(output['since'] for output in scan_outputs))
+                    if any(output['parquet'] for output in scan_outputs):
+                        sql_query += ' ORDER BY log_date'
+
+                    for output in scan_outputs:
+                        if output['parquet']:
+                            output['writer'] = ActivityDatasetWriter(parquet_dir, table_name, load_field_types(table_name))
+                            if not output['since']:
+                                output['writer'].clear()
+                    try:
+                        # Time fetching the chunks from the database separately from writing them out
+
+                        with recorder.phase('scan'):
+                            chunks = pd.read_sql(text(sql_query), conn, params=params, index_col=primary_key, chunksize=1000)
+                        while True:
+                            with recorder.phase('scan') as phase:
+                                chunk = next(chunks, None)
+                                if chunk is not None:
+                                    phase['rows'] += chunk.index.size
+                            if chunk is None:
+                                break
+                            with recorder.phase('write') as phase:
+                                for output in scan_outputs:
+                                    rows = chunk[output['data_columns']]
+                                    if output['since']:
+                                        rows = rows[chunk['log_date'].astype(str) > str(output['since'])]
+                                    if output['parquet']:
+                                        output['writer'].write(rows.reset_index())
+                                    elif output['rows'] == 0 and not output['since']:
+                                        rows.to_csv(output['path'], index=True, header=True, mode='w', encoding='utf-8-sig', quoting=csv.QUOTE_ALL)
+                                    else:
+                                        rows.to_csv(output['path'], mode='a', header=False, index=True, encoding='utf-8-sig', quoting=csv.QUOTE_ALL)
+                                    output['rows'] += rows.index.size
+                                    phase['rows'] += rows.index.size
+                    finally:
+                        for output in scan_outputs:
+                            if output['parquet']:
+                                output['writer'].close()
+                    for output in scan_outputs:
+                        self.finish_output(table_name, output, export_date, high_water_mark)
+            except Exception:
+                for output in outputs:
+                    if not output['finished']:
+                        self.discard_output(output)
+                raise
+        recorder.save()
 
     def add_arguments(self, parser):
         parser.add_argument('table', type=str, help='The Recombinant Type that to be exported. Use "all" to export all.')
         parser.add_argument('-d', '--report_dir', type=str, help='The directory where to write PD report files.', required=True)
         parser.add_argument('-f', '--filtered', action='store_true', help='Export filtered versions of some PD report files with limited columns')
+        parser.add_argument('-i', '--incremental', action='store_true', default=False,
+                            help='Only append the rows logged since the last export to existing report files. Files are '
+                                 'rebuilt when a day that was already exported has been compared again.')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='The number of PD types to export at the same time when exporting all types.')
+        parser.add_argument('-e', '--engine', type=str, choices=['pandas', 'copy'], default='pandas',
+                            help='How the rows are written: formatted with pandas (default) or streamed from PostgreSQL with COPY ... TO STDOUT.')
+        parser.add_argument('--parquet_dir', type=str, default='',
+                            help='Also write the activity rows to a Parquet dataset in this directory, partitioned as '
+                                 'table=<type>/log_date=<YYYY-MM-DD> and typed from the PD field types.')
+        add_profile_arguments(parser)
 
-    def handle(self, *args, **options):
-        table_name = options['table'].replace('-', '_')
+    def export_cols(self, table_name):
+        '''
+        Get the columns of the filtered export of a PD type. All NIL reports are automatically excluded.
+        :return: list of the pd_export field names in field order, or an empty list if no filter has been specified
+        '''
+        if table_name.endswith("_nil"):
+            return []
+        schema = get_schema(table_name)
+        return list(schema.export_fields) if schema else []
+
+    def export_job(self, eng, table_name, report_dir, cols, incremental, engine, parquet_dir):
+        '''
+        Run export_type() in a worker thread and release the thread's Django database connection when done
+        '''
         try:
-            conn_string = f"postgresql+psycopg2://{str(settings.DATABASES['default']['USER'])}:{str(settings.DATABASES['default']['PASSWORD'])}@{str(settings.DATABASES['default']['HOST'])}/{str(settings.DATABASES['default']['NAME'])}"
-            eng = create_engine(conn_string)
-            conn = eng.connect()
-
-            if table_name == 'all':
-                # Obtain a set if the unique table names derived from the fields table
-                table_qs = PDTableField.objects.all()
-                table_list = []
-                for table in table_qs:
-                    table_list.append(table.table_id)
-                table_list = set(table_list)
-
-                # Export each table
-                for table in table_list:
-                    statement_ruthere = f"SELECT EXISTS(SELECT FROM pg_tables WHERE schemaname = 'public' and tablename = '{table}')"
-                    results = conn.execute(statement_ruthere)
-                    r = results.fetchone()
-                    if not r['exists']:
-                        continue
-                    self.export_type(table, options['report_dir'], [])
-
-                    # If filtered files requested, check to see if filter has been specified. Al NIL reports are automatically
-                    # excluded from this action.
-                    xfields = PDTableField.objects.filter(table_id=table, pd_export=True).order_by('field_order')
-                    if not table.endswith("_nil") and  xfields.count() > 0:
-                        cols = []
-                        for f in xfields:
-                            cols.append(f.field_name)
-                        self.export_type(table, options['report_dir'], cols=cols)
-                    
-            else:
-                self.export_type(table_name, options['report_dir'])
+            self.export_type(eng, table_name, report_dir, cols, incremental, engine, parquet_dir)
         finally:
-            conn.close()
+            connections.close_all()
+
+    def handle(self, *args, **options):
+        table_name = options['table'].replace('-', '_')
+        if options['jobs'] < 1:
+            raise CommandError('The number of jobs must be at least 1.')
+        eng = get_engine()
+
+        if table_name == 'all':
+            # Obtain the unique table names from the fields table, and export the ones that have an activity table.
+            # Filtered files are always written when a filter has been specified.
+            with eng.connect() as conn:
+                results = conn.execute(text("SELECT tablename FROM pg_tables WHERE schemaname = 'public'"))
+                existing_tables = set(row[0] for row in results)
+            table_list = [t for t in get_all_schemas() if t in existing_tables]
+            exports = [(table, self.export_cols(table)) for table in table_list]
+        else:
+            exports = [(table_name, self.export_cols(table_name) if options['filtered'] else [])]
+
+        # Export each table, several at a time over the shared connection pool if requested
+
+        # cProfile only sees the thread it runs in, so each type is exported and profiled in turn when profiling
+
+        if options['profile'] and options['jobs'] > 1:
+            self.logger.warning('Profiling exports one PD type at a time, ignoring --jobs')
+            options['jobs'] = 1
+        # A PD type that fails to export is logged and the others are still exported, with a single error at the end
+
+        failures = []
+        if options['jobs'] == 1:
+            for table, cols in exports:
+                try:
+                    with profiled(profile_base(options, options['report_dir'], f'{table}_export'), options['profile_top'], options['profile_memory']):
+                        self.export_type(eng, table, options['report_dir'], cols, options['incremental'], options['engine'], options['parquet_dir'])
+                except Exception as e:
+                    self.logger.error(f'Error exporting table {table}: {e}')
+                    failures.append(table)
+        else:
+            with ThreadPoolExecutor(max_workers=options['jobs']) as pool:
+                futures = [(table, pool.submit(self.export_job, eng, table, options['report_dir'], cols, options['incremental'],
+                                               options['engine'], options['parquet_dir']))
+                           for table, cols in exports]
+                for table, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self.logger.error(f'Error exporting table {table}: {e}')
+                        failures.append(table)
+        if failures:
+            raise CommandError(f'{len(failures)} PD types failed to export: {", ".join(failures)}')
@@ -1,98 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from django.db import transaction
+import json
 import logging
+import os
+import pathlib
 import requests
+import time
+from tracker.metrics import PhaseRecorder
 from tracker.models import PDTableField
+from tracker.schema import invalidate_schemas
+
+# The Recombinant Types imported by --all. Set PD_TYPES to import a different list.
+
+DEFAULT_PD_TYPES = ["adminaircraft", "ati", "briefingt", "consultations", "contracts", "contractsa", "dac", "experiment",
+                    "grants", "hospitalityq", "inventory", "nap", "qpnotes", "reclassification", "service", "travela",
+                    "travelq", "wrongdoing"]
+
+SCHEMA_FIELD_ATTRIBUTES = ['field_order', 'field_type', 'label_en', 'label_fr', 'primary_key']
+
+
+def schema_fields(table_name, field_info):
+    '''
+    Build the PDTableField values of every resource in a recombinant schema. The owner_org key field and, except for
+    the Open Data Inventory, the record audit fields are added after the schema fields.
+    :param table_name: The Recombinant Type of the schema
+    :param field_info: Recombinant schema JSON
+    :return: dictionary of table id to a list of dictionaries of the PDTableField values, in field order
+    '''
+    tables = {}
+    for resource in field_info['resources']:
+        pk_fields = resource['primary_key']
+        table_fields = resource['fields']
+
+        # Use _ in place of - for table names
+        table_id = resource['resource_name'].replace('-', '_')
+        fields = []
+        for field_order, field in enumerate(table_fields):
+            fields.append({'field_name': field['id'], 'field_order': field_order, 'field_type': field['datastore_type'],
+                           'label_en': field['label']['en'], 'label_fr': field['label']['fr'],
+                           'primary_key': True if field['id'] in pk_fields else False})
+        fields.append({'field_name': 'owner_org', 'field_order': len(table_fields), 'field_type': 'text',
+                       'label_en': 'Organization', 'label_fr': 'Organisation', 'primary_key': True})
+        # Note: The Open Data Inventory is an exception and does not audit fields
+        if table_name != "inventory":
+            fields.append({'field_name': 'record_created', 'field_order': len(table_fields) + 1, 'field_type': 'text',
+                           'label_en': 'Record Creation Time', 'label_fr': "Temps de création de l'enregistrement",
+                           'primary_key': False})
+            fields.append({'field_name': 'record_modified', 'field_order': len(table_fields) + 2, 'field_type': 'text',
+                           'label_en': 'Last Record Modification Time',
+                           'label_fr': 'Temps de modification du dernier enregistrement', 'primary_key': False})
+            fields.append({'field_name': 'user_modified', 'field_order': len(table_fields) + 3, 'field_type': 'text',
+                           'label_en': 'User Last Modified Record',
+                           'label_fr': 'Utilisateur Dernier enregistrement modifié', 'primary_key': False})
+        tables[table_id] = fields
+    return tables
+
+
+def apply_schema_fields(tables):
+    '''
+    Bring the PDTableField rows of the given tables in line with their schemas in a single transaction. Only the
+    fields that were added, changed or removed are written, and the pd_export flag of existing fields is kept.
+    :param tables: dictionary of table id to a list of dictionaries of the PDTableField values
+    :return: tuple of the number of fields created, updated and deleted
+    '''
+    with transaction.atomic():
+        existing = {(f.table_id, f.field_name): f for f in PDTableField.objects.filter(table_id__in=list(tables))}
+        to_create = []
+        to_update = []
+        for table_id, fields in tables.items():
+            for values in fields:
+                pd_field = existing.pop((table_id, values['field_name']), None)
+                if pd_field is None:
+                    to_create.append(PDTableField(table_id=table_id, **values))
+                elif any(getattr(pd_field, a) != values[a] for a in SCHEMA_FIELD_ATTRIBUTES):
+                    for a in SCHEMA_FIELD_ATTRIBUTES:
+                        setattr(pd_field, a, values[a])
+                    to_update.append(pd_field)
+        PDTableField.objects.filter(pk__in=[f.pk for f in existing.values()]).delete()
+        PDTableField.objects.bulk_update(to_update, SCHEMA_FIELD_ATTRIBUTES)
+        PDTableField.objects.bulk_create(to_create)
+    return len(to_create), len(to_update), len(existing)
+
+
+def schema_cache_paths(cache_dir, table_name):
+    '''
+    :return: tuple of the paths of the cached schema JSON of a PD type and of its HTTP validators
+    '''
+    return os.path.join(cache_dir, f'{table_name}.json'), os.path.join(cache_dir, f'{table_name}.meta.json')
+
+
+def read_schema_file(file_name):
+    '''
+    Read a recombinant schema JSON file
+    :return: tuple of the recombinant schema JSON and the number of bytes read
+    '''
+    with open(file_name, 'rb') as handle:
+        content = handle.read()
+    return json.loads(content), len(content)
+
+
+def read_cached_schema(cache_dir, table_name):
+    '''
+    Read the cached recombinant schema of a PD type
+    :return: tuple of the recombinant schema JSON and a dictionary of its ETag, Last-Modified and fetch time, or
+    (None, None) if it is not cached
+    '''
+    schema_file, meta_file = schema_cache_paths(cache_dir, table_name)
+    try:
+        field_info = read_schema_file(schema_file)[0]
+        with open(meta_file, 'r', encoding='utf-8') as handle:
+            meta = json.load(handle)
+    except (OSError, ValueError):
+        return None, None
+    return field_info, meta
+
+
+def write_cached_schema(cache_dir, table_name, content, meta):
+    '''
+    Save a recombinant schema and its validators to the cache. The files are replaced atomically, so a failed run
+    cannot leave a truncated schema behind.
+    :param content: Response body of the recombinant schema, or None to only update the validators
+    :param meta: dictionary of the ETag, Last-Modified and fetch time of the schema
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    schema_file, meta_file = schema_cache_paths(cache_dir, table_name)
+    if content is not None:
+        with open(f'{schema_file}.tmp', 'wb') as handle:
+            handle.write(content)
+        os.replace(f'{schema_file}.tmp', schema_file)
+    with open(f'{meta_file}.tmp', 'w', encoding='utf-8') as handle:
+        json.dump(meta, handle)
+    os.replace(f'{meta_file}.tmp', meta_file)
 
 
 class Command(BaseCommand):
-    help = "Import CKAN schema"
+    help = "Import CKAN schema. Can import a single type or all types."
     logger = logging.getLogger(__name__)
 
     def add_arguments(self, parser):
-        parser.add_argument('-t', '--table', type=str, help='The Recombinant Type that is being loaded', required=True)
+        group = parser.add_mutually_exclusive_group(required=True)
+        group.add_argument('-t', '--table', type=str, help='The Recombinant Type that is being loaded')
+        group.add_argument('--all', action='store_true', default=False,
+                           help='Load every Recombinant Type in the PD_TYPES setting, or the default list, fetching the schemas at the same time.')
+        group.add_argument('--from_file', '--from-file', type=str, default='',
+                           help='Load the Recombinant Type from a local schema JSON file named <type>.json instead of the portal.')
+        parser.add_argument('--from_dir', '--from-dir', type=str, default='',
+                            help='Load the schemas of -t or --all from the <type>.json files in a local directory, such as a '
+                                 'copy of the schema cache, instead of the portal.')
+        parser.add_argument('-j', '--jobs', type=int, default=8,
+                            help='The number of schemas fetched at the same time with --all.')
+        parser.add_argument('--cache_dir', type=str, default=getattr(settings, 'PD_SCHEMA_CACHE_DIR', ''),
+                            help='Directory where the fetched schemas are cached. Cached schemas are revalidated with their '
+                                 'ETag or Last-Modified date, and used as is when the portal cannot be reached.')
+        parser.add_argument('--max_age', type=int, default=getattr(settings, 'PD_SCHEMA_CACHE_TTL', 60 * 60),
+                            help='The number of seconds a cached schema is used without checking the portal. 0 always checks.')
+        parser.add_argument('--timeout', type=int, default=100,
+                            help='The number of seconds to wait for the portal.')
 
-    def handle(self, *args, **options):
-        table_name = options['table']
-        self.logger.info("Importing CKAN schema for table: {}".format(table_name))
-        response = requests.get(settings.CKAN_RECOMBINANT_API_URL.format(options['table']), timeout=100, verify=False)
-        if response.status_code == 200:
-            self.logger.info("Successfully retrieved CKAN schema for table: {}".format(table_name))
-            field_info = response.json()
-            for r in range(len(field_info['resources'])):
-                pk_fields = field_info['resources'][r]['primary_key']
-                table_fields = field_info['resources'][r]['fields']
-
-                # Use _ in place of - for table names
-                table_id = field_info['resources'][r]['resource_name'].replace('-', '_')
-                # Delete all existing fields for this table
-                PDTableField.objects.filter(table_id=field_info['resources'][r]['resource_name']).delete()
-
-                for field_order, field in enumerate(table_fields):
-                    tbf, created = PDTableField.objects.update_or_create(
-                        table_id=table_id,
-                        field_name=field['id'],
-                        field_order=field_order,
-                        field_type=field['datastore_type'],
-                        label_en=field['label']['en'],
-                        label_fr=field['label']['fr'],
-                        primary_key=True if field['id'] in pk_fields else False,
-                    )
-                    tbf.save()
-                tbf, created = PDTableField.objects.update_or_create(
-                    table_id=table_id,
-                    field_name="owner_org",
-                    field_order=len(table_fields),
-                    field_type="text",
-                    label_en="Organization",
-                    label_fr="Organisation",
-                    primary_key=True,
-                )
-                # Note: The Open Data Inventory is an exception and does not audit fields
-                if table_name != "inventory":
-                    tbf, created = PDTableField.objects.update_or_create(
-                        table_id=table_id,
-                        field_name="record_created",
-                        field_order=len(table_fields) + 1,
-                        field_type="text",
-                        label_en="Record Creation Time",
-                        label_fr="Temps de création de l'enregistrement",
-                        primary_key=False,
-                    )
-                    tbf, created = PDTableField.objects.update_or_create(
-                        table_id=table_id,
-                        field_name="record_modified",
-                        field_order=len(table_fields) + 2,
-                        field_type="text",
-                        label_en="Last Record Modification Time",
-                        label_fr="Temps de modification du dernier enregistrement",
-                        primary_key=False,
-                    )
-                    tbf, created = PDTableField.objects.update_or_create(
-                        table_id=table_id,
-                        field_name="user_modified",
-                        field_order=len(table_fields) + 3,
-                        field_type="text",
-                        label_en="User Last Modified Record",
-                        label_fr="Utilisateur Dernier enregistrement modifié",
-                        primary_key=False,
-                    )
-                tbf.save()
-                self.logger.info("Successfully imported CKAN schema for table: {}".format(field_info['resources'][r]['resource_name']))
-        else:
+    def load_schema(self, session, table_name, options):
+        '''
+        Load the recombinant schema of a PD type from a local directory if one is given, otherwise from the portal
+        :return: tuple of the recombinant schema JSON and the number of bytes read
+        '''
+        if options['from_dir']:
+            return read_schema_file(os.path.join(options['from_dir'], f'{table_name}.json'))
+        return self.fetch_schema(session, table_name, options['cache_dir'], options['max_age'], options['timeout'])
+
+    def fetch_schema(self, session, table_name, cache_dir='', max_age=0, timeout=100):
+        '''
+        Retrieve the recombinant schema of a PD type from the portal. With a cache directory, a schema cached less than
+        max_age seconds ago is used without a request, an older one is only downloaded again if the portal reports that
+        it has changed, and the cached schema is used if the portal cannot be reached.
+        :param session: requests Session shared by the fetches
+        :param table_name: The Recombinant Type to retrieve
+        :param cache_dir: Directory of the schema cache, or an empty string to always download the schema
+        :param max_age: Number of seconds a cached schema is used without checking the portal
+        :param timeout: Number of seconds to wait for the portal
+        :return: tuple of the recombinant schema JSON and the number of bytes received
+        '''
+        cached, meta = read_cached_schema(cache_dir, table_name) if cache_dir else (None, None)
+        if cached is not None and time.time() - meta.get('fetched', 0) < max_age:
+            self.logger.info("Using the cached CKAN schema for table: {}".format(table_name))
+            return cached, 0
+
+        headers = {}
+        if cached is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if cached is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = session.get(settings.CKAN_RECOMBINANT_API_URL.format(table_name), headers=headers, timeout=timeout, verify=False)
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+            self.logger.warning(f'Could not reach the portal for table {table_name}, using the cached CKAN schema: {e}')
+            return cached, 0
+        if response.status_code == 304 and cached is not None:
+            self.logger.info("The CKAN schema for table {} has not changed".format(table_name))
+            write_cached_schema(cache_dir, table_name, None, {**meta, 'fetched': time.time()})
+            return cached, len(response.content)
+        if response.status_code != 200 and cached is not None and response.status_code >= 500:
+            self.logger.warning(f'The portal returned {response.status_code} for table {table_name}, using the cached CKAN schema')
+            return cached, len(response.content)
+        if response.status_code != 200:
             self.logger.error("Failed to retrieve CKAN schema for table: {}".format(table_name))
-            self.logger.error("Response: {}".format(response.text))
             self.logger.error("Response status code: {}".format(response.status_code))
             self.logger.error("Response headers: {}".format(response.headers))
-            self.logger.error("Response cookies: {}".format(response.cookies))
-            self.logger.error("Response history: {}".format(response.history))
             self.logger.error("Response elapsed: {}".format(response.elapsed))
-            self.logger.error("Response request: {}".format(response.request))
             self.logger.error("Response url: {}".format(response.url))
             self.logger.error("Response reason: {}".format(response.reason))
-            self.logger.error("Response encoding: {}".format(response.encoding))
             self.logger.error("Response text: {}".format(response.text))
-
             raise CommandError("Failed to retrieve CKAN schema for table: {}".format(table_name))
+        self.logger.info("Successfully retrieved CKAN schema for table: {}".format(table_name))
+        field_info = response.json()
+        if cache_dir:
+            write_cached_schema(cache_dir, table_name, response.content, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+            })
+        return field_info, len(response.content)
+
+    def handle(self, *args, **options):
+        if options['jobs'] < 1:
+            raise CommandError('The number of jobs must be at least 1.')
+        if options['from_file'] and options['from_dir']:
+            raise CommandError('Cannot use both --from_file and --from_dir.')
+        if options['all']:
+            table_names = list(getattr(settings, 'PD_TYPES', DEFAULT_PD_TYPES))
+        elif options['from_file']:
+            table_names = [pathlib.Path(options['from_file']).stem]
+        else:
+            table_names = [options['table']]
+        recorder = PhaseRecorder('import_ckan_schema', 'all' if options['all'] else table_names[0])
+        self.logger.info("Importing CKAN schema for tables: {}".format(", ".join(table_names)))
+
+        # Fetch the schemas over a single session so the connection to the portal is reused
+
+        failures = []
+        tables = {}
+        with requests.Session() as session, recorder.phase('fetch') as phase:
+            with ThreadPoolExecutor(max_workers=min(options['jobs'], len(table_names))) as pool:
+                if options['from_file']:
+                    futures = [(table_names[0], pool.submit(read_schema_file, options['from_file']))]
+                else:
+                    futures = [(table_name, pool.submit(self.load_schema, session, table_name, options)) for table_name in table_names]
+                for table_name, future in futures:
+                    try:
+                        field_info, size = future.result()
+                    except Exception as e:
+                        self.logger.error(f'Error importing CKAN schema for table {table_name}: {e}')
+                        failures.append(table_name)
+                        continue
+                    tables.update(schema_fields(table_name, field_info))
+                    phase['bytes_read'] += size
 
-        return None
+        with recorder.phase('apply') as phase:
+            created, updated, deleted = apply_schema_fields(tables)
+            invalidate_schemas()
+            phase['rows'] += sum(len(fields) for fields in tables.values())
+        recorder.save()
+        if tables:
+            self.logger.info(f'Successfully imported CKAN schema for tables: {", ".join(tables)}. '
+                             f'{created} fields created, {updated} updated, {deleted} deleted')
+        if failures:
+            raise CommandError(f'Failed to retrieve CKAN schema for tables: {", ".join(failures)}')
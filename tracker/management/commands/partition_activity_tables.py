@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+import logging
+from sqlalchemy import text
+from tracker.db import get_engine
+from tracker.management.commands.compare_csv_files import activity_table_kind, create_activity_table, create_activity_partition
+from tracker.management.commands.compare_pd_archive import load_all_table_fields
+
+
+class Command(BaseCommand):
+    help = "Convert PD activity tables created before partitioning, with TEXT log dates, into tables range-partitioned " \
+           "by month on a DATE log_date column. Can convert all types or a single type."
+
+    logger = logging.getLogger(__name__)
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', type=str, help='The Recombinant Type to be converted. Use "all" to convert all.')
+        parser.add_argument('--keep_old', action='store_true', default=False,
+                            help='Keep the original table as <type>_unpartitioned instead of dropping it.')
+
+    def select_column(self, column, data_type):
+        '''
+        Build the SQL expression copying a column of the old table into the partitioned table. Text log dates are cast
+        to dates and comma separated changed_fields lists are split into arrays.
+        :param column: column name
+        :param data_type: information_schema data type of the column in the old table
+        :return: SQL expression
+        '''
+        if column == 'log_date':
+            return f'CAST({column} AS DATE)'
+        if column == 'changed_fields' and data_type != 'ARRAY':
+            return f"string_to_array({column}, ',')"
+        return column
+
+    def convert_table(self, pgconn, table_name, primary_key, keep_old):
+        '''
+        Copy an unpartitioned activity table into a new partitioned table with the same name and columns
+        :param table_name: PD type
+        :param primary_key: list of the primary key field names
+        :param keep_old: Keep the original table instead of dropping it
+        '''
+        table_kind = activity_table_kind(pgconn, table_name)
+        if table_kind is None:
+            self.logger.info(f'No activity table found for {table_name}')
+            return
+        if table_kind == 'p':
+            self.logger.info(f'{table_name} is already partitioned')
+            return
+
+        old_table = f'{table_name}_unpartitioned'
+        results = pgconn.execute(text(f'''select column_name, data_type from information_schema.columns
+                                          where table_schema = 'public' and table_name = '{table_name}' order by ordinal_position'''))
+        column_types = {row[0]: row[1] for row in results}
+        columns = list(column_types)
+        if 'log_date' not in columns or 'log_activity' not in columns:
+            raise CommandError(f'{table_name} is not an activity table')
+
+        self.logger.info(f'Converting {table_name} to a partitioned table')
+        pgconn.execute(text(f'ALTER TABLE {table_name} RENAME TO {old_table}'))
+
+        # Indexes keep their names when the table is renamed, so move them out of the way of the new table's indexes
+
+        results = pgconn.execute(text(f"select indexname from pg_indexes where schemaname = 'public' and tablename = '{old_table}'"))
+        for row in results.fetchall():
+            pgconn.execute(text(f'ALTER INDEX {row[0]} RENAME TO {row[0]}_unpartitioned'))
+        create_activity_table(pgconn, table_name, columns, primary_key)
+        results = pgconn.execute(text(f'SELECT DISTINCT CAST(log_date AS DATE) FROM {old_table}'))
+        for row in results.fetchall():
+            create_activity_partition(pgconn, table_name, row[0])
+        select_fields = ", ".join(self.select_column(c, column_types[c]) for c in columns)
+        results = pgconn.execute(text(f'INSERT INTO {table_name} ({", ".join(columns)}) SELECT {select_fields} FROM {old_table}'))
+        self.logger.info(f'Copied {results.rowcount} rows to {table_name}')
+        pgconn.execute(text(f'ANALYZE {table_name}'))
+        if not keep_old:
+            pgconn.execute(text(f'DROP TABLE {old_table}'))
+
+    def handle(self, *args, **options):
+        table_name = options['table'].replace('-', '_')
+        table_fields = load_all_table_fields()
+        if table_name == 'all':
+            table_list = sorted(table_fields)
+        elif table_name in table_fields:
+            table_list = [table_name]
+        else:
+            raise CommandError(f'No fields found for table {table_name}')
+
+        # Convert each table in its own transaction so that a failure leaves the other tables converted
+
+        eng = get_engine()
+        for table in table_list:
+            with eng.begin() as pgconn:
+                self.convert_table(pgconn, table, table_fields[table][0], options['keep_old'])
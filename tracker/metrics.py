@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.utils import timezone
+import json
+import logging
+import sys
+import time
+from tracker.models import PDRunPhase
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows, where peak memory is not recorded
+    resource = None
+
+metrics_logger = logging.getLogger('tracker.metrics')
+
+
+def peak_rss_mb():
+    '''
+    Return the peak resident set size of the process so far
+    :return: peak memory in MB, or None if it cannot be measured on this platform
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class PhaseRecorder:
+    '''
+    Record the wall time, rows processed, bytes read and peak memory of the phases of a command run on a PD type. A
+    phase that is entered several times, such as fetching the batches of a streamed comparison, is accumulated into a
+    single record. The peak memory of a phase is the peak of the process when the phase last ended.
+    '''
+
+    def __init__(self, command, table_id):
+        self.command = command
+        self.table_id = table_id
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name, rows=0, bytes_read=0):
+        '''
+        Time a phase. The yielded record can be updated with the rows and bytes processed inside the phase.
+        :param name: Phase name, e.g. hash, load_first_file, index, diff or write
+        :param rows: Number of rows processed, if known up front
+        :param bytes_read: Number of bytes read, if known up front
+        :return: dictionary of the phase measurements
+        '''
+        record = self.phases.setdefault(name, {'phase': name, 'started': timezone.now(), 'seconds': 0.0, 'rows': 0,
+                                               'bytes_read': 0, 'peak_rss_mb': None})
+        record['rows'] += rows
+        record['bytes_read'] += bytes_read
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] += time.perf_counter() - start
+            record['peak_rss_mb'] = peak_rss_mb()
+
+    def save(self, run_log=None):
+        '''
+        Store the recorded phases, and log them as JSON lines on the tracker.metrics logger if PD_METRICS_JSON_LOG is set
+        :param run_log: PDRunLog entry of the comparison the phases belong to, or None
+        '''
+        PDRunPhase.objects.bulk_create([PDRunPhase(run_log=run_log, command=self.command, table_id=self.table_id, **record)
+                                        for record in self.phases.values()])
+        if getattr(settings, 'PD_METRICS_JSON_LOG', False):
+            for record in self.phases.values():
+                metrics_logger.info(json.dumps({**record, 'started': record['started'].isoformat(), 'command': self.command,
+                                                'table_id': self.table_id, 'run_log': run_log.pk if run_log else None}))
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.20 on 2026-10-18 02:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDRunLog',
+            fields=[
+                ('activity_id', models.AutoField(primary_key=True, serialize=False)),
+                ('table_id', models.CharField(max_length=100)),
+                ('file_from', models.CharField(max_length=200)),
+                ('file_to', models.CharField(max_length=200)),
+                ('activity_date', models.DateTimeField()),
+                ('log_date', models.DateTimeField()),
+                ('report_file', models.CharField(max_length=200)),
+                ('rows_added', models.IntegerField(default=0)),
+                ('rows_updated', models.IntegerField(default=0)),
+                ('rows_deleted', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'PD Warehouse Run Log',
+                'verbose_name_plural': 'PD Warehouse Run Logs',
+                'ordering': ['-log_date', 'table_id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PDTableField',
+            fields=[
+                ('field_id', models.AutoField(primary_key=True, serialize=False)),
+                ('table_id', models.CharField(max_length=100)),
+                ('field_name', models.CharField(max_length=200)),
+                ('field_order', models.IntegerField()),
+                ('field_type', models.CharField(max_length=100)),
+                ('label_en', models.CharField(max_length=200)),
+                ('label_fr', models.CharField(max_length=200)),
+                ('primary_key', models.BooleanField(default=False)),
+                ('pd_export', models.BooleanField(default=False)),
+            ],
+            options={
+                'verbose_name': 'PD Types Field',
+                'verbose_name_plural': 'PD Types Fields',
+                'ordering': ['table_id', 'field_name', 'field_order'],
+                'unique_together': {('table_id', 'field_name')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.20 on 2026-10-18 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDExportLog',
+            fields=[
+                ('export_id', models.AutoField(primary_key=True, serialize=False)),
+                ('table_id', models.CharField(max_length=100)),
+                ('report_file', models.CharField(max_length=200, unique=True)),
+                ('export_date', models.DateTimeField()),
+                ('high_water_mark', models.DateField()),
+                ('rows_exported', models.IntegerField(default=0)),
+                ('full_export', models.BooleanField(default=True)),
+            ],
+            options={
+                'verbose_name': 'PD Export Log',
+                'verbose_name_plural': 'PD Export Logs',
+                'ordering': ['table_id', 'report_file'],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.20 on 2026-10-18 02:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0002_pdexportlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PDRunPhase',
+            fields=[
+                ('phase_id', models.AutoField(primary_key=True, serialize=False)),
+                ('command', models.CharField(max_length=100)),
+                ('table_id', models.CharField(max_length=100)),
+                ('phase', models.CharField(max_length=100)),
+                ('started', models.DateTimeField()),
+                ('seconds', models.FloatField(default=0)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('bytes_read', models.BigIntegerField(default=0)),
+                ('peak_rss_mb', models.FloatField(blank=True, null=True)),
+                ('run_log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='phases', to='tracker.pdrunlog')),
+            ],
+            options={
+                'verbose_name': 'PD Run Phase',
+                'verbose_name_plural': 'PD Run Phases',
+                'ordering': ['-started', 'table_id', 'phase_id'],
+            },
+        ),
+    ]
@@ -62,4 +62,65 @@ class PDRunLog(models.Model):
     class Meta:
         ordering = ['-log_date', 'table_id']
         verbose_name = 'PD Warehouse Run Log'
-        verbose_name_plural = 'PD Warehouse Run Logs'
\ No newline at end of file
+        verbose_name_plural = 'PD Warehouse Run Logs'
+
+
+class PDExportLog(models.Model):
+    """
+    This class represents the PDExportLog model.
+    Every time a PD activity file is exported, the latest log date written to the file is recorded in this table so
+    that an incremental export only needs to append the newer rows.
+    """
+    # Fields
+    export_id = models.AutoField(primary_key=True)
+    table_id = models.CharField(max_length=100)
+    report_file = models.CharField(max_length=200, unique=True)
+    export_date = models.DateTimeField()
+    high_water_mark = models.DateField()
+    rows_exported = models.IntegerField(default=0)
+    full_export = models.BooleanField(default=True)
+
+    # Relationships
+    # Methods
+    def __str__(self):
+        """
+        String for representing the Model object (in Admin site etc.)
+        """
+        return f'{self.table_id}-{self.report_file}-{self.high_water_mark}'
+
+    class Meta:
+        ordering = ['table_id', 'report_file']
+        verbose_name = 'PD Export Log'
+        verbose_name_plural = 'PD Export Logs'
+
+
+class PDRunPhase(models.Model):
+    """
+    This class represents the PDRunPhase model.
+    The wall time, rows, bytes read and peak memory of each phase of a comparison, export or schema import are
+    recorded in this table. Comparison phases are linked to their run log entry.
+    """
+    # Fields
+    phase_id = models.AutoField(primary_key=True)
+    run_log = models.ForeignKey(PDRunLog, on_delete=models.CASCADE, null=True, blank=True, related_name='phases')
+    command = models.CharField(max_length=100)
+    table_id = models.CharField(max_length=100)
+    phase = models.CharField(max_length=100)
+    started = models.DateTimeField()
+    seconds = models.FloatField(default=0)
+    rows = models.BigIntegerField(default=0)
+    bytes_read = models.BigIntegerField(default=0)
+    peak_rss_mb = models.FloatField(null=True, blank=True)
+
+    # Relationships
+    # Methods
+    def __str__(self):
+        """
+        String for representing the Model object (in Admin site etc.)
+        """
+        return f'{self.command}-{self.table_id}-{self.phase}-{self.started}'
+
+    class Meta:
+        ordering = ['-started', 'table_id', 'phase_id']
+        verbose_name = 'PD Run Phase'
+        verbose_name_plural = 'PD Run Phases'
@@ -0,0 +1,168 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tracker.schema import get_schema
+
+# Arrow types for the CKAN datastore types of the PD fields. Any other type, including arrays, is kept as a string.
+
+CKAN_ARROW_TYPES = {
+    'int': pa.int64(),
+    'year': pa.int64(),
+    'month': pa.int64(),
+    'numeric': pa.float64(),
+    'money': pa.float64(),
+    'date': pa.date32(),
+    'timestamp': pa.timestamp('us', tz='UTC'),
+    'boolean': pa.bool_(),
+}
+
+BOOLEAN_VALUES = {'true': True, 't': True, 'yes': True, 'y': True, '1': True,
+                  'false': False, 'f': False, 'no': False, 'n': False, '0': False}
+
+
+def load_field_types(table_name):
+    '''
+    Look up the CKAN datastore type of every field of a PD type from its cached schema
+    :param table_name: PD type
+    :return: dictionary of field name to datastore type
+    '''
+    schema = get_schema(table_name)
+    return dict(schema.field_types) if schema else {}
+
+
+def arrow_schema(columns, field_types):
+    '''
+    Build the Arrow schema of a PD CSV or activity file. The PD fields are typed from their datastore type, log_date is
+    a date and every other column is a string.
+    :param columns: list of the column names
+    :param field_types: dictionary of field name to datastore type
+    :return: Arrow schema
+    '''
+    fields = []
+    for c in columns:
+        if c == 'log_date':
+            fields.append(pa.field(c, pa.date32()))
+        else:
+            fields.append(pa.field(c, CKAN_ARROW_TYPES.get(field_types.get(c, 'text'), pa.string())))
+    return pa.schema(fields)
+
+
+def to_arrow_array(values, arrow_type):
+    '''
+    Convert a column of PD values, read as strings, to an Arrow array of the given type. Values that cannot be
+    converted become nulls rather than failing the whole file.
+    :param values: pandas Series
+    :param arrow_type: Arrow type of the column
+    :return: Arrow array
+    '''
+    if pa.types.is_integer(arrow_type):
+        numbers = pd.to_numeric(values, errors='coerce')
+        return pa.array(numbers.where(numbers % 1 == 0).astype('Int64'), type=arrow_type, from_pandas=True)
+    if pa.types.is_floating(arrow_type):
+        return pa.array(pd.to_numeric(values, errors='coerce'), type=arrow_type, from_pandas=True)
+    if pa.types.is_date(arrow_type):
+        dates = pd.to_datetime(values.astype(object).where(values.notna()), errors='coerce', format='ISO8601')
+        return pa.array(dates, from_pandas=True).cast(arrow_type, safe=False)
+    if pa.types.is_timestamp(arrow_type):
+        timestamps = pd.to_datetime(values.astype(object).where(values.notna()), errors='coerce', format='ISO8601', utc=True)
+        return pa.array(timestamps, from_pandas=True).cast(arrow_type, safe=False)
+    if pa.types.is_boolean(arrow_type):
+        return pa.array(values.astype(object).where(values.notna()).map(lambda v: BOOLEAN_VALUES.get(str(v).strip().lower())),
+                        type=arrow_type, from_pandas=True)
+    return pa.array(values.astype(object).map(lambda v: None if pd.isna(v) else str(v)), type=arrow_type, from_pandas=True)
+
+
+def to_arrow_table(df, schema):
+    '''
+    Convert a DataFrame of PD values to an Arrow table with the given schema. Columns missing from the DataFrame are
+    written as nulls.
+    :param df: DataFrame of PD values
+    :param schema: Arrow schema
+    :return: Arrow table
+    '''
+    arrays = []
+    for field in schema:
+        if field.name in df.columns:
+            arrays.append(to_arrow_array(df[field.name], field.type))
+        else:
+            arrays.append(pa.nulls(len(df.index), type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class ActivityDatasetWriter:
+    '''
+    Write PD activity rows to a Parquet dataset partitioned as table=<type>/log_date=<YYYY-MM-DD>, so the history
+    can be read with partition pruning and predicate pushdown. Each log date is one file with a row group per batch.
+    The file of a log date is replaced when rows for that date are first written, so rows must arrive grouped by log
+    date, and re-running a day does not duplicate its rows.
+    '''
+
+    def __init__(self, dataset_dir, table_name, field_types):
+        self.table_dir = os.path.join(dataset_dir, f'table={table_name}')
+        self.field_types = field_types
+        self.schema = None
+        self.log_date = None
+        self.writer = None
+
+    def partition_dir(self, log_date):
+        return os.path.join(self.table_dir, f'log_date={log_date}')
+
+    def clear(self):
+        '''
+        Remove every log date of the PD type from the dataset
+        '''
+        self.close()
+        shutil.rmtree(self.table_dir, ignore_errors=True)
+
+    def clear_partition(self, log_date):
+        '''
+        Remove the rows of one log date from the dataset
+        :param log_date: Date, or YYYY-MM-DD string, of the partition to remove
+        '''
+        if self.log_date == str(log_date):
+            self.close()
+        shutil.rmtree(self.partition_dir(str(log_date)), ignore_errors=True)
+
+    def write(self, df):
+        '''
+        Append a batch of activity rows, with a log_date column, to the dataset
+        :param df: DataFrame of activity rows
+        '''
+        if len(df.index) == 0:
+            return
+        if self.schema is None:
+            self.schema = arrow_schema([c for c in df.columns if c != 'log_date'], self.field_types)
+        for log_date, rows in df.groupby(df['log_date'].astype(str), sort=False):
+            if log_date != self.log_date:
+                self.close()
+                self.clear_partition(log_date)
+                os.makedirs(self.partition_dir(log_date), exist_ok=True)
+                self.writer = pq.ParquetWriter(os.path.join(self.partition_dir(log_date), 'part-0.parquet'), self.schema)
+                self.log_date = log_date
+            self.writer.write_table(to_arrow_table(rows, self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self.log_date = None
+
+
+def cast_record_batch(batch, schema):
+    '''
+    Convert a record batch of PD values, read as strings, to the given schema. String columns are passed through
+    without leaving Arrow; only the typed columns are converted.
+    :param batch: Arrow record batch with string columns
+    :param schema: Arrow schema with the same column names
+    :return: Arrow record batch
+    '''
+    arrays = []
+    for field in schema:
+        column = batch.column(batch.schema.get_field_index(field.name))
+        if pa.types.is_string(field.type):
+            arrays.append(column)
+        else:
+            arrays.append(to_arrow_array(column.to_pandas(), field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
@@ -0,0 +1,26 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def prefetched(items, func, depth=1, discard=None):
+    '''
+    Yield func(item) for each item, in order, while the next items are prepared in a background thread. This lets
+    the next daily archive be decompressed while the current one is being compared.
+    :param items: Items to prepare, in processing order
+    :param func: Function that prepares an item
+    :param depth: Maximum number of items prepared ahead of the one being processed. 0 prepares items one at a time.
+    :param discard: Optional function called with the result of any item that was prepared but never processed
+    '''
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        try:
+            for item in items:
+                pending.append(pool.submit(func, item))
+                if len(pending) > depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                if not future.cancel() and discard and future.exception() is None:
+                    discard(future.result())
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+import cProfile
+import logging
+import os
+import pstats
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+def add_profile_arguments(parser):
+    '''
+    Add the profiling options shared by the PD commands to a command parser
+    '''
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='Profile the run with cProfile and write a .pstats file and a summary of the hottest functions '
+                             'next to the report file.')
+    parser.add_argument('--profile_dir', type=str, default='',
+                        help='Write the profiles to this directory instead of next to the report file.')
+    parser.add_argument('--profile_top', type=int, default=30,
+                        help='The number of functions and allocation sites listed in the profile summary.')
+    parser.add_argument('--profile_memory', action='store_true', default=False,
+                        help='Also trace memory allocations with tracemalloc and write an allocation snapshot. '
+                             'This slows the run down noticeably.')
+
+
+def profile_base(options, default_dir, name):
+    '''
+    Work out where the profile files of a run are written
+    :param options: command options with the profiling options
+    :param default_dir: Directory of the report file, used when no profile directory is given
+    :param name: File name of the profile files without extension
+    :return: path of the profile files without extension, or None if profiling is not enabled
+    '''
+    if not options.get('profile'):
+        return None
+    profile_dir = options.get('profile_dir') or default_dir or os.getcwd()
+    os.makedirs(profile_dir, exist_ok=True)
+    return os.path.join(profile_dir, name)
+
+
+def write_profile(profiler, snapshot, base_name, top, peak_memory=0):
+    '''
+    Write <base_name>.pstats, a <base_name>.txt summary of the top functions by cumulative and own time, and, if an
+    allocation snapshot was taken, <base_name>.tracemalloc with the peak traced memory and the top allocation sites
+    added to the summary
+    '''
+    profiler.dump_stats(f'{base_name}.pstats')
+    with open(f'{base_name}.txt', 'w', encoding='utf-8') as handle:
+        stats = pstats.Stats(profiler, stream=handle).strip_dirs()
+        handle.write(f'Top {top} functions by cumulative time\n')
+        stats.sort_stats('cumulative').print_stats(top)
+        handle.write(f'Top {top} functions by own time\n')
+        stats.sort_stats('tottime').print_stats(top)
+        if snapshot is not None:
+            snapshot.dump(f'{base_name}.tracemalloc')
+            handle.write(f'Peak traced memory: {peak_memory / (1024 * 1024):.1f} MB\n')
+            handle.write(f'Top {top} allocation sites still in use at the end of the run\n\n')
+            for stat in snapshot.statistics('lineno')[:top]:
+                handle.write(f'{stat}\n')
+    logger.info(f'Wrote profile to {base_name}.pstats and summary to {base_name}.txt')
+
+
+@contextmanager
+def profiled(base_name, top=30, trace_memory=False):
+    '''
+    Profile the enclosed block with cProfile, and optionally tracemalloc. cProfile only sees the thread it was started
+    in, so work handed to other threads is not included.
+    :param base_name: path of the profile files without extension, or None to run the block without profiling
+    :param top: Number of functions and allocation sites listed in the summary
+    :param trace_memory: Also take a tracemalloc snapshot
+    '''
+    if not base_name:
+        yield
+        return
+    profiler = cProfile.Profile()
+    if trace_memory:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = None
+        peak_memory = 0
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        write_profile(profiler, snapshot, base_name, top, peak_memory)
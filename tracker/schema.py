@@ -0,0 +1,106 @@
+from django.conf import settings
+from django.core.cache import cache
+import time
+from tracker.models import PDTableField
+
+# Every cached schema is keyed by the current schema version, so changing the version invalidates the schemas cached
+# by every process that shares the Django cache.
+
+SCHEMA_VERSION_KEY = 'pd_tracker:schema:version'
+
+_schemas = {}
+_schemas_version = None
+
+
+class PDSchema:
+    '''
+    The field metadata of a PD type that the comparison and export commands need, built from its PDTableField rows
+    '''
+
+    def __init__(self, table_id, pd_fields):
+        '''
+        :param table_id: PD type
+        :param pd_fields: list of the PDTableField objects of the PD type, in field order
+        '''
+        self.table_id = table_id
+        self.field_names = [f.field_name for f in pd_fields]
+        self.primary_key = [f.field_name for f in pd_fields if f.primary_key]
+        self.non_key_fields = [f.field_name for f in pd_fields if not f.primary_key]
+        self.export_fields = [f.field_name for f in pd_fields if f.pd_export]
+        self.field_types = {f.field_name: f.field_type for f in pd_fields}
+
+    def __str__(self):
+        return self.table_id
+
+
+def schema_cache_key(version, table_name):
+    return f'pd_tracker:schema:{version}:{table_name}'
+
+
+def current_version():
+    '''
+    Get the current schema version from the Django cache, and drop the schemas held in this process if it has changed
+    :return: schema version
+    '''
+    global _schemas_version
+    version = cache.get_or_set(SCHEMA_VERSION_KEY, time.time_ns, timeout=None)
+    if version != _schemas_version:
+        _schemas.clear()
+        _schemas_version = version
+    return version
+
+
+def invalidate_schemas():
+    '''
+    Drop every cached PD schema, in this process and in the Django cache. Call this whenever PDTableField rows change.
+    '''
+    cache.set(SCHEMA_VERSION_KEY, time.time_ns(), timeout=None)
+    current_version()
+
+
+def get_all_schemas():
+    '''
+    Get the schema of every PD type, reading all the PDTableField rows in a single query if they are not cached
+    :return: dictionary of PD type to PDSchema, ordered by PD type
+    '''
+    version = current_version()
+    table_ids = cache.get(schema_cache_key(version, '__all__'))
+    if table_ids is not None and all(t in _schemas for t in table_ids):
+        return {t: _schemas[t] for t in table_ids}
+
+    pd_fields = {}
+    for pd_field in PDTableField.objects.all().order_by('table_id', 'field_order'):
+        pd_fields.setdefault(pd_field.table_id, []).append(pd_field)
+    schemas = {t: PDSchema(t, fields) for t, fields in pd_fields.items()}
+    timeout = getattr(settings, 'PD_SCHEMA_CACHE_TIMEOUT', 60 * 60 * 24)
+    cache.set_many({schema_cache_key(version, t): schema for t, schema in schemas.items()}, timeout=timeout)
+    cache.set(schema_cache_key(version, '__all__'), list(schemas), timeout=timeout)
+    _schemas.update(schemas)
+    return schemas
+
+
+def get_schema(table_name):
+    '''
+    Get the schema of a PD type from this process, the Django cache or the PD database, in that order
+    :param table_name: PD type
+    :return: PDSchema, or None if the PD type has no fields
+    '''
+    version = current_version()
+    schema = _schemas.get(table_name)
+    if schema is None:
+        schema = cache.get(schema_cache_key(version, table_name))
+    if schema is None:
+        pd_fields = list(PDTableField.objects.filter(table_id=table_name).order_by('field_order'))
+        if not pd_fields:
+            return None
+        schema = PDSchema(table_name, pd_fields)
+        cache.set(schema_cache_key(version, table_name), schema, timeout=getattr(settings, 'PD_SCHEMA_CACHE_TIMEOUT', 60 * 60 * 24))
+    _schemas[table_name] = schema
+    return schema
+
+
+def pd_table_ids():
+    '''
+    :return: sorted list of every PD type with fields
+    '''
+    return list(get_all_schemas())
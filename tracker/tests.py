@@ -1,3 +1,443 @@
-from django.test import TestCase
+import csv
+from datetime import datetime
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import mock
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+from tracker.db import get_engine
+from tracker.management.commands.compare_csv_files import (digest_changed_fields, key_digests, read_digest_snapshot, row_digests,
+                                                           snapshot_path, sql_changed_fields, write_digest_snapshot)
+from tracker.management.commands.compare_pd_archive import Command as CompareArchiveCommand
+from tracker.management.commands.csv_to_parquet import pd_type_for_file
+from tracker.models import PDRunLog, PDTableField
+from tracker.parquet import arrow_schema, to_arrow_array
+from tracker.pipeline import prefetched
+from tracker.schema import invalidate_schemas
 
-# Create your tests here.
+TEST_TYPE = 'pdtest'
+TEST_FIELDS = [('ref_number', True), ('owner_org', True), ('title', False), ('amount', False)]
+
+
+def write_pd_csv(file_name, columns, rows):
+    with open(file_name, 'w', encoding='utf-8', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+class CompareCommandTestCase(TestCase):
+    '''
+    Runs compare_csv_files against the PostgreSQL test database on small generated PD files
+    '''
+
+    @classmethod
+    def tearDownClass(cls):
+        # The SQLAlchemy pool holds connections to the test database, which must be closed before it is dropped
+        get_engine().dispose()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for field_order, (field_name, primary_key) in enumerate(TEST_FIELDS):
+            PDTableField.objects.create(table_id=TEST_TYPE, field_name=field_name, field_order=field_order,
+                                        field_type='text', label_en=field_name, label_fr=field_name,
+                                        primary_key=primary_key, pd_export=True)
+        invalidate_schemas()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+        with get_engine().begin() as pgconn:
+            pgconn.execute(text(f'DROP TABLE IF EXISTS {TEST_TYPE} CASCADE'))
+        invalidate_schemas()
+
+    def compare(self, first_rows, second_rows, first_columns=None, second_columns=None, **options):
+        '''
+        Write the two PD files and compare them with compare_csv_files
+        :param options: extra command options, such as engine
+        '''
+        columns = [f for f, _ in TEST_FIELDS]
+        first_file = os.path.join(self.temp_dir, f'{TEST_TYPE}_1.csv')
+        second_file = os.path.join(self.temp_dir, f'{TEST_TYPE}_2.csv')
+        write_pd_csv(first_file, first_columns or columns, first_rows)
+        write_pd_csv(second_file, second_columns or columns, second_rows)
+        call_command('compare_csv_files', '-t', TEST_TYPE, '-f1', first_file, '-f2', second_file,
+                     '-s', '2024-01-01', '-l', '2024-01-02', '--snapshot_dir', '', **options)
+
+    def activity_rows(self, log_date='2024-01-02'):
+        with get_engine().connect() as pgconn:
+            return [tuple(r) for r in pgconn.execute(text(
+                f'SELECT ref_number, log_activity, changed_fields FROM {TEST_TYPE} WHERE log_date = :log_date ORDER BY ref_number'),
+                {'log_date': log_date})]
+
+    def test_failed_comparison_raises(self):
+        columns = [f for f, _ in TEST_FIELDS]
+        for engine in ['postgres', 'local']:
+            with self.subTest(engine=engine):
+                with self.assertRaises(CommandError):
+                    self.compare([['1', 'org', 'a', '1']], [['1', 'org', 'a', '1', 'x']],
+                                 second_columns=columns + ['extra'], engine=engine)
+
+    def test_engines_agree_on_empty_values(self):
+        first_rows = [['1', 'org', 'a', '1'], ['2', 'org', '', '5'], ['3', 'org', 'b', ''], ['4', 'org', 'c', '7'],
+                      ['5', 'org', 'd', '8']]
+        second_rows = [['1', 'org', 'a', '1'], ['2', 'org', 'x', '5'], ['3', 'org', 'b', ''], ['4', 'org', 'c', ''],
+                       ['6', 'org', 'e', '9']]
+        expected = [('2', 'C', ['title']), ('4', 'C', ['amount']), ('5', 'D', None), ('6', 'A', None)]
+        for options in [{'engine': 'postgres'}, {'engine': 'postgres', 'insert_select': True}, {'engine': 'local'},
+                        {'engine': 'postgres', 'change_values': True}, {'engine': 'local', 'change_values': True}]:
+            with self.subTest(**options):
+                self.compare(first_rows, second_rows, **options)
+                run_log = PDRunLog.objects.order_by('-activity_id').first()
+                self.assertEqual((run_log.rows_added, run_log.rows_deleted, run_log.rows_updated), (1, 1, 2))
+                self.assertEqual(self.activity_rows(), expected)
+
+    def test_readers_agree_on_short_rows(self):
+        # pandas pads the missing fields with empty values, so the short rows are unchanged rather than deleted
+        first_rows = [['1', 'org', 'a', '1'], ['2', 'org', 'b', ''], ['3', 'org', '', '']]
+        second_rows = [['1', 'org', 'x', '1'], ['2', 'org', 'b'], ['3', 'org'], ['4', 'org', 'c', '4', 'extra']]
+        for options in [{'engine': 'postgres', 'loader': 'copy'}, {'engine': 'postgres', 'loader': 'to_sql'}, {'engine': 'local'}]:
+            for csv_reader in ['pandas', 'arrow']:
+                with self.subTest(csv_reader=csv_reader, **options):
+                    self.compare(first_rows, second_rows, csv_reader=csv_reader, **options)
+                    self.assertEqual(self.activity_rows(), [('1', 'C', ['title'])])
+
+    def test_report_columns_are_fixed(self):
+        report_file = os.path.join(self.temp_dir, 'report.csv')
+        write_pd_csv(report_file, ['ref_number', 'owner_org', 'title', 'amount', 'log_date', 'log_activity'],
+                     [['9', 'org', 'old', '1', '2023-12-31', 'A']])
+        first_rows = [['1', 'org', 'a', '1']]
+        second_rows = [['1', 'org', 'b', '1'], ['2', 'org', 'c', '2']]
+        for engine, insert_select in [('postgres', False), ('postgres', True), ('local', False)]:
+            with self.subTest(engine=engine, insert_select=insert_select):
+                self.compare(first_rows, second_rows, engine=engine, insert_select=insert_select, report_file=report_file)
+        with open(report_file, encoding='utf-8', newline='') as handle:
+            rows = list(csv.reader(handle))
+        self.assertEqual(rows[0], [f for f, _ in TEST_FIELDS] + ['log_date', 'log_activity', 'changed_fields', 'changed_values'])
+        self.assertEqual(len(rows), 7)
+        self.assertTrue(all(len(r) == len(rows[0]) for r in rows))
+        self.assertEqual({r[-2] for r in rows[1:] if r[5] == 'C'}, {'title'})
+        old_reports = [f for f in os.listdir(self.temp_dir) if f.startswith('report_')]
+        self.assertEqual(len(old_reports), 1)
+
+    def test_changed_fields_text_column_is_converted(self):
+        first_rows = [['1', 'org', 'a', '1'], ['2', 'org', 'b', '2']]
+        second_rows = [['1', 'org', 'x', '9'], ['2', 'org', 'b', '3']]
+        self.compare(first_rows, second_rows)
+        with get_engine().begin() as pgconn:
+            pgconn.execute(text(f'DROP INDEX {TEST_TYPE}_changed_fields_idx'))
+            pgconn.execute(text(f"ALTER TABLE {TEST_TYPE} ALTER COLUMN changed_fields TYPE TEXT USING array_to_string(changed_fields, ',')"))
+        self.compare(first_rows, second_rows, engine='local')
+        with get_engine().connect() as pgconn:
+            data_type = pgconn.execute(text(f"""SELECT data_type FROM information_schema.columns
+                                                WHERE table_name = '{TEST_TYPE}' AND column_name = 'changed_fields'""")).scalar()
+            self.assertEqual(data_type, 'ARRAY')
+            self.assertTrue(pgconn.execute(text(f"SELECT to_regclass('{TEST_TYPE}_changed_fields_idx') IS NOT NULL")).scalar())
+            rows = pgconn.execute(text(f"SELECT ref_number FROM {TEST_TYPE} WHERE changed_fields @> ARRAY['amount'] ORDER BY ref_number"))
+            self.assertEqual([r[0] for r in rows], ['1', '2'])
+
+    def test_partitioned_table_gets_its_own_indexes(self):
+        with get_engine().begin() as pgconn:
+            pgconn.execute(text(f'''CREATE TABLE {TEST_TYPE} (ref_number TEXT, owner_org TEXT, title TEXT, amount TEXT,
+                                    log_date TEXT, log_activity TEXT, changed_fields TEXT)'''))
+            pgconn.execute(text(f"INSERT INTO {TEST_TYPE} VALUES ('1', 'org', 'a', '1', '2024-01-02', 'C', 'title,amount')"))
+            pgconn.execute(text(f'CREATE INDEX {TEST_TYPE}_key_idx ON {TEST_TYPE} (ref_number, owner_org, log_date)'))
+            pgconn.execute(text(f'CREATE INDEX {TEST_TYPE}_changed_fields_idx ON {TEST_TYPE} (changed_fields)'))
+        try:
+            call_command('partition_activity_tables', TEST_TYPE, '--keep_old')
+            with get_engine().connect() as pgconn:
+                indexes = pgconn.execute(text(f"SELECT indexname, tablename, indexdef FROM pg_indexes WHERE indexname LIKE '{TEST_TYPE}_%'"))
+                indexes = {r[0]: (r[1], r[2]) for r in indexes}
+            self.assertEqual(indexes[f'{TEST_TYPE}_key_idx'][0], TEST_TYPE)
+            self.assertEqual(indexes[f'{TEST_TYPE}_changed_fields_idx'][0], TEST_TYPE)
+            self.assertIn('USING gin', indexes[f'{TEST_TYPE}_changed_fields_idx'][1])
+            self.assertEqual(indexes[f'{TEST_TYPE}_changed_fields_idx_unpartitioned'][0], f'{TEST_TYPE}_unpartitioned')
+            self.assertEqual(self.activity_rows(), [('1', 'C', ['title', 'amount'])])
+        finally:
+            with get_engine().begin() as pgconn:
+                pgconn.execute(text(f'DROP TABLE IF EXISTS {TEST_TYPE}_unpartitioned'))
+
+    def test_export_engines_write_changed_fields_as_lists(self):
+        self.compare([['1', 'org', 'a', '1']], [['1', 'org', 'b', '2'], ['2', 'org', 'two\nlines', '3']])
+        exports = {}
+        for linesep in ['\n', '\r\n']:
+            for engine in ['pandas', 'copy']:
+                report_dir = os.path.join(self.temp_dir, f'{engine}_{len(linesep)}')
+                os.makedirs(report_dir)
+                with mock.patch('os.linesep', linesep):
+                    call_command('export_pd_csv', TEST_TYPE, '--report_dir', report_dir, '--engine', engine)
+                with open(os.path.join(report_dir, f'{TEST_TYPE}_activity.csv'), 'rb') as handle:
+                    exports[engine] = handle.read()
+            with self.subTest(linesep=linesep):
+                # Both engines end the records with the platform line separator, but not the line breaks in values
+                self.assertEqual(exports['pandas'], exports['copy'])
+                self.assertEqual(exports['copy'].count(b'"' + linesep.encode()), 3)
+                self.assertIn(b'"two\nlines"', exports['copy'])
+        with open(os.path.join(self.temp_dir, 'copy_2', f'{TEST_TYPE}_activity.csv'), encoding='utf-8-sig', newline='') as handle:
+            rows = list(csv.DictReader(handle))
+        self.assertEqual({r['ref_number']: r['changed_fields'] for r in rows}, {'1': 'title,amount', '2': ''})
+
+    def test_failed_incremental_export_appends_nothing(self):
+        self.compare([['1', 'org', 'a', '1']], [['1', 'org', 'b', '1'], ['2', 'org', 'c', '2']])
+        engines = ['pandas', 'copy']
+        report_files = {engine: os.path.join(self.temp_dir, engine, f'{TEST_TYPE}_activity.csv') for engine in engines}
+        first_exports = {}
+        for engine in engines:
+            os.makedirs(os.path.join(self.temp_dir, engine))
+            call_command('export_pd_csv', TEST_TYPE, '--report_dir', os.path.join(self.temp_dir, engine), '--incremental', '--engine', engine)
+            with open(report_files[engine], 'rb') as handle:
+                first_exports[engine] = handle.read()
+        day3_file = os.path.join(self.temp_dir, f'{TEST_TYPE}_3.csv')
+        write_pd_csv(day3_file, [f for f, _ in TEST_FIELDS], [['1', 'org', 'b', '1'], ['2', 'org', 'd', '2'], ['3', 'org', 'e', '3']])
+        call_command('compare_csv_files', '-t', TEST_TYPE, '-f1', os.path.join(self.temp_dir, f'{TEST_TYPE}_2.csv'),
+                     '-f2', day3_file, '-s', '2024-01-02', '-l', '2024-01-03', '--snapshot_dir', '')
+
+        for engine in engines:
+            with self.subTest(engine=engine):
+                report_dir = os.path.join(self.temp_dir, engine)
+                with mock.patch('tracker.management.commands.export_pd_csv.ActivityDatasetWriter.write', side_effect=OSError('disk full')):
+                    with self.assertRaises(CommandError):
+                        call_command('export_pd_csv', TEST_TYPE, '--report_dir', report_dir, '--incremental', '--engine', engine,
+                                     '--parquet_dir', os.path.join(self.temp_dir, f'{engine}_parquet'))
+
+                # The rows appended by the pandas scan are removed, while the copy engine completed the file before the
+                # Parquet dataset failed, so it is kept and recorded
+                with open(report_files[engine], 'rb') as handle:
+                    self.assertEqual(handle.read() == first_exports[engine], engine == 'pandas')
+                call_command('export_pd_csv', TEST_TYPE, '--report_dir', report_dir, '--incremental', '--engine', engine)
+                with open(report_files[engine], encoding='utf-8-sig', newline='') as handle:
+                    rows = sorted((r['ref_number'], r['log_date']) for r in csv.DictReader(handle))
+                self.assertEqual(rows, [('1', '2024-01-02'), ('2', '2024-01-02'), ('2', '2024-01-03'), ('3', '2024-01-03')])
+                self.assertEqual(os.listdir(report_dir), [f'{TEST_TYPE}_activity.csv'])
+
+    def test_snapshot_finds_changed_fields_without_the_first_file(self):
+        snapshot_dir = os.path.join(self.temp_dir, 'snapshots')
+        self.compare([['1', 'org', 'a', '1']], [['1', 'org', 'a', '1'], ['2', 'org', 'b', '2']],
+                     engine='local', snapshot_dir=snapshot_dir)
+
+        # The first file is only needed for deleted rows, so replacing it must not affect the comparison
+        first_file = os.path.join(self.temp_dir, f'{TEST_TYPE}_2.csv')
+        second_file = os.path.join(self.temp_dir, f'{TEST_TYPE}_3.csv')
+        write_pd_csv(first_file, ['unreadable'], [])
+        write_pd_csv(second_file, [f for f, _ in TEST_FIELDS], [['1', 'org', 'a', '5'], ['2', 'org', 'c', '2'], ['3', 'org', 'd', '3']])
+        call_command('compare_csv_files', '-t', TEST_TYPE, '-f1', first_file, '-f2', second_file, '-s', '2024-01-02',
+                     '-l', '2024-01-03', '--snapshot_dir', snapshot_dir, '--engine', 'local')
+        self.assertEqual(self.activity_rows('2024-01-03'), [('1', 'C', ['amount']), ('2', 'C', ['title']), ('3', 'A', None)])
+
+    def test_identical_files_carry_the_snapshot_forward(self):
+        snapshot_dir = os.path.join(self.temp_dir, 'snapshots')
+        columns = [f for f, _ in TEST_FIELDS]
+        rows = [['1', 'org', 'a', '1'], ['2', 'org', 'b', '2']]
+        self.compare([['1', 'org', 'a', '1']], rows, engine='local', snapshot_dir=snapshot_dir)
+        files = {day: os.path.join(self.temp_dir, f'{TEST_TYPE}_{day}.csv') for day in [3, 4]}
+        write_pd_csv(files[3], columns, rows)
+        call_command('compare_csv_files', '-t', TEST_TYPE, '-f1', os.path.join(self.temp_dir, f'{TEST_TYPE}_2.csv'),
+                     '-f2', files[3], '-s', '2024-01-02', '-l', '2024-01-03', '--snapshot_dir', snapshot_dir, '--engine', 'local')
+        self.assertTrue(os.path.exists(os.path.join(snapshot_dir, f'{TEST_TYPE}_2024_01_03.parquet')))
+
+        # The third day is compared from its carried forward snapshot, without reading its file
+        write_pd_csv(files[3], ['unreadable'], [])
+        write_pd_csv(files[4], columns, [['1', 'org', 'a', '1'], ['2', 'org', 'b', '7']])
+        call_command('compare_csv_files', '-t', TEST_TYPE, '-f1', files[3], '-f2', files[4], '-s', '2024-01-03',
+                     '-l', '2024-01-04', '--snapshot_dir', snapshot_dir, '--engine', 'local')
+        self.assertEqual(self.activity_rows('2024-01-04'), [('2', 'C', ['amount'])])
+
+    @override_settings(PD_ARCHIVE_MEMORY_SIZE=100)
+    def test_streamed_archives_are_reused_the_next_day(self):
+        columns = [f for f, _ in TEST_FIELDS]
+        days = {'20240101': [['1', 'org', 'a', '1']],
+                '20240102': [['1', 'org', 'b', '1'], ['2', 'org', 'c', '2']],
+                '20240103': [['1', 'org', 'b', '1'], ['2', 'org', 'c', '3'], ['3', 'org', 'a long title to read from the archive', '4']]}
+        data_dir = os.path.join(self.temp_dir, 'archives')
+        os.makedirs(data_dir)
+        for day, rows in days.items():
+            csv_file = os.path.join(self.temp_dir, f'{TEST_TYPE}.csv')
+            write_pd_csv(csv_file, columns, rows)
+            with tarfile.open(os.path.join(data_dir, f'pd-{day}.tar.gz'), 'w:gz') as tar:
+                tar.add(csv_file, arcname=f'{TEST_TYPE}.csv')
+        call_command('compare_pd_archive', '--data_dir', data_dir, '--stream', '--prefetch', '1', '--temp_dir', self.temp_dir)
+        self.assertEqual(self.activity_rows('2024-01-02'), [('1', 'C', ['title']), ('2', 'A', None)])
+        self.assertEqual(self.activity_rows('2024-01-03'), [('2', 'C', ['amount']), ('3', 'A', None)])
+        self.assertFalse([f for f in os.listdir(self.temp_dir) if f.startswith('import_od_')])
+
+    def test_export_failures_do_not_stop_the_other_types(self):
+        self.compare([['1', 'org', 'a', '1']], [['1', 'org', 'b', '1']])
+
+        # pdbroken sorts before the test type and cannot be exported, since it has no primary key
+        PDTableField.objects.create(table_id='pdbroken', field_name='title', field_order=0, field_type='text',
+                                    label_en='title', label_fr='title')
+        invalidate_schemas()
+        with get_engine().begin() as pgconn:
+            pgconn.execute(text('CREATE TABLE pdbroken (title TEXT, log_date DATE)'))
+        try:
+            for jobs in ['1', '2']:
+                with self.subTest(jobs=jobs):
+                    report_dir = os.path.join(self.temp_dir, f'jobs_{jobs}')
+                    os.makedirs(report_dir)
+                    with self.assertRaisesMessage(CommandError, '1 PD types failed to export: pdbroken'):
+                        call_command('export_pd_csv', 'all', '--report_dir', report_dir, '--jobs', jobs)
+                    self.assertTrue(os.path.exists(os.path.join(report_dir, f'{TEST_TYPE}_activity.csv')))
+        finally:
+            with get_engine().begin() as pgconn:
+                pgconn.execute(text('DROP TABLE pdbroken'))
+
+
+class CsvToParquetTestCase(TestCase):
+    '''
+    Runs csv_to_parquet on small generated CSV files
+    '''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_duplicate_targets_raise(self):
+        for day in ['20240101', '20240102']:
+            os.makedirs(os.path.join(self.temp_dir, day))
+            write_pd_csv(os.path.join(self.temp_dir, day, 'contracts.csv'), ['ref_number'], [['1']])
+        parquet_dir = os.path.join(self.temp_dir, 'parquet')
+        with self.assertRaisesMessage(CommandError, 'same Parquet file'):
+            call_command('csv_to_parquet', '--csv', os.path.join(self.temp_dir, '*', 'contracts.csv'), '--parquet', parquet_dir)
+        self.assertFalse(os.path.exists(parquet_dir))
+
+        call_command('csv_to_parquet', '--csv', os.path.join(self.temp_dir, '20240101'), '--parquet', parquet_dir)
+        self.assertEqual(os.listdir(parquet_dir), ['contracts.parquet'])
+
+    def test_single_file_types(self):
+        PDTableField.objects.create(table_id=TEST_TYPE, field_name='amount', field_order=0, field_type='numeric',
+                                    label_en='amount', label_fr='amount', primary_key=False)
+        PDTableField.objects.create(table_id=TEST_TYPE, field_name='ref_number', field_order=1, field_type='text',
+                                    label_en='ref_number', label_fr='ref_number', primary_key=True)
+        invalidate_schemas()
+        try:
+            # The PD type is taken from the file name, and files of no PD type have their column types inferred
+            types = {}
+            for name in [f'{TEST_TYPE}_activity', 'other', 'mixed']:
+                csv_file = os.path.join(self.temp_dir, f'{name}.csv')
+                parquet_file = os.path.join(self.temp_dir, f'{name}.parquet')
+                rows = [['1', '2'], ['3', 'x' if name == 'mixed' else '4']] * 5
+                write_pd_csv(csv_file, ['ref_number', 'amount'], rows)
+                call_command('csv_to_parquet', '--csv', csv_file, '--parquet', parquet_file, '--block_size', '24')
+                table = pq.read_table(parquet_file)
+                self.assertEqual(table.num_rows, 10)
+                types[name] = [f.type for f in table.schema]
+            self.assertEqual(types, {f'{TEST_TYPE}_activity': [pa.string(), pa.float64()], 'other': [pa.int64(), pa.int64()],
+                                     'mixed': [pa.string(), pa.string()]})
+        finally:
+            invalidate_schemas()
+
+
+class HelperTestCase(SimpleTestCase):
+    '''
+    Tests of the helper functions that do not need a database
+    '''
+
+    def test_sql_changed_fields(self):
+        self.assertEqual(sql_changed_fields([]), 'CAST(NULL AS TEXT[])')
+        expression = sql_changed_fields([f'field_{i}' for i in range(150)])
+        self.assertEqual(expression.count('ARRAY['), 1)
+        self.assertEqual(expression.count('IS DISTINCT FROM'), 150)
+        self.assertIn("CASE WHEN x.field_0 IS DISTINCT FROM y.field_0 THEN 'field_0' END", expression)
+
+    def test_row_digests(self):
+        df = pd.DataFrame({'a': ['1', '1', '1', None], 'b': ['x', 'x', 'y', 'x']})
+        digests = row_digests(df, ['a', 'b'])
+        self.assertEqual(digests.dtype, np.uint64)
+        self.assertEqual(digests[0], digests[1])
+        self.assertNotEqual(digests[0], digests[2])
+        self.assertNotEqual(digests[0], digests[3])
+        self.assertTrue((row_digests(df, []) == 0).all())
+
+    def test_digest_changed_fields(self):
+        old = key_digests(pd.DataFrame({'k': ['1', '2'], 'a': ['x', 'x'], 'b': ['y', None]}), ['k'], ['a', 'b'])
+        new = key_digests(pd.DataFrame({'k': ['1', '2'], 'a': ['x', 'z'], 'b': ['w', 'y']}), ['k'], ['a', 'b'])
+        matched = old.merge(new, on='k', suffixes=('_x', '_y'))
+        self.assertEqual(digest_changed_fields(matched, ['a', 'b']), [['b'], ['a', 'b']])
+
+    def test_snapshot_round_trip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            file_name = snapshot_path(temp_dir, 'contracts', datetime(2024, 1, 2))
+            self.assertEqual(os.path.basename(file_name), 'contracts_2024_01_02.parquet')
+            self.assertIsNone(read_digest_snapshot(file_name, ['k', 'a'], ['a']))
+            digests = key_digests(pd.DataFrame({'k': ['1', '2'], 'a': ['x', None]}), ['k'], ['a'])
+            write_digest_snapshot(file_name, digests, ['k', 'a'], ['a'])
+            pd.testing.assert_frame_equal(read_digest_snapshot(file_name, ['a', 'k'], ['a']), digests)
+            self.assertIsNone(read_digest_snapshot(file_name, ['k', 'a', 'b'], ['a', 'b']))
+
+            # Snapshots without field digests cannot be used to find the changed fields
+            write_digest_snapshot(file_name, digests[['k', '_digest']], ['k', 'a'], ['a'])
+            self.assertIsNone(read_digest_snapshot(file_name, ['k', 'a'], ['a']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_arrow_schema(self):
+        schema = arrow_schema(['ref_number', 'amount', 'start_date', 'log_date', 'changed_fields'],
+                              {'ref_number': 'text', 'amount': 'money', 'start_date': 'date'})
+        self.assertEqual([f.type for f in schema], [pa.string(), pa.float64(), pa.date32(), pa.date32(), pa.string()])
+
+    def test_to_arrow_array(self):
+        values = pd.Series(['1', '2.5', 'bad', None])
+        self.assertEqual(to_arrow_array(values, pa.int64()).to_pylist(), [1, None, None, None])
+        self.assertEqual(to_arrow_array(values, pa.float64()).to_pylist(), [1.0, 2.5, None, None])
+        self.assertEqual(to_arrow_array(pd.Series(['2024-01-31', 'never', None]), pa.date32()).to_pylist(),
+                         [datetime(2024, 1, 31).date(), None, None])
+        self.assertEqual(to_arrow_array(pd.Series(['Yes', 'f', 'maybe', None]), pa.bool_()).to_pylist(), [True, False, None, None])
+        self.assertEqual(to_arrow_array(values, pa.string()).to_pylist(), ['1', '2.5', 'bad', None])
+
+    def test_pd_type_for_file(self):
+        pd_types = {'contracts', 'contracts_nil', 'grants'}
+        self.assertEqual(pd_type_for_file('data/contracts.csv', pd_types), 'contracts')
+        self.assertEqual(pd_type_for_file('contracts-nil.csv', pd_types), 'contracts_nil')
+        self.assertEqual(pd_type_for_file('contracts_activity.csv', pd_types), 'contracts')
+        self.assertEqual(pd_type_for_file('contracts_nil_pd_activity.csv', pd_types), 'contracts_nil')
+        self.assertIsNone(pd_type_for_file('travel.csv', pd_types))
+
+    def test_prefetched(self):
+        for depth in [0, 1, 3]:
+            with self.subTest(depth=depth):
+                self.assertEqual(list(prefetched(range(5), lambda n: n * 2, depth=depth)), [0, 2, 4, 6, 8])
+
+        # Items that were prepared but never processed are handed to discard, the others are never prepared
+        prepared = []
+        discarded = []
+        items = prefetched(range(5), lambda n: prepared.append(n) or n, depth=2, discard=discarded.append)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(discarded, prepared[1:])
+        self.assertLessEqual(len(prepared), 3)
+
+    @override_settings(PD_ARCHIVE_MEMORY_SIZE=100)
+    def test_streamed_archive_members(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            contents = {'a.csv': b'a' * 60, 'b.csv': bytes(range(256)) * 4, 'c.csv': b'c' * 40}
+            with tarfile.open(os.path.join(temp_dir, 'pd-20240101.tar.gz'), 'w:gz') as tar:
+                for name, data in contents.items():
+                    member = tarfile.TarInfo(name)
+                    member.size = len(data)
+                    tar.addfile(member, io.BytesIO(data))
+            members, close = CompareArchiveCommand().open_archive('pd-20240101.tar.gz', {'data_dir': temp_dir, 'temp_dir': None, 'stream': True})
+
+            # The members that fit in the memory budget are kept, the others are read from the archive
+            self.assertEqual({n: m.in_memory for n, m in members.items()}, {'a.csv': True, 'b.csv': False, 'c.csv': True})
+            for name, data in contents.items():
+                for _ in range(2):
+                    with members[name].open() as handle:
+                        self.assertEqual(handle.read(), data)
+            close()
+            with self.assertRaises(ValueError):
+                members['a.csv'].open()
+        finally:
+            shutil.rmtree(temp_dir)